@@ -16,6 +16,8 @@
 #ifdef MULTI_THREAD_KL_CALC
 #include <pthread.h>
 #include <time.h>
+#include <unistd.h>
+#include <atomic>
 #endif
 
 extern "C"{
@@ -29,6 +31,15 @@ struct mul_thread_inputs{
   long long N;
   long long BINS;
 };
+
+struct batch_thread_inputs {
+  const int* data;
+  const float* width;
+  float* threshold;
+  long long num;
+  long long N;
+  std::atomic<long long>* next;
+};
 #endif
 
 static inline void print_trace(void)
@@ -325,6 +336,135 @@ float real_multi_thread_kl_diversity_hist(int *data, float &width, const long lo
 
   return threshold;
 }
+
+// Same KL divergence as kl_calc_thread for every candidate bins number of one
+// histogram. P and log10(P) are shared by all the candidates, and log10(Q) is
+// computed once per merged bin. The float operations keep the order of
+// kl_calc_thread, so the results are bit exact.
+static long long kl_min_index(const int *data, long long N, long long BINS,
+                              long long *hist, float *P, double *logP, float *kl) {
+  long long count = 0;
+  bool negative = false;
+  for (long long j = 0; j < N; j++) {
+    hist[j] = data[j];
+    count += hist[j];
+    negative |= hist[j] < 0;
+  }
+  for (long long j = 0; j < N; j++) {
+    P[j] = hist[j];
+    P[j] /= count;
+    logP[j] = log10(P[j] + 1e-30);
+  }
+  // the float sums of integers are exact below 2^24, so the tail bin can be
+  // taken from the integer prefix sum instead of adding it again.
+  const bool exact = !negative && count <= (1LL << 24);
+  const double log_zero = log10(0.0f + 1e-30);
+  float sum = 0;
+  long long sum_idx = 0;
+  long long prefix = 0;
+  long long m = 0;
+  for (long long i = BINS; i < N + 1; i += BINS) {
+    for (; sum_idx < i; sum_idx++) {
+      sum += hist[sum_idx];
+    }
+    for (long long j = i - BINS; j < i - 1; j++) {
+      prefix += hist[j];
+    }
+    float P_tail = 0;
+    if (exact) {
+      P_tail = count - prefix;
+    } else {
+      for (long long j = i - 1; j < N; j++) {
+        P_tail += hist[j];
+      }
+    }
+    P_tail /= count;
+    const double logP_tail = log10(P_tail + 1e-30);
+    prefix += hist[i - 1];
+
+    float kl_i = 0;
+    long long expand_size = i / BINS;
+    long long idx = 0;
+    for (long long j = 0; j < BINS; j++) {
+      float sum_bin = 0;
+      float positive_cnt = 0;
+      long long bin_idx = idx;
+      for (long long k = 0; k < expand_size; k++) {
+        sum_bin += hist[idx];
+        positive_cnt += (hist[idx] > 0) ? 1 : 0;
+        idx++;
+      }
+      positive_cnt = (positive_cnt == 0) ? 1 : positive_cnt;
+      float Q_base = sum_bin / positive_cnt / sum;
+      const double logQ_base = log10(Q_base + 1e-30);
+      for (; bin_idx < idx; bin_idx++) {
+        const double logQ = hist[bin_idx] ? logQ_base : log_zero;
+        if (bin_idx == i - 1) {
+          kl_i += P_tail * (logP_tail - logQ);
+        } else {
+          kl_i += P[bin_idx] * (logP[bin_idx] - logQ);
+        }
+      }
+    }
+    kl[m++] = kl_i;
+  }
+  return the_min_index(kl, m);
+}
+
+void* kl_batch_thread(void* args_input) {
+  struct batch_thread_inputs *args = (struct batch_thread_inputs *)args_input;
+  const long long N = args->N;
+  const long long BINS = 128;
+  // scratch buffers are reused by all the histograms of this thread
+  long long *hist = new long long[N];
+  float *P = new float[N];
+  double *logP = new double[N];
+  float *kl = new float[N / BINS];
+  while (true) {
+    long long n = args->next->fetch_add(1);
+    if (n >= args->num) {
+      break;
+    }
+    long long m_min = kl_min_index(args->data + n * N, N, BINS, hist, P, logP, kl);
+    args->threshold[n] = args->width[n] * (m_min + 1) * BINS;
+  }
+  delete[] hist;
+  delete[] P;
+  delete[] logP;
+  delete[] kl;
+  return NULL;
+}
+
+// thresholds of num histograms of N bins stored row by row in data,
+// num_threads <= 0 uses all the online cores.
+void kl_diversity_hist_batch(const int *data, const float *width, long long num,
+                             long long N, int num_threads, float *threshold) {
+  if (num <= 0) {
+    return;
+  }
+  if (num_threads <= 0) {
+    num_threads = sysconf(_SC_NPROCESSORS_ONLN);
+  }
+  if (num_threads > num) {
+    num_threads = num;
+  }
+  if (num_threads < 1) {
+    num_threads = 1;
+  }
+  std::atomic<long long> next(0);
+  struct batch_thread_inputs args = {data, width, threshold, num, N, &next};
+  pthread_t *id = new pthread_t[num_threads];
+  for (int t = 0; t < num_threads; t++) {
+    if (pthread_create(&id[t], NULL, kl_batch_thread, (void *)&args)) {
+      printf("Create No. %d thread error!\n", t);
+      exit(1);
+    }
+  }
+  for (int t = 0; t < num_threads; t++) {
+    pthread_join(id[t], NULL);
+  }
+  delete[] id;
+}
 #endif
 
 float kl_diversity(float *data, long long count, long long num_bins) {
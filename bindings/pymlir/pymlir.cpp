@@ -26,11 +26,14 @@
 #include "mlir/Transforms/Passes.h"
 #include "tpu_mlir/Dialect/Top/IR/TopOps.h"
 #include "tpu_mlir/Dialect/Tpu/IR/TpuOps.h"
+#include "tpu_mlir/InitAll.h"
+#include "tpu_mlir/Support/Module.h"
 #include "tpu_mlir/Support/ModuleInterpreter.h"
 #include "llvm/ADT/STLExtras.h"
 #include "llvm/IR/IRBuilder.h"
 #include "llvm/IR/LLVMContext.h"
 #include "llvm/Support/CommandLine.h"
+#include "llvm/Support/FileSystem.h"
 #include "llvm/Support/SourceMgr.h"
 #include "llvm/Support/ToolOutputFile.h"
 
@@ -57,6 +60,51 @@ static py::array getPyArray(std::shared_ptr<std::vector<float>> ptr,
                             delete_shared_ptr_ptr);
 }
 
+// Top modules parsed once per process. lowering() clones them in memory, so
+// repeated lowering of the same top mlir needs no file reading or tpuc-opt.
+struct top_module_cache {
+  struct entry {
+    OwningOpRef<ModuleOp> module;
+    llvm::sys::TimePoint<> mtime;
+  };
+  std::shared_ptr<MLIRContext> context;
+  std::map<std::string, entry> modules;
+
+  static top_module_cache &instance() {
+    static top_module_cache cache;
+    return cache;
+  }
+
+  std::shared_ptr<MLIRContext> get_context() {
+    if (!context) {
+      DialectRegistry registry;
+      tpu_mlir::registerAllDialects(registry);
+      context = std::make_shared<MLIRContext>(registry);
+    }
+    return context;
+  }
+
+  ModuleOp get(const std::string &filename) {
+    llvm::sys::fs::file_status status;
+    if (llvm::sys::fs::status(filename, status)) {
+      throw std::runtime_error("can't stat " + filename);
+    }
+    auto mtime = status.getLastModificationTime();
+    auto iter = modules.find(filename);
+    if (iter != modules.end() && iter->second.mtime == mtime) {
+      return iter->second.module.get();
+    }
+    auto module = parseSourceFile<ModuleOp>(filename, get_context().get());
+    if (!module) {
+      throw std::runtime_error("parse " + filename + " failed");
+    }
+    auto &e = modules[filename];
+    e.module = std::move(module);
+    e.mtime = mtime;
+    return e.module.get();
+  }
+};
+
 struct quant_brief_info {
   std::string dtype;
   std::string shape;
@@ -77,6 +125,11 @@ public:
   }
 
   void load(std::string filename) {
+    interpreter_.reset();
+    auto module = module_.release();
+    if (module) {
+      module.erase();
+    }
     if (context_) {
       context_.reset();
     }
@@ -84,16 +137,58 @@ public:
     DialectRegistry registry;
     registry.insert<func::FuncDialect, top::TopDialect, tpu::TpuDialect,
                     quant::QuantizationDialect>();
-    context_ = std::make_unique<MLIRContext>(registry);
+    context_ = std::make_shared<MLIRContext>(registry);
 
     module_ = parseSourceFile<ModuleOp>(filename, context_.get());
     assert(module_);
-    if (interpreter_) {
-      interpreter_.reset();
+    init_interpreter();
+  }
+
+  // Run a pass pipeline (same passes as tpuc-opt, textual pipeline syntax) on
+  // an in-memory copy of the top mlir and load the result for inference.
+  void lowering(std::string top_mlir, std::string pipeline) {
+    interpreter_.reset();
+    auto old_module = module_.release();
+    if (old_module) {
+      old_module.erase();
+    }
+    auto &cache = top_module_cache::instance();
+    auto top_module = cache.get(top_mlir);
+    context_ = cache.get_context();
+    module_ = OwningOpRef<ModuleOp>(top_module.clone());
+
+    // options of former lowering in this process must not leak into this one
+    tpu_mlir::module::setWeightFileName("");
+    PassManager pm(context_.get());
+    std::string err;
+    llvm::raw_string_ostream os(err);
+    if (failed(parsePassPipeline(pipeline, pm, os))) {
+      throw std::runtime_error("invalid pass pipeline: " + pipeline + "\n" +
+                               os.str());
+    }
+    if (failed(pm.run(module_.get()))) {
+      throw std::runtime_error("lowering " + top_mlir + " failed");
     }
+    init_interpreter();
+  }
+
+  // the module in textual form, with locations, as tpuc-opt writes it
+  py::str get_module_str() {
+    std::string str;
+    llvm::raw_string_ostream os(str);
+    OpPrintingFlags flags;
+    flags.enableDebugInfo();
+    module_->print(os, flags);
+    return os.str();
+  }
 
+  void init_interpreter() {
     interpreter_ = std::make_unique<ModuleInterpreter>(module_.get());
     interpreter_->allocate_resources();
+    input_names = py::list();
+    output_names = py::list();
+    all_tensor_names = py::list();
+    all_weight_names = py::list();
     for (auto &name : interpreter_->input_names) {
       input_names.append(name);
     }
@@ -207,7 +302,7 @@ public:
   static std::string version;
 
 private:
-  std::unique_ptr<mlir::MLIRContext> context_;
+  std::shared_ptr<mlir::MLIRContext> context_;
   OwningOpRef<ModuleOp> module_;
   std::string weightFilePath_;
   std::unique_ptr<ModuleInterpreter> interpreter_;
@@ -234,6 +329,7 @@ std::string py_module::version = MLIR_VERSION;
 // wrap as Python module
 PYBIND11_MODULE(pymlir, m) {
   m.doc() = "pybind11 for mlir";
+  tpu_mlir::registerAllPasses();
   m.def("debug", &debug, py::arg("enable") = true,
         "enable debugging information");
   m.def("debug", &debug_only, "configure debugging information");
@@ -248,6 +344,8 @@ PYBIND11_MODULE(pymlir, m) {
   py::class_<py_module>(m, "module", "MLIR Module")
       .def(py::init<>())
       .def("load", &py_module::load, "load module from IR")
+      .def("lowering", &py_module::lowering, "lower top mlir in memory by pass pipeline and load it")
+      .def("get_module_str", &py_module::get_module_str, "get module IR with locations")
       .def("set_tensor", &py_module::set_tensor)
       .def("set_tensor_from_int", &py_module::set_tensor_from_int)
       .def("get_tensor", &py_module::get_tensor, "get one tensor data")
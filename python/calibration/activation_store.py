@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import os
+import bisect
+import shutil
+import tempfile
+import numpy as np
+
+
+def ref_uses(parser):
+    # positions of the ops reading each tensor in the op order, an op reads its own output
+    # (histograms, distances) and the ones of its inputs
+    order = parser.get_op_name_list()
+    uses = {}
+    for pos, op in enumerate(order):
+        uses.setdefault(op, []).append(pos)
+        for input in parser.get_pre_op_by_op_name(op):
+            uses.setdefault(input, []).append(pos)
+    return {k: sorted(set(v)) for k, v in uses.items()}
+
+
+def dq_uses(parser):
+    # a quantized tensor is also read when the quantized outputs of its users are made,
+    # at the first user of each of them
+    uses = ref_uses(parser)
+    order = {op: pos for pos, op in enumerate(parser.get_op_name_list())}
+    users = {}
+    for op in order:
+        for input in parser.get_pre_op_by_op_name(op):
+            users.setdefault(input, []).append(op)
+    dq = {}
+    for name, positions in uses.items():
+        dq[name] = set(positions)
+        for user in users.get(name, []):
+            later = [p for p in uses.get(user, []) if p > order[user]]
+            if later:
+                dq[name].add(later[0])
+    return {k: sorted(v) for k, v in dq.items()}
+
+
+class ActivationStore:
+    # Tensors of the calibration samples keyed by (tag, sample, name). The op positions
+    # reading the tensors of a tag are given once, and release(pos) frees the tensors not read
+    # after the op at pos. Over budget bytes, the tensors whose next read is the farthest are
+    # spilled to memory-mapped files.
+
+    def __init__(self, budget=0, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.uses = {}
+        self.tensors = {}
+        self.spilled = set()
+        self.expire = {}
+        self.nbytes = 0
+        self.pos = 0
+        self.spill_num = 0
+        self.spill_bytes = 0
+        self.peak_bytes = 0
+        self.tmp_dir = None
+
+    def add_tag(self, tag, uses):
+        self.uses[tag] = uses
+
+    def last_use(self, tag, name):
+        # tensors read by no op are freed at the next release
+        uses = self.uses[tag].get(name)
+        return uses[-1] if uses else self.pos
+
+    def next_use(self, key):
+        uses = self.uses[key[0]].get(key[2], [])
+        i = bisect.bisect_left(uses, self.pos)
+        return uses[i] if i < len(uses) else self.pos
+
+    def has(self, tag, i, name):
+        return (tag, i, name) in self.tensors
+
+    def get(self, tag, i, name):
+        return self.tensors.get((tag, i, name))
+
+    def names(self, tag, i):
+        return [k[2] for k in self.tensors if k[0] == tag and k[1] == i]
+
+    def samples(self, tag):
+        return sorted(set(k[1] for k in self.tensors if k[0] == tag))
+
+    def put(self, tag, i, name, value, copy=True):
+        # a tensor of the module must be copied, its buffer is reused by the next invoke
+        key = (tag, i, name)
+        self.pop(key)
+        value = np.asarray(value)
+        if self.budget > 0 and self.nbytes + value.nbytes > self.budget:
+            self._make_room(value.nbytes, self.next_use(key))
+        if self.budget > 0 and self.nbytes + value.nbytes > self.budget:
+            self.tensors[key] = self._spill(value)
+            self.spilled.add(key)
+        else:
+            self.tensors[key] = value.copy() if copy else value
+            self.nbytes += value.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        self.expire.setdefault(self.last_use(tag, name), []).append(key)
+
+    def pop(self, key):
+        value = self.tensors.pop(key, None)
+        if value is None:
+            return
+        if key in self.spilled:
+            self.spilled.remove(key)
+            filename = value.filename
+            del value
+            os.remove(filename)
+        else:
+            self.nbytes -= value.nbytes
+
+    def release(self, pos):
+        # the ops up to pos are done
+        for p in sorted(p for p in self.expire if p <= pos):
+            for key in self.expire.pop(p):
+                self.pop(key)
+        self.pos = pos + 1
+
+    def _make_room(self, nbytes, next_use):
+        # spill the tensors read later than the new one, the farthest first
+        keys = [k for k in self.tensors if k not in self.spilled and self.tensors[k].nbytes > 0]
+        keys.sort(key=self.next_use, reverse=True)
+        for key in keys:
+            if self.nbytes + nbytes <= self.budget or self.next_use(key) <= next_use:
+                break
+            value = self.tensors[key]
+            self.tensors[key] = self._spill(value)
+            self.spilled.add(key)
+            self.nbytes -= value.nbytes
+
+    def _spill(self, value):
+        if self.tmp_dir is None:
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self.tmp_dir = tempfile.mkdtemp(prefix='act_spill_', dir=self.spill_dir)
+        filename = os.path.join(self.tmp_dir, '{}.npy'.format(self.spill_num))
+        np.save(filename, value)
+        self.spill_num += 1
+        self.spill_bytes += value.nbytes
+        # copy on write, the tensors are sometimes cleaned in place (nan to 0)
+        return np.load(filename, mmap_mode='c')
+
+    def clear(self):
+        for key in list(self.tensors):
+            self.pop(key)
+        self.expire = {}
+        self.pos = 0
+
+    def close(self):
+        self.clear()
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def summary(self):
+        return 'activation store: peak {:.1f} MB in memory, {} tensors {:.1f} MB spilled'.format(
+            self.peak_bytes / 2**20, self.spill_num, self.spill_bytes / 2**20)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from utils.file_hash import hash_file
+
+
+class Checkpoint:
+    # State of a long run, saved at most every interval seconds so that an interrupted run
+    # can be resumed: a json meta and named arrays. The file is replaced atomically, a kill
+    # during a save leaves the previous checkpoint. fingerprint gives the hash of what the
+    # state depends on, computed at the first save or load; a checkpoint of another one is
+    # not resumed. A checkpoint not enabled saves and loads nothing.
+
+    def __init__(self, path, interval=60.0, fingerprint=lambda: '', enabled=True):
+        self.path = path if path.endswith('.npz') else path + '.npz'
+        self.interval = interval
+        self.enabled = enabled
+        self.last = time.time()
+        self.get_fingerprint = fingerprint
+        self.fingerprint = None
+
+    def _fingerprint(self):
+        if self.fingerprint is None:
+            self.fingerprint = self.get_fingerprint()
+        return self.fingerprint
+
+    def due(self):
+        return self.enabled and time.time() - self.last >= self.interval
+
+    def save(self, meta, arrays={}):
+        if not self.enabled:
+            return
+        meta = dict(meta, fingerprint=self._fingerprint())
+        tmp = self.path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp, __meta__=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp, self.path)
+        self.last = time.time()
+
+    def load(self):
+        if not self.enabled or not os.path.exists(self.path):
+            return None, {}
+        with np.load(self.path) as f:
+            meta = json.loads(str(f['__meta__']))
+            if meta.pop('fingerprint', None) != self._fingerprint():
+                print('{} is of another model, sample list or options, start over'.format(
+                    self.path))
+                return None, {}
+            arrays = {k: f[k] for k in f.files if k != '__meta__'}
+        return meta, arrays
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_fingerprint(files, data_list, options):
+    # the files, the samples by path, size and time, and the options
+    h = hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode())
+    for file in files:
+        h.update(file.encode())
+        if os.path.isfile(file):
+            hash_file(file, h)
+    for sample in data_list:
+        for file in sample.split(','):
+            st = os.stat(file.strip())
+            h.update('{}:{}:{}'.format(file.strip(), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def pack_values(kind, values):
+    # numpy scalars are saved as 0-d arrays to keep their type
+    return {'{}:{}'.format(kind, k): np.asarray(v) for k, v in values.items()}
+
+
+def unpack_values(kind, arrays):
+    prefix = kind + ':'
+    return {k[len(prefix):]: v[()] for k, v in arrays.items() if k.startswith(prefix)}
@@ -8,6 +8,7 @@
 #
 # ==============================================================================
 
+import copy
 import random
 import pathlib
 
@@ -48,6 +49,14 @@ class DataSelector:
         self.all_npz, self.all_npy, self.all_image = False, False, False
         self._check_data_list()
 
+    def shard(self, index: int, num: int, unit: int = 1):
+        # the index-th of num contiguous parts of the data list, cut at multiples of unit
+        # so that the batches stay the same
+        units = (len(self.data_list) + unit - 1) // unit
+        ds = copy.copy(self)
+        ds.data_list = self.data_list[index * units // num * unit:(index + 1) * units // num * unit]
+        return ds
+
     def _check_data_list(self):
         for file in self.data_list:
             if self.is_npz(file):
@@ -9,6 +9,7 @@
 # ==============================================================================
 
 import os
+import sys
 import gc
 import time
 import copy
@@ -17,7 +18,11 @@ import pymlir
 from ctypes import *
 from tqdm import tqdm
 import datetime
-from utils.preprocess import preprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from utils.preprocess import preprocess, batch_image_inputs
 from utils.mlir_parser import *
 from utils.log_setting import setup_logger
 from utils.misc import *
@@ -25,6 +30,29 @@ from utils.misc import *
 from math import *
 from scipy import spatial
 from calibration.data_selector import DataSelector
+from calibration.quantile_sketch import LogHistogram
+from calibration.partial_stats import PartialStats
+from calibration.checkpoint import Checkpoint, run_fingerprint, pack_values, unpack_values
+from calibration.activation_store import ActivationStore, ref_uses, dq_uses
+
+
+def calibration_fingerprint(args, parser, data_list):
+    # what a checkpoint depends on: the model and its weights, the samples and the options that
+    # change the thresholds
+    debug_cmd = parse_debug_cmd(args.debug_cmd)
+    for k in ['ckpt_interval', 'act_budget', 'act_spill_dir', 'tune_workers', 'debug_log']:
+        debug_cmd.pop(k, None)
+    options = {'debug_cmd': debug_cmd}
+    for k in ['input_num', 'tune_num', 'histogram_bin_num', 'shard']:
+        options[k] = getattr(args, k, None)
+    files = [args.mlir_file, parser.module_weight_file] + list(getattr(args, 'stats_in', []))
+    return run_fingerprint(files, data_list, options)
+
+
+def calibration_checkpoint(args, debug_cmd, path, fingerprint):
+    # off unless --checkpoint or --resume, the state is then saved every ckpt_interval seconds
+    enabled = getattr(args, 'checkpoint', False) or getattr(args, 'resume', False)
+    return Checkpoint(path, float(debug_cmd.get('ckpt_interval', 60)), fingerprint, enabled)
 
 
 class BaseKldCalibrator:
@@ -33,19 +61,29 @@ class BaseKldCalibrator:
         self.calib_lib = CDLL(math_lib_path)
         self.calib_lib.kl_diversity.restype = c_float
         self.calib_lib.kl_diversity_hist.restype = c_float
+        self.calib_lib.kl_diversity_hist_batch.restype = None
 
-    def histogram(self, ndarray, abs_max, bin_num):
-        t = np.abs(ndarray.flatten())
-        t = t[t != 0]
+    def histogram(self, ndarray, abs_max, bin_num, out=None):
+        # counts of floor(|x| / width + 0.5) in [0, bin_num), zeros are not counted.
+        # the counts are added to out if it is given.
         width = abs_max / (bin_num - 1)
-        if t.size > 0:
-            hist, _ = np.histogram(np.floor(t / width + 0.5),
-                                   bins=bin_num,
-                                   range=(0, bin_num - 1),
-                                   density=False)
-        else:
-            hist = np.zeros(bin_num)
-        hist = hist.astype(np.int32)
+        hist = np.zeros(bin_num, dtype=np.int32) if out is None else out
+        if not width > 0:
+            return hist, width
+        data = ndarray.ravel()
+        counts = np.zeros(bin_num + 1, dtype=np.int64)
+        # in chunks, the buffers stay in cache
+        chunk = 1 << 18
+        for i in range(0, data.size, chunk):
+            t = np.abs(data[i:i + chunk])
+            counts[0] -= t.size - np.count_nonzero(t)
+            t = t / width
+            t += 0.5
+            np.floor(t, out=t)
+            # nan, inf and the values beyond the range go to the extra last bin
+            t[~(t <= bin_num - 1)] = bin_num
+            counts += np.bincount(t.astype(np.intp), minlength=bin_num + 1)
+        hist += counts[:bin_num].astype(np.int32)
         return hist, width
 
     def kld_threshold(self, hist, width, bin_num):
@@ -53,6 +91,116 @@ class BaseKldCalibrator:
                                                      c_float(width), c_longlong(bin_num))
         return threshold
 
+    def kld_thresholds(self, histogram_data_map, histogram_width_map, bin_num, num_threads=0):
+        # all the histograms in one call, spread across the cores
+        names = list(histogram_data_map.keys())
+        if len(names) == 0:
+            return {}
+        hists = np.empty((len(names), bin_num), dtype=np.int32)
+        for i, name in enumerate(names):
+            hists[i] = histogram_data_map[name]
+        widths = np.array([histogram_width_map[n] for n in names], dtype=np.float32)
+        thresholds = np.zeros(len(names), dtype=np.float32)
+        self.calib_lib.kl_diversity_hist_batch(hists.ctypes.data_as(POINTER(c_int)),
+                                               widths.ctypes.data_as(POINTER(c_float)),
+                                               c_longlong(len(names)), c_longlong(bin_num),
+                                               c_int(num_threads),
+                                               thresholds.ctypes.data_as(POINTER(c_float)))
+        return dict(zip(names, thresholds.tolist()))
+
+    def shard_unit(self, ds):
+        # samples are batched from several files for images and npz
+        return self.batch_size if ds.all_image or ds.all_npz else 1
+
+    def local_shard(self, ds):
+        # the --shard k/n part of the samples
+        index, num = [int(x) for x in getattr(self.args, 'shard', '0/1').split('/')]
+        self.first_shard = index == 0
+        return ds.shard(index, num, self.shard_unit(ds)) if num > 1 else ds
+
+    def use_partial_stats(self):
+        return (getattr(self.args, 'workers', 1) > 1 or bool(getattr(self.args, 'stats_in', None))
+                or bool(getattr(self.args, 'stats_out', None))
+                or getattr(self.args, 'shard', '0/1') != '0/1')
+
+    def gather_stats(self, statistics=None):
+        # partial stats of the samples, split in contiguous parts across the worker processes
+        unit = self.shard_unit(self.ds)
+        workers = min(getattr(self.args, 'workers', 1), (len(self.ds.data_list) + unit - 1) // unit)
+        if workers <= 1:
+            return self.collect_stats(statistics, self.first_shard)
+        args = copy.copy(self.args)
+        args.shard, args.workers = '0/1', 1
+        with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [
+                pool.submit(_stats_worker_run, type(self), args, self.ds.shard(i, workers, unit),
+                            statistics, self.first_shard and i == 0,
+                            os.path.join(tmp_dir, '{}.npz'.format(i))) for i in range(workers)
+            ]
+            return PartialStats.load_all([f.result() for f in futures])
+
+    def thresholds_by_partial_stats(self):
+        # merge the --stats_in stats and run the stages they miss, then save the stats to
+        # --stats_out or calculate the thresholds from the histograms
+        stats_in = getattr(self.args, 'stats_in', None)
+        stats_out = getattr(self.args, 'stats_out', None)
+        stats = PartialStats.load_all(stats_in) if stats_in else self.gather_stats()
+        # a run with --stats_out adds one stage to its stats in
+        if stats.stage == 'minmax' and (stats_in or not stats_out):
+            stats = self.gather_stats(self.stats_statistics(stats))
+        if stats_out:
+            stats.save(stats_out)
+            print("{} stats of {} samples saved to {}".format(stats.stage, stats.num_samples,
+                                                              stats_out))
+            return None
+        self.num_samples = stats.num_samples
+        self.activations_statistics = stats.statistics
+        # the same widths as histogram()
+        histogram_width_map = {
+            k: stats.statistics[k][2] / (self.histogram_bin_num - 1)
+            for k in stats.hist
+        }
+        return self.thresholds_by_hist(stats.hist, histogram_width_map)
+
+    def pack_statistics(self):
+        arrays = {}
+        for i, kind in enumerate(['min', 'max', 'abs']):
+            arrays.update(
+                pack_values(kind, {k: v[i]
+                                   for k, v in self.activations_statistics.items()}))
+        return arrays
+
+    def unpack_statistics(self, arrays):
+        columns = [unpack_values(kind, arrays) for kind in ['min', 'max', 'abs']]
+        self.activations_statistics = {k: tuple(c[k] for c in columns) for k in columns[0]}
+
+    def save_checkpoint(self, stage, cursor=0, maps={}):
+        # the statistics and maps of the samples before cursor, or of all of them at the
+        # collected stage that --resume tunes from
+        if not self.ckpt.enabled:
+            return
+        arrays = self.pack_statistics()
+        for kind, values in maps.items():
+            arrays.update(pack_values(kind, values))
+        self.ckpt.save({'stage': stage, 'cursor': cursor, 'num_samples': self.num_samples}, arrays)
+
+    def load_checkpoint(self):
+        meta, arrays = self.ckpt.load()
+        if meta is None:
+            return None, 0, {}
+        self.unpack_statistics(arrays)
+        self.num_samples = meta['num_samples']
+        print('resume from the {} stage, sample {} of {}'.format(meta['stage'], meta['cursor'],
+                                                                 self.ckpt.path))
+        return meta['stage'], meta['cursor'], arrays
+
+
+def _stats_worker_run(cls, args, ds, statistics, first, path):
+    calibrator = cls(args, ds)
+    calibrator.collect_stats(statistics, first).save(path)
+    return path
+
 
 class CalibrationTable:
 
@@ -121,6 +269,86 @@ def cosine_sim(x, y):
     return cosine_similarity
 
 
+def quant_distance(module, evaled_op, inputs, target_fp32_activations, threshold):
+    # run evaled_op with its inputs quantized by threshold, compare with the fp32 reference
+    for input, value in inputs:
+        value = import_quant_bias(value, threshold)
+        module.set_tensor(input, value)
+    target_activations = module.invoke_at(evaled_op)
+    cosine_similarity = cosine_sim(target_activations, target_fp32_activations)
+    diff = target_fp32_activations.flatten() - target_activations.flatten()
+    norm_2 = np.linalg.norm(diff)
+    norm_1 = np.linalg.norm(target_fp32_activations.flatten(), ord=1)
+    return norm_2 / norm_1, cosine_similarity
+
+
+# module_dq of the tune worker process
+_tune_module = None
+
+
+def _tune_worker_init(mlir_file):
+    global _tune_module
+    _tune_module = pymlir.module()
+    _tune_module.load(mlir_file)
+    _tune_module.fake_quant_weight()
+
+
+def _tune_worker_run(shm_name, layout, evaled_op, thresholds):
+
+    def calc_distance(buf):
+        samples = []
+        for inputs, (shape, dtype, offset) in layout:
+            inputs = [(name, np.ndarray(s, t, buf, o)) for name, s, t, o in inputs]
+            samples.append((inputs, np.ndarray(shape, dtype, buf, offset)))
+        results = []
+        for threshold in thresholds:
+            distance = 0
+            total_cosine_similarity = 0
+            for inputs, target in samples:
+                d, c = quant_distance(_tune_module, evaled_op, inputs, target, threshold)
+                distance += d
+                total_cosine_similarity += c
+            results.append((distance / len(samples), total_cosine_similarity / len(samples)))
+        return results
+
+    # the views of the shared memory must be released before closing it
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return calc_distance(shm.buf)
+    finally:
+        shm.close()
+
+
+class SharedTensors:
+    # tensors of the tune samples, copied into one shared memory block
+
+    def __init__(self, samples):
+        offset = 0
+        self.layout = []
+        arrays = []
+        for inputs, target in samples:
+            entries = []
+            for name, value in inputs + [(None, target)]:
+                value = np.ascontiguousarray(value)
+                entries.append((name, value.shape, value.dtype.str, offset))
+                arrays.append((offset, value))
+                offset += (value.nbytes + 63) // 64 * 64
+            self.layout.append((entries[:-1], entries[-1][1:]))
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        try:
+            for offset, value in arrays:
+                dst = np.ndarray(value.shape, value.dtype, self.shm.buf, offset)
+                dst[...] = value
+                del dst
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
 class SimpleTuner:
 
     def __init__(self, args, ds: DataSelector, ppa_list, abs_max_dict):
@@ -160,6 +388,25 @@ class SimpleTuner:
         self.module_dq = pymlir.module()
         self.module_dq.load(args.mlir_file)
         self.module_dq.fake_quant_weight()
+        # search the thresholds on worker processes, each one loads its own module_dq
+        self.tune_workers = int(self.debug_cmd.get('tune_workers', 0))
+        self.tune_pool = None
+        # grid, golden, ternary or coarse
+        self.tune_search = self.debug_cmd.get('tune_search', 'grid')
+        assert self.tune_search in ('grid', 'golden', 'ternary', 'coarse')
+        self.tune_tol = float(self.debug_cmd.get('tune_tol', 0))
+        self.saved_invokes = 0
+        # the tuning state is saved every ckpt_interval seconds, --resume goes on from it
+        self.resume = getattr(args, 'resume', False)
+        self.ckpt = calibration_checkpoint(
+            args, self.debug_cmd, args.calibration_table + '.tune.ckpt',
+            lambda: calibration_fingerprint(args, self.parser, self.data_list))
+        # the tensors of the tune samples are freed after their last use, over act_budget MB
+        # they are spilled to files in act_spill_dir
+        self.store = ActivationStore(
+            float(self.debug_cmd.get('act_budget', 0)) * 2**20, self.debug_cmd.get('act_spill_dir'))
+        self.store.add_tag('ref', ref_uses(self.parser))
+        self.store.add_tag('dq', dq_uses(self.parser))
         self.load_net_input()
         self.dot = None
         #self.dot = gz.Digraph()
@@ -175,24 +422,23 @@ class SimpleTuner:
         self.logger.info(tmpStr)
 
     def load_net_input(self):
-        self.dq_activations = {}
-        self.ref_activations = {}
-        inp_ref_dict = {}
-        for input in self.module.input_names:
-            inp_ref_dict[input] = self.parser.get_use_count_by_op_name(input)
+        dq_activations = {}
+        ref_activations = {}
 
+        batched_inputs = {}
         if self.ds.all_image:
-            batched_inputs = self.input_num * ['']
-        else:
-            batched_inputs = {}
+            image_loaders = [
+                ppa.prefetch(batches) for ppa, batches in zip(
+                    self.ppa_list, batch_image_inputs(self.data_list, self.input_num, self.batch_size))
+            ]
 
         idx, tune_idx = 0, 0
-        self.dq_activations[tune_idx] = {}
-        self.ref_activations[tune_idx] = {}
+        dq_activations[tune_idx] = {}
+        ref_activations[tune_idx] = {}
         only_one = len(self.module.input_names) == 1
         print(f'prepare data from {len(self.data_list)}')
         for data in self.data_list:
-            if len(self.ref_activations) > self.args.tune_num + 1:
+            if len(ref_activations) > self.args.tune_num + 1:
                 break
             if self.ds.all_npz:
                 x = np.load(data)
@@ -201,19 +447,15 @@ class SimpleTuner:
                     n0 = self.module.input_names[0]
                     n1 = x.files[0]
                     if x[n1].shape[0] > 1:
-                        self.dq_activations[tune_idx][n0] = [x[n1], inp_ref_dict[n0]]
-                        self.ref_activations[tune_idx][n0] = [x[n1], inp_ref_dict[n0]]
+                        dq_activations[tune_idx][n0] = x[n1]
+                        ref_activations[tune_idx][n0] = x[n1]
                     else:
                         batched_inputs[n1] = (np.concatenate(
                             [batched_inputs[n1], x[n1].astype(np.float32)], axis=0)
                                             if n1 in batched_inputs else x[n1].astype(np.float32))
                         if batched_inputs[n1].shape[0] >= self.batch_size:
-                            self.dq_activations[tune_idx][n0] = [
-                                batched_inputs[n1][:self.batch_size], inp_ref_dict[n0]
-                            ]
-                            self.ref_activations[tune_idx][n0] = [
-                                batched_inputs[n1][:self.batch_size], inp_ref_dict[n0]
-                            ]
+                            dq_activations[tune_idx][n0] = batched_inputs[n1][:self.batch_size]
+                            ref_activations[tune_idx][n0] = batched_inputs[n1][:self.batch_size]
                             batched_inputs.pop(n1)
                         else:
                             continue
@@ -221,8 +463,8 @@ class SimpleTuner:
                     for input in self.module.input_names:
                         assert (input in x)
                         if x[input].shape[0] > 1:
-                            self.dq_activations[tune_idx][input] = [x[input], inp_ref_dict[input]]
-                            self.ref_activations[tune_idx][input] = [x[input], inp_ref_dict[input]]
+                            dq_activations[tune_idx][input] = x[input]
+                            ref_activations[tune_idx][input] = x[input]
                             batch_size = self.batch_size
                         else:
                             batched_inputs[input] = (np.concatenate(
@@ -230,101 +472,62 @@ class SimpleTuner:
                                                     in batched_inputs else x[input].astype(np.float32))
                             batch_size = batched_inputs[input].shape[0]
                             if batched_inputs[input].shape[0] >= self.batch_size:
-                                self.dq_activations[tune_idx][input] = [
-                                    batched_inputs[input][:self.batch_size], inp_ref_dict[input]
-                                ]
-                                self.ref_activations[tune_idx][input] = [
-                                    batched_inputs[input][:self.batch_size], inp_ref_dict[input]
-                                ]
+                                dq_activations[tune_idx][input] = batched_inputs[
+                                    input][:self.batch_size]
+                                ref_activations[tune_idx][input] = batched_inputs[
+                                    input][:self.batch_size]
                                 batched_inputs.pop(input)
 
                     if batch_size < self.batch_size:
                         continue
             elif self.ds.all_image:
                 idx += 1
-                inputs = data.split(',')
-                inputs = [s.strip() for s in inputs]
-                assert (self.input_num == len(inputs))
-                for i in range(self.input_num):
-                    batched_inputs[i] += '{},'.format(inputs[i])
-                    if idx == self.batch_size:
-                        x = self.ppa_list[i].run(batched_inputs[i][:-1])
-                        name = self.ppa_list[i].input_name
-                        self.dq_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                        self.ref_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                if idx == self.batch_size:
-                    idx = 0
-                    batched_inputs = self.input_num * ['']
-                else:
+                if idx < self.batch_size:
                     continue
+                idx = 0
+                for i in range(self.input_num):
+                    x = next(image_loaders[i])
+                    name = self.ppa_list[i].input_name
+                    dq_activations[tune_idx][name] = x
+                    ref_activations[tune_idx][name] = x
             else:
-                self.dq_activations[tune_idx] = {}
-                self.ref_activations[tune_idx] = {}
+                dq_activations[tune_idx] = {}
+                ref_activations[tune_idx] = {}
                 inputs = data.split(',')
                 inputs = [s.strip() for s in inputs]
                 assert (self.input_num == len(inputs))
                 for name, input in zip(self.module.input_names, inputs):
                     x = np.load(input)
-                    self.dq_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                    self.ref_activations[tune_idx][name] = [x, inp_ref_dict[name]]
+                    dq_activations[tune_idx][name] = x
+                    ref_activations[tune_idx][name] = x
             tune_idx += 1
-            self.dq_activations[tune_idx] = {}
-            self.ref_activations[tune_idx] = {}
+            dq_activations[tune_idx] = {}
+            ref_activations[tune_idx] = {}
 
-        if len(self.ref_activations[tune_idx]) == 0:
+        if len(ref_activations[tune_idx]) == 0:
             # print(f'last tune data (tune_idx={tune_idx}) not valid, droped')
-            self.ref_activations.pop(tune_idx)
-        self.args.tune_num = min(self.args.tune_num, len(self.ref_activations))
-        # print(f"tune_num = {self.args.tune_num}, ref = {len(self.ref_activations)}")
+            ref_activations.pop(tune_idx)
+        self.args.tune_num = min(self.args.tune_num, len(ref_activations))
+        # print(f"tune_num = {self.args.tune_num}, ref = {len(ref_activations)}")
         # print(f"real tune_num = {self.args.tune_num}")
         assert self.args.tune_num > 0
+        for i in range(self.args.tune_num):
+            for name, x in ref_activations[i].items():
+                self.store.put('ref', i, name, x, copy=False)
+            if 'not_use_fp32_tensor_as_ref' in self.debug_cmd:
+                for name, x in dq_activations[i].items():
+                    self.store.put('dq', i, name, x, copy=False)
 
     def get_input_tensor(self, i, op_name):
-        if op_name in self.dq_activations[i]:
-            return self.dq_activations[i][op_name][0]
-        print('error, idx:{} op_name:{} not in dq_activations'.format(i, op_name))
-        return None
-
-    def clear_input_tensor(self, i, op_name, node_label):
-        if i == 0:
-            node_label[0] += '\nclear_input_tensor {}\'s input'.format(op_name)
-        input_ops = self.parser.get_pre_op_by_op_name(op_name)
-        for input_op in input_ops:
-            if input_op in self.dq_activations[i]:
-                if self.dq_activations[i][input_op][1] == 1:
-                    self.dq_activations[i].pop(input_op)
-                    if i == 0:
-                        node_label[0] += '\npop its input:{}'.format(input_op)
-                else:
-                    self.dq_activations[i][input_op][1] -= 1
-                    tmp = self.dq_activations[i][input_op][1]
-                    if i == 0:
-                        node_label[0] += '\ndec {}\'s refcount:{} > {}'.format(
-                            input_op, tmp + 1, tmp)
-
-    def clear_ref_tensor(self, i, evaled_op, node_label):
-        if i == 0:
-            node_label[0] += '\nclear_ref_tensor {}\'s input'.format(evaled_op)
-        if self.ref_activations[i][evaled_op][1] == 0:  #清除残留的网络输出
-            self.ref_activations[i].pop(evaled_op)
-        input_ops = self.parser.get_pre_op_by_op_name(evaled_op)
-        for input_op in input_ops:
-            if input_op in self.ref_activations[i]:
-                if self.ref_activations[i][input_op][1] == 1:
-                    self.ref_activations[i].pop(input_op)
-                    if i == 0:
-                        node_label[0] += '\npop its input:{}'.format(input_op)
-                else:
-                    self.ref_activations[i][input_op][1] -= 1
-                    tmp = self.ref_activations[i][input_op][1]
-                    if i == 0:
-                        node_label[0] += '\ndec {}\'s refcount:{} > {}'.format(
-                            input_op, tmp + 1, tmp)
+        value = self.store.get('dq', i, op_name)
+        if value is None:
+            print('error, idx:{} op_name:{} not in dq_activations'.format(i, op_name))
+        return value
 
     def gen_input_tensor(self, i, input_tensor_of_evaled_op, node_label):
         if i == 0:
             tmp = 'gen_input_tensor:{}'.format(input_tensor_of_evaled_op)
-        if input_tensor_of_evaled_op in self.dq_activations[i]:
+        if self.store.has('dq', i, input_tensor_of_evaled_op):
             if i == 0:
                 tmp += '\nit exsit'
                 node_label[0] += '\n{}'.format(tmp)
@@ -350,79 +553,183 @@ class SimpleTuner:
                 self.layer_cos_sim[input_tensor_of_evaled_op] += cos_sim
             else:
                 self.layer_cos_sim[input_tensor_of_evaled_op] = cos_sim
-            count = self.parser.get_use_count_by_op_name(input_tensor_of_evaled_op)
-            self.dq_activations[i][input_tensor_of_evaled_op] = [value.copy(), count]
+            self.store.put('dq', i, input_tensor_of_evaled_op, value)
             if i == 0:
-                tmp += '\nrun it, refcount:{}, cos:{}\n'.format(count, cos_sim)
+                tmp += '\nrun it, cos:{}\n'.format(cos_sim)
         if i == 0:
             node_label[0] += '\n{}'.format(tmp)
         return True
 
     def get_ref_tensor(self, i, evaled_op):
-        if evaled_op in self.ref_activations[i]:
-            return self.ref_activations[i][evaled_op][0]
-        print('error, idx:{} evaled_op:{} not in ref_activations'.format(i, evaled_op))
-        return None
+        value = self.store.get('ref', i, evaled_op)
+        if value is None:
+            print('error, idx:{} evaled_op:{} not in ref_activations'.format(i, evaled_op))
+        return value
 
     def gen_ref_tensor(self, i, op_name, node_label):
         if i == 0:
             tmp = 'gen_ref_tensor:{}'.format(op_name)
-        if op_name in self.ref_activations[i]:
+        if self.store.has('ref', i, op_name):
             if i == 0:
                 tmp += '\nit exsit'
                 node_label[0] += '\n{}'.format(tmp)
             return
         input_ops = self.parser.get_pre_op_by_op_name(op_name)
         for input_op in input_ops:
-            data = self.ref_activations[i][input_op][0]
-            refcount = self.ref_activations[i][input_op][1]
+            data = self.store.get('ref', i, input_op)
             if i == 0:
-                tmp += '\nits input:{}, refcount:{}'.format(input_op, refcount)
+                tmp += '\nits input:{}'.format(input_op)
 
             self.module.set_tensor(input_op, data)
         if len(input_ops) > 0:
             value = self.module.invoke_at(op_name)
-            count = self.parser.get_use_count_by_op_name(op_name)
-            self.ref_activations[i][op_name] = [value.copy(), count]
+            self.store.put('ref', i, op_name, value)
             if i == 0:
-                tmp += '\ninvoke_at:{}, refcount:{}'.format(op_name, count)
-                #self.print_dbg('have {} users as refcount'.format(count))
+                tmp += '\ninvoke_at:{}'.format(op_name)
         if i == 0:
             node_label[0] += '\n{}'.format(tmp)
 
+    def get_tune_inputs(self, idx, evaled_op):
+        inputs = []
+        for input in self.parser.get_pre_op_by_op_name(evaled_op):
+            if 'not_use_fp32_tensor_as_ref' in self.debug_cmd:
+                value = self.get_input_tensor(idx, input)
+            else:
+                value = self.get_ref_tensor(idx, input)
+            if value is None:
+                print('error, calc_distance get tensor fail')
+                return None
+            inputs.append((input, value))
+        return inputs
+
     def calc_distance(self, evaled_op, threshold):
         distance = 0
         total_cosine_similarity = 0
+        for input in self.parser.get_pre_op_by_op_name(evaled_op):
+            self.print_dbg('{}\'s input:{} import_quant_bias, th:{}'.format(
+                evaled_op, input, threshold))
         for idx in range(self.args.tune_num):
-            for input in self.parser.get_pre_op_by_op_name(evaled_op):
-                if idx == 0:
-                    self.print_dbg('{}\'s input:{} import_quant_bias, th:{}'.format(
-                        evaled_op, input, threshold))
-                if 'not_use_fp32_tensor_as_ref' in self.debug_cmd:
-                    value = self.get_input_tensor(idx, input)
-                else:
-                    value = self.get_ref_tensor(idx, input)
-                if value is None:
-                    print('error, calc_distance get tensor fail')
-                    return None, None
-                value = import_quant_bias(value, threshold)
-                self.module_dq.set_tensor(input, value)
-            target_activations = self.module_dq.invoke_at(evaled_op)
-            target_fp32_activations = self.get_ref_tensor(idx, evaled_op)
-            total_cosine_similarity += cosine_sim(target_activations, target_fp32_activations)
-            diff = target_fp32_activations.flatten() - target_activations.flatten()
-            norm_2 = np.linalg.norm(diff)
-            norm_1 = np.linalg.norm(target_fp32_activations.flatten(), ord=1)
-            distance += norm_2 / norm_1
+            inputs = self.get_tune_inputs(idx, evaled_op)
+            if inputs is None:
+                return None, None
+            cur_distance, cur_cos_sim = quant_distance(self.module_dq, evaled_op, inputs,
+                                                       self.get_ref_tensor(idx, evaled_op),
+                                                       threshold)
+            distance += cur_distance
+            total_cosine_similarity += cur_cos_sim
         return distance / self.args.tune_num, total_cosine_similarity / self.args.tune_num
 
+    def calc_distances(self, evaled_op, thresholds):
+        if self.tune_workers <= 1 or len(thresholds) <= 1:
+            results = []
+            for th in thresholds:
+                results.append(self.calc_distance(evaled_op, th))
+                if results[-1][0] is None:
+                    break
+            return results
+        samples = []
+        for idx in range(self.args.tune_num):
+            inputs = self.get_tune_inputs(idx, evaled_op)
+            if inputs is None:
+                return [(None, None)]
+            samples.append((inputs, self.get_ref_tensor(idx, evaled_op)))
+        for input in self.parser.get_pre_op_by_op_name(evaled_op):
+            for th in thresholds:
+                self.print_dbg('{}\'s input:{} import_quant_bias, th:{}'.format(
+                    evaled_op, input, th))
+        if self.tune_pool is None:
+            self.tune_pool = ProcessPoolExecutor(self.tune_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_tune_worker_init,
+                                                 initargs=(self.args.mlir_file, ))
+        shared = SharedTensors(samples)
+        try:
+            chunk = (len(thresholds) + self.tune_workers - 1) // self.tune_workers
+            futures = [
+                self.tune_pool.submit(_tune_worker_run, shared.shm.name, shared.layout,
+                                      evaled_op, thresholds[i:i + chunk])
+                for i in range(0, len(thresholds), chunk)
+            ]
+            results = [r for f in futures for r in f.result()]
+        finally:
+            shared.close()
+        # cosine_sim clears the nan of the reference in place, as the serial search does
+        for _, target in samples:
+            target[np.isnan(target)] = 0.0
+        return results
+
+    def search_threshold(self, evaled_op, th_min, th_max, resolution):
+        # search the threshold of the least distance in [th_min, th_max] until the
+        # interval is narrower than resolution, or the distance improves less than tune_tol
+        evaluated = {}
+
+        def evaluate(thresholds):
+            thresholds = [th for th in dict.fromkeys(thresholds) if th not in evaluated]
+            results = self.calc_distances(evaled_op, thresholds)
+            if len(results) < len(thresholds) or any(r[0] is None for r in results):
+                return False
+            evaluated.update(zip(thresholds, results))
+            return True
+
+        def dist(th):
+            return evaluated[th][0]
+
+        def is_flat(d0, d1):
+            return abs(d0 - d1) < self.tune_tol * min(d0, d1)
+
+        a, b = th_min, th_max
+        if self.tune_search == 'golden':
+            ratio = (sqrt(5) - 1) / 2
+            c, d = b - ratio * (b - a), a + ratio * (b - a)
+            if not evaluate([th_min, c, d]):
+                return None
+            while b - a > resolution and not is_flat(dist(c), dist(d)):
+                if dist(c) < dist(d):
+                    b, d = d, c
+                    c = b - ratio * (b - a)
+                    if not evaluate([c]):
+                        return None
+                else:
+                    a, c = c, d
+                    d = a + ratio * (b - a)
+                    if not evaluate([d]):
+                        return None
+        elif self.tune_search == 'ternary':
+            if not evaluate([th_min]):
+                return None
+            while b - a > resolution:
+                c, d = a + (b - a) / 3, b - (b - a) / 3
+                if not evaluate([c, d]):
+                    return None
+                if is_flat(dist(c), dist(d)):
+                    break
+                if dist(c) < dist(d):
+                    b = d
+                else:
+                    a = c
+        else:
+            # coarse to fine, refine around the best point of each level
+            points = 5
+            best = None
+            while True:
+                step = (b - a) / (points - 1)
+                thresholds = [a + step * i for i in range(points)]
+                if not evaluate([th_min] + thresholds):
+                    return None
+                cur = min(thresholds, key=dist)
+                if step <= resolution or (best is not None and is_flat(dist(best), dist(cur))):
+                    break
+                best = cur if best is None or dist(cur) < dist(best) else best
+                a, b = max(best - step, th_min), min(best + step, th_max)
+        return evaluated
+
     def find_better_threshold(self, evaled_op, tuned_op, node_label):
         prev_distance = -1
         threshold = self.initial_threshold[tuned_op][0]
         # abs_max = max(map(abs, self.initial_threshold[tuned_op][1:]))
         abs_max = self.abs_max_dict[tuned_op]
         #op_no = self.module.all_tensor_names.index(tuned_op)
-        op_no = self.parser.get_op_name_list().index(tuned_op)
+        op_no = self.parser.get_op_idx_by_op_name(tuned_op)
         self.print_dbg('>>>tuned_op_idx:', op_no, ', tuned_op:', tuned_op, ', threshold:',
                        threshold, 'abs_max:', abs_max, ', evaled_op:', evaled_op)
         if threshold > abs_max:
@@ -447,9 +754,18 @@ class SimpleTuner:
         diff = abs(abs_max - th_min)
         step = (abs_max - th_min) / self.tune_steps
         ranges = range(self.tune_steps + 1)
+        # the grid search costs tune_steps + 1 distances, and a finer pass with find_lower_th
+        grid_num = self.tune_steps + 1
+        resolution = step
+        if 'find_lower_th' in self.debug_cmd:
+            grid_num += self.tune_steps // 2 - 1
+            resolution = 2 * step / (self.tune_steps // 2)
         if step > 0 and diff > min_tuned_diff:
             for n in range(2):
-                if n == 1 and 'find_lower_th' in self.debug_cmd:
+                if n == 1:
+                    # the adaptive search refines by itself
+                    if 'find_lower_th' not in self.debug_cmd or self.tune_search != 'grid':
+                        break
                     th_min = best_threshold - step
                     th_max = best_threshold + step
                     diff = abs(th_max - th_min)
@@ -457,9 +773,22 @@ class SimpleTuner:
                     step = (th_max - th_min) / times
                     ranges = range(times + 1)[1:-1]
                     #print(f'find_lower_th enable,tuned_op:{tuned_op},best_threshold:{best_threshold},step:{step},th_min:{th_min},th_max:{th_max}, times:{times}')
-                for i in ranges:
-                    cur_threshold = th_min + step * i
-                    cur_distance, cur_cos_sim = self.calc_distance(evaled_op, cur_threshold)
+                if self.tune_search == 'grid':
+                    thresholds = [th_min + step * i for i in ranges]
+                    distances = self.calc_distances(evaled_op, thresholds)
+                else:
+                    evaluated = self.search_threshold(evaled_op, th_min, abs_max, resolution)
+                    if evaluated is None:
+                        return False
+                    thresholds = sorted(evaluated)
+                    distances = [evaluated[th] for th in thresholds]
+                    ranges = range(len(thresholds))
+                    saved = (grid_num - len(thresholds)) * self.args.tune_num
+                    self.saved_invokes += saved
+                    self.print_dbg('{} search of {}: {} distances, {} invoke_at saved'.format(
+                        self.tune_search, tuned_op, len(thresholds), saved))
+                for i, cur_threshold, (cur_distance, cur_cos_sim) in zip(ranges, thresholds,
+                                                                        distances):
                     if cur_distance is None and cur_cos_sim is None:
                         return False
                     if prev_distance == -1:
@@ -482,9 +811,6 @@ class SimpleTuner:
                     #     "### tuning i:{}, tuned_op_idx:{}, tuned_op:{}, not a better threshold:"
                     #     "{:5f}".format(i, op_no, tuned_op,cur_threshold))
 
-        for idx in range(self.args.tune_num):
-            if 'not_use_fp32_tensor_as_ref' in self.debug_cmd:
-                self.clear_input_tensor(idx, tuned_op, node_label)
         if step > 0:
             if threshold != best_threshold:
                 node_label[
@@ -504,6 +830,47 @@ class SimpleTuner:
             self.threshold_table.thresholds_map[tuned_op][0] = best_threshold
         return True
 
+    def save_checkpoint(self, op_idx):
+        # the ops before op_idx are tuned; the tensors they left are not saved, a resume
+        # computes them again
+        meta = {
+            'op_idx': op_idx,
+            'tuned_op_list': self.tuned_op_list,
+            'layer_cos_sim': {k: float(v) for k, v in self.layer_cos_sim.items()},
+            'saved_invokes': self.saved_invokes
+        }
+        arrays = pack_values('th', {k: v[0] for k, v in self.threshold_table.thresholds_map.items()})
+        self.ckpt.save(meta, arrays)
+
+    def load_checkpoint(self, all_tensors):
+        meta, arrays = self.ckpt.load()
+        if meta is None:
+            return 0
+        for k, v in unpack_values('th', arrays).items():
+            self.threshold_table.thresholds_map[k][0] = v
+        self.replay(all_tensors, meta['op_idx'])
+        self.tuned_op_list = meta['tuned_op_list']
+        self.layer_cos_sim = meta['layer_cos_sim']
+        self.saved_invokes = meta['saved_invokes']
+        print('resume tuning from op {}, {} ops tuned'.format(meta['op_idx'],
+                                                             len(self.tuned_op_list)))
+        return meta['op_idx']
+
+    def replay(self, all_tensors, start):
+        # the tensors the ops before start leave, computed in the order of tuning; the dq ones
+        # of not_use_fp32_tensor_as_ref with the thresholds of the checkpoint
+        for i, evaled_op in enumerate(all_tensors[:start]):
+            self.store.release(i - 1)
+            if self.parser.get_op_type_by_op_name(evaled_op) in [None, 'top.Input']:
+                continue
+            node_label = ['']
+            for idx in range(self.args.tune_num):
+                self.gen_ref_tensor(idx, evaled_op, node_label)
+            if 'not_use_fp32_tensor_as_ref' in self.debug_cmd:
+                for pre_op in self.parser.get_pre_op_by_op_name(evaled_op):
+                    for idx in range(self.args.tune_num):
+                        self.gen_input_tensor(idx, pre_op, node_label)
+
     def isAllInputTuned(self, evaled_op):
         pre_ops = self.parser.get_pre_op_by_op_name(evaled_op)
         for tuned_op in pre_ops:
@@ -511,15 +878,34 @@ class SimpleTuner:
                 return False
         return True
 
+    def close(self):
+        # the workers and the spilled tensors, freed when tuning fails too
+        self.store.close()
+        if self.tune_pool is not None:
+            self.tune_pool.shutdown(cancel_futures=True)
+            self.tune_pool = None
+
     def run(self):
+        try:
+            return self.tune()
+        finally:
+            self.close()
+
+    def tune(self):
         #pdb.set_trace()
         self.layer_cos_sim = {}
         all_tensors = self.parser.get_op_name_list()
         self.initial_threshold = copy.deepcopy(self.threshold_table.thresholds_map)
+        start = self.load_checkpoint(all_tensors) if self.resume else 0
         pbar = tqdm(all_tensors, total=len(all_tensors), position=0, leave=True)
         for i, evaled_op in enumerate(all_tensors):
             pbar.set_description("tune op: {}".format(evaled_op))
             pbar.update(1)
+            if i < start:
+                continue
+            self.store.release(i - 1)
+            if self.ckpt.due():
+                self.save_checkpoint(i)
             type = self.parser.get_op_type_by_op_name(evaled_op)
             if type is None:
                 continue
@@ -545,8 +931,6 @@ class SimpleTuner:
                 self.tuned_op_list.append(pre_ops[0])
                 if self.dot is not None:
                     self.dot.node(evaled_op, node_label[0], shape='box')
-                for idx in range(self.args.tune_num):
-                    self.clear_ref_tensor(idx, evaled_op, node_label)
                 continue
             faild = False
             for tuned_op in pre_ops:
@@ -560,19 +944,18 @@ class SimpleTuner:
             if faild:
                 break
 
-            for idx in range(self.args.tune_num):
-                self.clear_ref_tensor(idx, evaled_op, node_label)
-
             self.print_dbg('>>>>buffered_tensors info:')
-            self.print_dbg('dq_activations keys:', list(self.dq_activations[0].keys()))
-            for op_name in self.dq_activations[0]:
-                self.print_dbg('op:', op_name, ' refcount:', self.dq_activations[0][op_name][1])
-            self.print_dbg('ref_activations keys:', list(self.ref_activations[0].keys()))
-            for op_name in self.ref_activations[0]:
-                self.print_dbg('op:', op_name, ' refcount:', self.ref_activations[0][op_name][1])
+            self.print_dbg('dq_activations keys:', self.store.names('dq', 0))
+            self.print_dbg('ref_activations keys:', self.store.names('ref', 0))
             if self.dot is not None:
                 self.dot.node(evaled_op, node_label[0], shape='box')
         pbar.close()
+        self.ckpt.remove()
+        self.print_info(self.store.summary())
+        self.close()
+        if self.tune_search != 'grid':
+            self.print_info('{} search saved {} invoke_at'.format(self.tune_search,
+                                                                 self.saved_invokes))
         print('auto tune end, run time:{}'.format(time.time() - self.start_time))
 
         if 'print_debug_info' in self.debug_cmd:
@@ -633,8 +1016,8 @@ class ActivationCalibrator2(BaseKldCalibrator):
             tmp = preprocess()
             tmp.load_config(self.parser.get_input_op_by_idx(i))
             self.ppa_list.append(tmp)
-        self.ds = ds
-        self.data_list = ds.data_list
+        self.ds = self.local_shard(ds)
+        self.data_list = self.ds.data_list
         self.args.input_num = len(self.data_list)
         if ds.all_image:
             n = self.args.input_num % self.batch_size
@@ -650,26 +1033,33 @@ class ActivationCalibrator2(BaseKldCalibrator):
         self.num_samples = self.args.input_num
         if 'tune_steps' in self.debug_cmd:
             self.tune_steps = int(self.debug_cmd['tune_steps'])
-        self.load_net_input()
+        self.sketch_error = {}
+        self.resume = getattr(args, 'resume', False)
+        self.ckpt = calibration_checkpoint(
+            args, self.debug_cmd, (args.calibration_table or args.mlir_file) + '.ckpt',
+            lambda: calibration_fingerprint(args, self.parser, self.data_list))
+        # the tensors of the samples are freed after their last use, over act_budget MB they
+        # are spilled to files in act_spill_dir
+        self.store = ActivationStore(
+            float(self.debug_cmd.get('act_budget', 0)) * 2**20, self.debug_cmd.get('act_spill_dir'))
+        self.store.add_tag('ref', ref_uses(self.parser))
 
     def _clean_resource(self):
         del self.module
         self.module = None
 
     def load_net_input(self):
-        self.dq_activations = {}
-        self.ref_activations = {}
-        inp_ref_dict = {}
-        for input in self.module.input_names:
-            inp_ref_dict[input] = self.parser.get_use_count_by_op_name(input)
+        self.store.clear()
+        ref_activations = {}
 
+        batched_inputs = {}
         if self.ds.all_image:
-            batched_inputs = self.input_num * ['']
-        else:
-            batched_inputs = {}
+            image_loaders = [
+                ppa.prefetch(batches) for ppa, batches in zip(
+                    self.ppa_list, batch_image_inputs(self.data_list, self.input_num, self.batch_size))
+            ]
         idx, tune_idx = 0, 0
-        self.dq_activations[tune_idx] = {}
-        self.ref_activations[tune_idx] = {}
+        ref_activations[tune_idx] = {}
         only_one = len(self.module.input_names) == 1
         for data in self.data_list:
             if self.ds.all_npz:
@@ -679,19 +1069,13 @@ class ActivationCalibrator2(BaseKldCalibrator):
                     n0 = self.module.input_names[0]
                     n1 = x.files[0]
                     if x[n1].shape[0] > 1:
-                        self.dq_activations[tune_idx][n0] = [x[n1], inp_ref_dict[n0]]
-                        self.ref_activations[tune_idx][n0] = [x[n1], inp_ref_dict[n0]]
+                        ref_activations[tune_idx][n0] = x[n1]
                     else:
                         batched_inputs[n1] = (np.concatenate(
                             [batched_inputs[n1], x[n1].astype(np.float32)], axis=0)
                                             if n1 in batched_inputs else x[n1].astype(np.float32))
                         if batched_inputs[n1].shape[0] >= self.batch_size:
-                            self.dq_activations[tune_idx][n0] = [
-                                batched_inputs[n1][:self.batch_size], inp_ref_dict[n0]
-                            ]
-                            self.ref_activations[tune_idx][n0] = [
-                                batched_inputs[n1][:self.batch_size], inp_ref_dict[n0]
-                            ]
+                            ref_activations[tune_idx][n0] = batched_inputs[n1][:self.batch_size]
                             batched_inputs.pop(n1)
                         else:
                             continue
@@ -699,8 +1083,7 @@ class ActivationCalibrator2(BaseKldCalibrator):
                     for input in self.module.input_names:
                         assert (input in x)
                         if x[input].shape[0] > 1:
-                            self.dq_activations[tune_idx][input] = [x[input], inp_ref_dict[input]]
-                            self.ref_activations[tune_idx][input] = [x[input], inp_ref_dict[input]]
+                            ref_activations[tune_idx][input] = x[input]
                             batch_size = self.batch_size
                         else:
                             batched_inputs[input] = (np.concatenate(
@@ -708,12 +1091,8 @@ class ActivationCalibrator2(BaseKldCalibrator):
                                                     in batched_inputs else x[input].astype(np.float32))
                             batch_size = batched_inputs[input].shape[0]
                             if batched_inputs[input].shape[0] >= self.batch_size:
-                                self.dq_activations[tune_idx][input] = [
-                                    batched_inputs[input][:self.batch_size], inp_ref_dict[input]
-                                ]
-                                self.ref_activations[tune_idx][input] = [
-                                    batched_inputs[input][:self.batch_size], inp_ref_dict[input]
-                                ]
+                                ref_activations[tune_idx][input] = batched_inputs[
+                                    input][:self.batch_size]
                                 batched_inputs.pop(input)
 
                     if batch_size < self.batch_size:
@@ -721,72 +1100,51 @@ class ActivationCalibrator2(BaseKldCalibrator):
 
             elif self.ds.all_image:
                 idx += 1
-                inputs = data.split(',')
-                inputs = [s.strip() for s in inputs]
-                assert (self.input_num == len(inputs))
-                for i in range(self.input_num):
-                    batched_inputs[i] += '{},'.format(inputs[i])
-                    if idx == self.batch_size:
-                        x = self.ppa_list[i].run(batched_inputs[i][:-1])
-                        name = self.ppa_list[i].input_name
-                        self.dq_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                        self.ref_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                if idx == self.batch_size:
-                    idx = 0
-                    batched_inputs = self.input_num * ['']
-                else:
+                if idx < self.batch_size:
                     continue
+                idx = 0
+                for i in range(self.input_num):
+                    x = next(image_loaders[i])
+                    name = self.ppa_list[i].input_name
+                    ref_activations[tune_idx][name] = x
             else:
-                self.dq_activations[tune_idx] = {}
-                self.ref_activations[tune_idx] = {}
+                ref_activations[tune_idx] = {}
                 inputs = data.split(',')
                 inputs = [s.strip() for s in inputs]
                 assert (self.input_num == len(inputs))
                 for name, input in zip(self.module.input_names, inputs):
                     x = np.load(input)
-                    self.dq_activations[tune_idx][name] = [x, inp_ref_dict[name]]
-                    self.ref_activations[tune_idx][name] = [x, inp_ref_dict[name]]
+                    ref_activations[tune_idx][name] = x
             tune_idx += 1
-            self.dq_activations[tune_idx] = {}
-            self.ref_activations[tune_idx] = {}
+            ref_activations[tune_idx] = {}
 
-        if len(self.ref_activations[tune_idx]) == 0:
+        if len(ref_activations[tune_idx]) == 0:
             print(f'last input data (idx={tune_idx}) not valid, droped')
-            self.ref_activations.pop(tune_idx)
-        self.args.input_num = min(self.args.input_num, len(self.ref_activations))
-        print(f"input_num = {self.args.input_num}, ref = {len(self.ref_activations)}")
+            ref_activations.pop(tune_idx)
+        self.args.input_num = min(self.args.input_num, len(ref_activations))
+        print(f"input_num = {self.args.input_num}, ref = {len(ref_activations)}")
         print(f"real input_num = {self.args.input_num}")
         assert self.args.input_num > 0
-
-    def clear_ref_tensor(self, i, evaled_op):
-        if self.ref_activations[i][evaled_op][1] == 0:  #清除残留的网络输出
-            self.ref_activations[i].pop(evaled_op)
-        input_ops = self.parser.get_pre_op_by_op_name(evaled_op)
-        for input_op in input_ops:
-            if input_op in self.ref_activations[i]:
-                if self.ref_activations[i][input_op][1] == 1:
-                    self.ref_activations[i].pop(input_op)
-                else:
-                    self.ref_activations[i][input_op][1] -= 1
+        for i in range(self.args.input_num):
+            for name, x in ref_activations[i].items():
+                self.store.put('ref', i, name, x, copy=False)
 
     def get_ref_tensor(self, i, evaled_op):
-        # print(i, self.ref_activations[i])
-        if evaled_op in self.ref_activations[i]:
-            return self.ref_activations[i][evaled_op][0]
-        print('error, idx:{} evaled_op:{} not in ref_activations'.format(i, evaled_op))
-        return None
+        value = self.store.get('ref', i, evaled_op)
+        if value is None:
+            print('error, idx:{} evaled_op:{} not in ref_activations'.format(i, evaled_op))
+        return value
 
     def gen_ref_tensor(self, i, op_name):
-        if op_name in self.ref_activations[i]:
+        if self.store.has('ref', i, op_name):
             return
         input_ops = self.parser.get_pre_op_by_op_name(op_name)
         for input_op in input_ops:
-            data = self.ref_activations[i][input_op][0]
+            data = self.store.get('ref', i, input_op)
             self.module.set_tensor(input_op, data)
         if len(input_ops) > 0:
             value = self.module.invoke_at(op_name)
-            count = self.parser.get_use_count_by_op_name(op_name)
-            self.ref_activations[i][op_name] = [value.copy(), count]
+            self.store.put('ref', i, op_name, value)
             outputs = self.parser.get_outputs_by_op_name(op_name)
             if outputs is not None:
                 for output in outputs:
@@ -794,30 +1152,115 @@ class ActivationCalibrator2(BaseKldCalibrator):
                         continue
                     count = self.parser.get_use_count_by_op_name(output)
                     if count > 0:
-                        self.ref_activations[i][output] = [self.module.get_tensor(output), count]
+                        self.store.put('ref', i, output, self.module.get_tensor(output), copy=False)
 
     def find_threshold(self, histogram_data_map, histogram_width_map):
-        thresholds = {}
-        num = len(histogram_data_map)
-        pbar = tqdm(range(num), total=num, position=0, leave=True)
-        for item in histogram_data_map:
-            pbar.set_description("[{}] threshold: {}".format(self.histogram_bin_num, item))
-            pbar.update(1)
-            thresholds[item] = self.kld_threshold(histogram_data_map[item],
-                                                  histogram_width_map[item], self.histogram_bin_num)
-        pbar.close()
-        return thresholds
+        print("[{}] calculate threshold of {} ops".format(self.histogram_bin_num,
+                                                         len(histogram_data_map)))
+        return self.kld_thresholds(histogram_data_map, histogram_width_map,
+                                   self.histogram_bin_num)
+
+    def op_statistics(self, i, evaled_op, min_value, max_value, sketch=None):
+        # (min, max, abs max) of the i-th op, abs max comes from the sketch with
+        # percentile or mse calibration
+        abs_value = max(abs(min_value), abs(max_value))
+        if sketch is not None and sketch.count > 0:
+            if 'use_percentile9999' in self.debug_cmd:
+                step = (99.999999 - 99.99) / len(self.parser.op_names)
+                abs_value = sketch.percentile(99.99 + i * step)
+            else:
+                abs_value = sketch.mse_threshold()
+            self.sketch_error[evaled_op] = sketch.error_bound(abs_value)
+        if abs_value <= 1e-5:
+            # if op's outputs are all close to zero, change it to 1e-5 for them.
+            min_value = -1e-5
+            max_value = 1e-5
+            abs_value = 1e-5
+            print("WARNING: layer {} is all zeros. Please check the "
+                  "input data correctness.".format(evaled_op))
+        return min_value, max_value, abs_value
+
+    def new_sketch(self):
+        # percentile and mse thresholds come from a streaming histogram of |x|, so the
+        # memory stays fixed whatever the size and number of the activations
+        if 'use_percentile9999' in self.debug_cmd or 'use_mse' in self.debug_cmd:
+            return LogHistogram(int(self.debug_cmd.get('sketch_bits', 7)))
+        return None
+
+    def thresholds_by_hist(self, histogram_data_map, histogram_width_map):
+        thresholds_map = self.find_threshold(histogram_data_map, histogram_width_map)
+        thresholds_map_absmax = {}
+        for k, v in self.activations_statistics.items():
+            _, _, abs_val = v
+            thresholds_map_absmax[k] = abs_val
+            if thresholds_map[k] > abs_val:
+                thresholds_map[k] = abs_val
+            if 'use_percentile9999' in self.debug_cmd:
+                thresholds_map[k] = abs_val
+            elif 'use_max' in self.debug_cmd or 'use_mse' in self.debug_cmd:
+                thresholds_map[k] = abs_val
+        if self.sketch_error:
+            op, error = max(self.sketch_error.items(), key=lambda x: x[1])
+            sketch = self.new_sketch()
+            print("sketch of {} bytes per op, relative error {:.2e}, max error {:.2e} at {}".format(
+                sketch.nbytes, sketch.relative_error, error, op))
+        return thresholds_map, thresholds_map_absmax, {}, {}
+
+    def collect_stats(self, statistics=None, first=True):
+        # min/max (and sketches) of the ops over the samples, or their histograms against
+        # the statistics of all the samples
+        if 'use_torch_observer_for_cali' in self.debug_cmd:
+            raise RuntimeError("use_torch_observer_for_cali can't be run by partial stats")
+        self.load_net_input()
+        stats = PartialStats(self.num_samples)
+        all_tensors = self.parser.get_op_name_list()
+        pbar = tqdm(all_tensors, total=len(all_tensors), position=0, leave=True)
+        for i, evaled_op in enumerate(pbar):
+            for idx in range(self.args.input_num):
+                self.gen_ref_tensor(idx, evaled_op)
+            sketch = self.new_sketch() if statistics is None else None
+            for idx in range(self.args.input_num):
+                activation = self.get_ref_tensor(idx, evaled_op)
+                if activation is None:
+                    continue
+                if statistics is None:
+                    stats.update_min_max(evaled_op, activation)
+                    if sketch is not None:
+                        sketch.update(activation)
+                else:
+                    hist, _ = self.histogram(activation,
+                                             statistics[evaled_op][2],
+                                             self.histogram_bin_num,
+                                             out=stats.hist.get(evaled_op))
+                    stats.hist[evaled_op] = hist
+            if sketch is not None:
+                stats.sketch[evaled_op] = sketch
+            self.store.release(i)
+        print(self.store.summary())
+        self.store.close()
+        stats.statistics = statistics
+        return stats
+
+    def stats_statistics(self, stats):
+        self.sketch_error = {}
+        statistics = {}
+        for i, evaled_op in enumerate(self.parser.get_op_name_list()):
+            statistics[evaled_op] = self.op_statistics(i, evaled_op, stats.min[evaled_op],
+                                                       stats.max[evaled_op],
+                                                       stats.sketch.get(evaled_op))
+        return statistics
 
     def activation_collect_and_calc_th(self):
+        self.load_net_input()
         histogram_data_map = {}
         histogram_width_map = {}
         self.activations_statistics = {}
+        self.sketch_error = {}
         thresholds_map = {}
         thresholds_map_absmax = {}
         thresholds_map_scale = {}
         thresholds_map_zp = {}
         all_tensors = self.parser.get_op_name_list()
-        step = (99.999999 - 99.99) / len(all_tensors)
         pbar = tqdm(all_tensors, total=len(all_tensors), position=0, leave=True)
         for i, evaled_op in enumerate(all_tensors):
             pbar.set_description("activation_collect_and_calc_th for op: {}".format(evaled_op))
@@ -827,8 +1270,7 @@ class ActivationCalibrator2(BaseKldCalibrator):
 
             min_value = inf
             max_value = -inf
-            abs_value = None
-            all_data = []
+            sketch = self.new_sketch()
             for idx in range(self.args.input_num):
                 activation = self.get_ref_tensor(idx, evaled_op)
                 if activation is None:
@@ -839,40 +1281,21 @@ class ActivationCalibrator2(BaseKldCalibrator):
                 else:
                     min_value = min(np.min(activation), min_value)
                     max_value = max(np.max(activation), max_value)
-                    abs_value = max(abs(min_value), abs(max_value))
-                    if 'use_percentile9999' in self.debug_cmd:
-                        all_data.extend(activation.flatten().tolist())
-                    if 'use_max' in self.debug_cmd:
-                        all_data.extend(activation.flatten().tolist())
-            if 'use_percentile9999' in self.debug_cmd:
-                #t0 = time.time()
-                all_data = np.abs(np.array(all_data))
-                abs_value2 = np.percentile(all_data, 99.99 + i * step)
-                abs_value = abs_value2
-            if 'use_max' in self.debug_cmd:
-                #t0 = time.time()
-                all_data = np.abs(np.array(all_data))
-                abs_value2 = np.max(all_data)
-                abs_value = abs_value2
-            if abs_value <= 1e-5:
-                # if op's outputs are all close to zero, change it to 1e-5 for them.
-                min_value = -1e-5
-                max_value = 1e-5
-                abs_value = 1e-5
-                print("WARNING: layer {} is all zeros. Please check the "
-                      "input data correctness.".format(evaled_op))
-            self.activations_statistics[evaled_op] = (min_value, max_value, abs_value)
+                    if sketch is not None:
+                        sketch.update(activation)
 
             if 'use_torch_observer_for_cali' not in self.debug_cmd:
+                self.activations_statistics[evaled_op] = self.op_statistics(
+                    i, evaled_op, min_value, max_value, sketch)
                 for idx in range(self.args.input_num):
                     activation = self.get_ref_tensor(idx, evaled_op)
                     _, _, abs_value = self.activations_statistics[evaled_op]
-                    hist, width = self.histogram(activation, abs_value, self.histogram_bin_num)
-                    if evaled_op not in histogram_data_map:
-                        histogram_data_map[evaled_op] = hist
-                        histogram_width_map[evaled_op] = width
-                    else:
-                        histogram_data_map[evaled_op] += hist
+                    hist, width = self.histogram(activation,
+                                                 abs_value,
+                                                 self.histogram_bin_num,
+                                                 out=histogram_data_map.get(evaled_op))
+                    histogram_data_map[evaled_op] = hist
+                    histogram_width_map[evaled_op] = width
             else:
                 qmin, qmax = -128, 127
                 scale, zp = self.torchObserver_dict[evaled_op].calculate_qparams()
@@ -883,21 +1306,13 @@ class ActivationCalibrator2(BaseKldCalibrator):
                 thresholds_map_scale[evaled_op] = scale.numpy()[0]
                 thresholds_map_zp[evaled_op] = zp.numpy()[0]
 
-            for idx in range(self.args.input_num):
-                self.clear_ref_tensor(idx, evaled_op)
+            self.store.release(i)
         pbar.close()
+        print(self.store.summary())
+        self.store.close()
 
         if 'use_torch_observer_for_cali' not in self.debug_cmd:
-            thresholds_map = self.find_threshold(histogram_data_map, histogram_width_map)
-            for k, v in self.activations_statistics.items():
-                _, _, abs_val = v
-                thresholds_map_absmax[k] = abs_val
-                if thresholds_map[k] > abs_val:
-                    thresholds_map[k] = abs_val
-                if 'use_percentile9999' in self.debug_cmd:
-                    thresholds_map[k] = abs_val
-                elif 'use_max' in self.debug_cmd:
-                    thresholds_map[k] = abs_val
+            return self.thresholds_by_hist(histogram_data_map, histogram_width_map)
         return thresholds_map, thresholds_map_absmax, thresholds_map_scale, thresholds_map_zp
 
     def run(self):
@@ -916,7 +1331,19 @@ class ActivationCalibrator2(BaseKldCalibrator):
                 print('input_calibration_table error')
                 exit(1)
         else:
-            thresholds_map, thresholds_map_absmax, thresholds_map_scale, thresholds_map_zp = self.activation_collect_and_calc_th()
+            stage, _, arrays = self.load_checkpoint() if self.resume else (None, 0, {})
+            map_kinds = ['th', 'absmax', 'scale', 'zp']
+            if stage == 'collected':
+                results = tuple(unpack_values(kind, arrays) for kind in map_kinds)
+            elif self.use_partial_stats():
+                results = self.thresholds_by_partial_stats()
+                if results is None:
+                    return
+            else:
+                results = self.activation_collect_and_calc_th()
+            thresholds_map, thresholds_map_absmax, thresholds_map_scale, thresholds_map_zp = results
+            if stage != 'collected' and self.args.tune_num > 0:
+                self.save_checkpoint('collected', maps=dict(zip(map_kinds, results)))
             self._clean_resource()
             # step 3: dump threshold table of default histogram bins
             cali_table = self.args.calibration_table
@@ -944,6 +1371,7 @@ class ActivationCalibrator2(BaseKldCalibrator):
             # if 'use_torch_observer_for_cali' in self.debug_cmd:
             #     exit(0)
         if self.args.tune_num <= 0:
+            self.ckpt.remove()
             return
 
         # setp 4: tune to get better threshold of each layers.
@@ -977,6 +1405,7 @@ class ActivationCalibrator2(BaseKldCalibrator):
                 f.write("{} {:.7f} {:.7f} {:.7f}\n".format(op_name, threshold, min_value,
                                                            max_value))
         os.remove(cali_table)
+        self.ckpt.remove()
         if 'print_debug_info' in self.debug_cmd:
             th_before_tuned = np.array(thresholds_map_list)
             th_after_tuned = np.array(tuned_threshold_list)
@@ -1005,6 +1434,7 @@ class ActivationCalibrator(BaseKldCalibrator):
             tmp.load_config(self.parser.get_input_op_by_idx(i))
             self.ppa_list.append(tmp)
 
+        ds = self.local_shard(ds)
         if ds.all_image:
             n = len(ds.data_list) % self.batch_size
             if n != 0:
@@ -1016,7 +1446,14 @@ class ActivationCalibrator(BaseKldCalibrator):
         self.histogram_bin_num = args.histogram_bin_num
         self.activations_statistics = dict()
         self.debug_cmd = parse_debug_cmd(args.debug_cmd)
+        # streaming_cali: run inference twice instead of dumping activations to ./tmpdata
+        self.streaming = 'streaming_cali' in self.debug_cmd
         self.ds = ds
+        # the statistics are saved every ckpt_interval seconds, --resume goes on from them
+        self.resume = getattr(args, 'resume', False)
+        self.ckpt = calibration_checkpoint(
+            args, self.debug_cmd, (args.calibration_table or args.mlir_file) + '.ckpt',
+            lambda: calibration_fingerprint(args, self.parser, self.ds.data_list))
 
     def _activations_size(self, tensors):
         size = 0
@@ -1024,20 +1461,20 @@ class ActivationCalibrator(BaseKldCalibrator):
             size += v.size
         return size * 4
 
-    def _activations_generator_and_find_minmax(self):
-        idx, data_idx = 0, 0
-        if os.path.exists('./tmpdata/'):
-            os.system('rm -rf ./tmpdata/;mkdir -p ./tmpdata/')
-        else:
-            os.system('mkdir -p ./tmpdata/')
+    def _activations_generator(self, desc, start=0):
+        # invoke the module on every (batched) calibration sample from start and yield all
+        # its tensors
+        idx = 0
+        num = 0
+        batched_inputs = {}
         if self.ds.all_image:
-            batched_inputs = self.input_num * ['']
-        else:
-            batched_inputs = {}
-        show_mem_info('mem info before _activations_generator_and_find_minmax')
+            image_loaders = [
+                ppa.prefetch(batches) for ppa, batches in zip(
+                    self.ppa_list, batch_image_inputs(self.ds.data_list, self.input_num, self.batch_size))
+            ]
         pbar = tqdm(self.ds.data_list, total=self.num_samples, position=0, leave=True)
         for data in self.ds.data_list:
-            pbar.set_description("inference and find Min Max *{}".format(data.split("/")[-1]))
+            pbar.set_description("{} *{}".format(desc, data.split("/")[-1]))
             pbar.update(1)
             if self.ds.all_npz:
                 x = np.load(data)
@@ -1066,33 +1503,51 @@ class ActivationCalibrator(BaseKldCalibrator):
                     self.module.set_tensor(name, x.astype(np.float32))
             elif self.ds.all_image:
                 idx += 1
-                inputs = data.split(',')
-                inputs = [s.strip() for s in inputs]
-                assert (self.input_num == len(inputs))
-                for i in range(self.input_num):
-                    batched_inputs[i] += '{},'.format(inputs[i])
-                    if idx == self.batch_size:
-                        x = self.ppa_list[i].run(batched_inputs[i][:-1])
-                        self.module.set_tensor(self.ppa_list[i].input_name, x)
-                if idx == self.batch_size:
-                    idx = 0
-                    batched_inputs = self.input_num * ['']
-                else:
+                if idx < self.batch_size:
                     continue
+                idx = 0
+                for i in range(self.input_num):
+                    x = next(image_loaders[i])
+                    self.module.set_tensor(self.ppa_list[i].input_name, x)
             else:
                 raise RuntimeError("Unknown dataset")
+            num += 1
+            if num <= start:
+                continue
             self.module.invoke()
-            activations = self.module.get_all_tensor()
+            yield self.module.get_all_tensor()
+        pbar.close()
+
+    def _activations_generator_and_find_minmax(self, start=0):
+        data_idx = start
+        if not self.streaming and start == 0:
+            if os.path.exists('./tmpdata/'):
+                os.system('rm -rf ./tmpdata/;mkdir -p ./tmpdata/')
+            else:
+                os.system('mkdir -p ./tmpdata/')
+        show_mem_info('mem info before _activations_generator_and_find_minmax')
+        for activations in self._activations_generator("inference and find Min Max", start):
             self.find_min_max_abs_per_input(activations)
-            for name in activations:
-                activations[name] = activations[name].astype(np.float32)
-            np.savez('./tmpdata/{}_activations.npz'.format(data_idx), **activations)
+            if not self.streaming:
+                for name in activations:
+                    activations[name] = activations[name].astype(np.float32)
+                np.savez('./tmpdata/{}_activations.npz'.format(data_idx), **activations)
             data_idx += 1
+            if self.ckpt.due():
+                self.save_checkpoint('minmax', data_idx)
             del activations
             gc.collect()
-        pbar.close()
         show_mem_info('mem info after _activations_generator_and_find_minmax')
 
+    def _activations_loader(self, start=0):
+        num = self.num_samples // self.batch_size if self.ds.all_image else self.num_samples
+        pbar = tqdm(self.ds.data_list, total=num, position=0, leave=True)
+        for i in range(start, num):
+            pbar.set_description("calc_thresholds, iter {}".format(i))
+            pbar.update(1)
+            yield np.load('./tmpdata/{}_activations.npz'.format(i))
+        pbar.close()
+
     def _clean_resource(self):
         del self.module
         self.module = None
@@ -1115,30 +1570,45 @@ class ActivationCalibrator(BaseKldCalibrator):
                       "input data correctness.".format(op_name))
             self.activations_statistics[op_name] = (min_value, max_value, abs_value)
 
-    def calc_thresholds(self):
+    def calc_thresholds(self, start=0, histogram_data_map=None):
+        # histograms of the samples from start, added to the ones given
         print("calculate histogram..")
-        histogram_data_map = {}
+        histogram_data_map = {} if histogram_data_map is None else histogram_data_map
         histogram_width_map = {}
         show_mem_info('mem info before calc_thresholds')
-        num = self.num_samples // self.batch_size if self.ds.all_image else self.num_samples
-        pbar = tqdm(self.ds.data_list, total=num, position=0, leave=True)
-        for i in range(num):
-            activations = np.load('./tmpdata/{}_activations.npz'.format(i))
-            pbar.set_description("calc_thresholds, iter {}".format(i))
-            pbar.update(1)
+        if self.streaming:
+            # second inference pass: histograms are built against the final abs max,
+            # so the result equals the dump-and-reload flow without touching the disk
+            activations_iter = self._activations_generator("calc_thresholds", start)
+        else:
+            activations_iter = self._activations_loader(start)
+        data_idx = start
+        for activations in activations_iter:
             for op_name, activation in activations.items():
                 _, _, abs_value = self.activations_statistics[op_name]
-                hist, width = self.histogram(activation, abs_value, self.histogram_bin_num)
-                if op_name not in histogram_data_map:
-                    histogram_data_map[op_name] = hist
-                    histogram_width_map[op_name] = width
-                else:
-                    histogram_data_map[op_name] += hist
+                hist, width = self.histogram(activation,
+                                             abs_value,
+                                             self.histogram_bin_num,
+                                             out=histogram_data_map.get(op_name))
+                histogram_data_map[op_name] = hist
+                histogram_width_map[op_name] = width
+            data_idx += 1
+            if self.ckpt.due():
+                self.save_checkpoint('hist', data_idx, {'hist': histogram_data_map})
             del activations
             gc.collect()
-        pbar.close()
         show_mem_info('mem info after calc_thresholds')
+        for op_name, hist in histogram_data_map.items():
+            # the histograms resumed with no sample left, the same widths as histogram()
+            if op_name not in histogram_width_map:
+                _, _, abs_value = self.activations_statistics[op_name]
+                histogram_width_map[op_name] = abs_value / (self.histogram_bin_num - 1)
 
+        thresholds_map = self.thresholds_by_hist(histogram_data_map, histogram_width_map)
+        show_mem_info('mem info after find_threshold')
+        return thresholds_map
+
+    def thresholds_by_hist(self, histogram_data_map, histogram_width_map):
         thresholds_map = self.find_threshold(histogram_data_map, histogram_width_map)
         thresholds_map['abs_max'] = {}
         for k, v in self.activations_statistics.items():
@@ -1146,21 +1616,46 @@ class ActivationCalibrator(BaseKldCalibrator):
             thresholds_map['abs_max'][k] = abs_val
             if thresholds_map[k] > abs_val:
                 thresholds_map[k] = abs_val
-
-        show_mem_info('mem info after find_threshold')
         return thresholds_map
 
+    def collect_stats(self, statistics=None, first=True):
+        # min/max of the tensors over the samples, or their histograms against the statistics
+        # of all the samples
+        stats = PartialStats(self.num_samples)
+        if statistics is None:
+            for activations in self._activations_generator("inference and find Min Max"):
+                if first:
+                    # the first sample decides the all zeros layers, as in a serial run
+                    self.find_min_max_abs_per_input(activations)
+                else:
+                    for op_name, activation in activations.items():
+                        stats.update_min_max(op_name, activation)
+            for op_name, (min_value, max_value, _) in self.activations_statistics.items():
+                stats.min[op_name] = min_value
+                stats.max[op_name] = max_value
+            return stats
+        for activations in self._activations_generator("calc histogram"):
+            for op_name, activation in activations.items():
+                # float32 as the activations dumped to ./tmpdata
+                hist, _ = self.histogram(activation.astype(np.float32),
+                                         statistics[op_name][2],
+                                         self.histogram_bin_num,
+                                         out=stats.hist.get(op_name))
+                stats.hist[op_name] = hist
+        stats.statistics = statistics
+        return stats
+
+    def stats_statistics(self, stats):
+        return {
+            k: (stats.min[k], stats.max[k], max(abs(stats.min[k]), abs(stats.max[k])))
+            for k in stats.min
+        }
+
     def find_threshold(self, histogram_data_map, histogram_width_map):
-        thresholds = {}
-        num = len(histogram_data_map)
-        pbar = tqdm(range(num), total=num, position=0, leave=True)
-        for item in histogram_data_map:
-            pbar.set_description("[{}] threshold: {}".format(self.histogram_bin_num, item))
-            pbar.update(1)
-            thresholds[item] = self.kld_threshold(histogram_data_map[item],
-                                                  histogram_width_map[item], self.histogram_bin_num)
-        pbar.close()
-        return thresholds
+        print("[{}] calculate threshold of {} ops".format(self.histogram_bin_num,
+                                                         len(histogram_data_map)))
+        return self.kld_thresholds(histogram_data_map, histogram_width_map,
+                                   self.histogram_bin_num)
 
     def run(self):
         layer_name_list = []
@@ -1178,11 +1673,25 @@ class ActivationCalibrator(BaseKldCalibrator):
                 print('input_calibration_table error')
                 exit(1)
         else:
-            # step 1: find min max
-            self._activations_generator_and_find_minmax()
-
-            # step 2: calculate threshold with histogram bins
-            thresholds_map = self.calc_thresholds()
+            stage, cursor, arrays = self.load_checkpoint() if self.resume else (None, 0, {})
+            if stage == 'collected':
+                thresholds_map = unpack_values('th', arrays)
+                thresholds_map['abs_max'] = unpack_values('absmax', arrays)
+            elif self.use_partial_stats():
+                thresholds_map = self.thresholds_by_partial_stats()
+                if thresholds_map is None:
+                    return
+            else:
+                # step 1: find min max
+                if stage != 'hist':
+                    self._activations_generator_and_find_minmax(cursor)
+                    cursor = 0
+
+                # step 2: calculate threshold with histogram bins
+                thresholds_map = self.calc_thresholds(cursor, unpack_values('hist', arrays))
+            if stage != 'collected' and self.args.tune_num > 0:
+                th = {k: v for k, v in thresholds_map.items() if k != 'abs_max'}
+                self.save_checkpoint('collected', maps={'th': th, 'absmax': thresholds_map['abs_max']})
             self._clean_resource()
 
             # step 3: dump threshold table of default histogram bins
@@ -1202,6 +1711,7 @@ class ActivationCalibrator(BaseKldCalibrator):
                                                                max_value))
 
         if self.args.tune_num <= 0:
+            self.ckpt.remove()
             return
 
         # setp 4: tune to get better threshold of each layers.
@@ -1228,6 +1738,7 @@ class ActivationCalibrator(BaseKldCalibrator):
                 f.write("{} {:.7f} {:.7f} {:.7f}\n".format(op_name, threshold, min_value,
                                                            max_value))
         os.remove(cali_table)
+        self.ckpt.remove()
         if 'print_debug_info' in self.debug_cmd:
             th_before_tuned = np.array(thresholds_map_list)
             th_after_tuned = np.array(tuned_threshold_list)
@@ -1236,3 +1747,41 @@ class ActivationCalibrator(BaseKldCalibrator):
                 self.tunner.tune_steps)
             save_tensor_diff_subplot(th_before_tuned, th_after_tuned, layer_name_list,
                                      'before_tuned', 'after_tuned', file_prefix)
+
+
+def benchmark(op_num=5000, math_lib_path='calibration_math.so'):
+    # kl_diversity_hist per op against the batched call, np.histogram against bincount
+    calibrator = BaseKldCalibrator(math_lib_path)
+    rng = np.random.default_rng(0)
+    for bin_num in (2048, 8192):
+        decay = np.exp(-np.arange(bin_num) / rng.uniform(10, bin_num, (op_num, 1)))
+        hists = rng.poisson(decay * 100).astype(np.int32)
+        hist_map = {str(i): hists[i] for i in range(op_num)}
+        width_map = {str(i): w for i, w in enumerate(rng.uniform(1e-3, 1, op_num))}
+        t0 = time.time()
+        loop = {k: calibrator.kld_threshold(v, width_map[k], bin_num) for k, v in hist_map.items()}
+        t1 = time.time()
+        batch = calibrator.kld_thresholds(hist_map, width_map, bin_num)
+        t2 = time.time()
+        assert loop == batch
+        print("threshold of {} ops, {} bins: per op {:.3f}s, batch {:.3f}s".format(
+            op_num, bin_num, t1 - t0, t2 - t1))
+
+        data = rng.standard_normal((16, 64, 56, 56)).astype(np.float32)
+        data[data < 0] = 0
+        abs_max = float(np.abs(data).max())
+        t0 = time.time()
+        t = np.abs(data.flatten())
+        t = t[t != 0]
+        width = abs_max / (bin_num - 1)
+        ref, _ = np.histogram(np.floor(t / width + 0.5), bins=bin_num, range=(0, bin_num - 1))
+        t1 = time.time()
+        hist, _ = calibrator.histogram(data, abs_max, bin_num)
+        t2 = time.time()
+        assert np.array_equal(ref, hist)
+        print("histogram of {} values, {} bins: np.histogram {:.3f}s, bincount {:.3f}s".format(
+            data.size, bin_num, t1 - t0, t2 - t1))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -17,11 +17,13 @@ import copy
 import time
 import datetime
 from tqdm import tqdm
-from utils.mlir_shell import mlir_lowering
+from utils.mlir_shell import mlir_lowering_in_process
 from utils.mlir_parser import MlirParser
 from utils.misc import parse_debug_cmd
-from utils.preprocess import preprocess
+from utils.preprocess import preprocess, batch_image_inputs
 from calibration.data_selector import DataSelector
+from calibration.ref_cache import RefCache
+from utils.file_hash import hash_file, hash_array
 from utils.misc import cos_sim,seed_all
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
@@ -67,6 +69,11 @@ def find_all_pre_layers(all_pre_layers, op_name, parser, exist_ref_layers = None
             all_pre_layers.append(op_name)
 
 class MixQuantModel:
+    # number of lowerings done in process
+    lowering_count = 0
+    # number of infer/infer_from runs
+    infer_count = 0
+
     def __init__(self, fp32_mlir, chip: str, calib_table: str = None, mix_table: str = None, fp_type: str = 'auto'):
         self.fp32_mlir = fp32_mlir
         self.chip = chip
@@ -86,14 +93,15 @@ class MixQuantModel:
                     exit(1)
 
         self.quanted_mlir_file = '{}.{}.tune.mlir'.format(fp32_mlir, 'mix' if mix_table else self.mode)
-        mlir_lowering(self.fp32_mlir, self.quanted_mlir_file, self.mode, self.chip,
-                      self.calib_table, False, self.mix_table)
         self.module = pymlir.module()
-        self.module.load(self.quanted_mlir_file)
-        self.parser = MlirParser(self.quanted_mlir_file)
+        mlir_lowering_in_process(self.module, self.fp32_mlir, self.quanted_mlir_file, self.mode,
+                                 self.chip, self.calib_table, False, self.mix_table)
+        MixQuantModel.lowering_count += 1
+        self.parser = MlirParser(mlir_str=self.module.get_module_str())
         self.weight_file = self.parser.module_weight_file
 
     def infer(self, data: list, global_compare_layers:list = None):
+        MixQuantModel.infer_count += 1
         for k, v in zip(self.module.input_names, data):
             self.module.set_tensor(k, v)
         self.module.invoke()
@@ -108,6 +116,7 @@ class MixQuantModel:
 
     def infer_from(self, top_op_name, input_data_dict: dict, extra_input_data_dict: dict, global_compare_layers:list = None):
         # print('mix model op list:', self.parser.get_op_name_list())
+        MixQuantModel.infer_count += 1
         for k in input_data_dict:
             self.module.set_tensor_from_int(k, input_data_dict[k])
             print(f'infer_from set_tensor:{k}')
@@ -143,7 +152,7 @@ class MixQuantModel:
     def clean(self):
         try:
             del self.module
-            os.remove(self.quanted_mlir_file)
+            # lowered in process, only the weight file is on disk
             os.remove(self.weight_file)
         except:
             pass
@@ -172,6 +181,7 @@ class MixPrecSearcher:
         log_level = "DEBUG" if 'debug_log' in self.debug_cmd else "INFO"
         self.logger = logger('MixPrecSearcher', log_level=log_level)
         self._init_inputs(args)
+        self.ref_cache = None
 
     def disable_print(self):
         if 'debug_log' not in self.debug_cmd:
@@ -200,24 +210,17 @@ class MixPrecSearcher:
                 for i in range(self.batch_size - n):
                     ds.data_list.append(ds.data_list[-1])
             self.num_sample = len(ds.data_list) // self.batch_size
-            batched_idx = 0
-            batched_inputs = self.input_num * ['']
-            for data in ds.data_list:
-                inputs = data.split(',')
-                inputs = [s.strip() for s in inputs]
-                assert (len(inputs) == self.input_num)
-                batched_idx += 1
+            image_loaders = [
+                ppa.prefetch(batches) for ppa, batches in zip(
+                    ppa_list, batch_image_inputs(ds.data_list, self.input_num, self.batch_size))
+            ]
+            for _ in range(self.num_sample):
                 for i, input in enumerate(input_names):
-                    batched_inputs[i] += '{},'.format(inputs[i])
-                    if batched_idx == self.batch_size:
-                        x = ppa_list[i].run(batched_inputs[i][:-1])
-                        count = self.parser.get_user_count_by_op_name(input)
-                        self.ref_activations[tune_idx][input] = [x, count]
-                if batched_idx == self.batch_size:
-                    tune_idx += 1
-                    batched_idx = 0
-                    batched_inputs = self.input_num * ['']
-                    self.ref_activations[tune_idx] = {}
+                    x = next(image_loaders[i])
+                    count = self.parser.get_user_count_by_op_name(input)
+                    self.ref_activations[tune_idx][input] = [x, count]
+                tune_idx += 1
+                self.ref_activations[tune_idx] = {}
         elif ds.all_npy:
             self.num_sample = len(ds.data_list)
             self.input_data_buffer = [[] for i in range(self.num_sample)]
@@ -373,6 +376,12 @@ class MixPrecSearcher:
         if op_name in data_dict[i]:
             return False
         input_ops = model.parser.get_pre_op_by_op_name(op_name)
+        if len(input_ops) > 0 and not is_int8_data and self.ref_cache is not None:
+            value = self.ref_cache.get('ref', i, op_name)
+            if value is not None:
+                count = model.parser.get_user_count_by_op_name(op_name)
+                data_dict[i][op_name] = [value, count]
+                return True
         for input_op in input_ops:
             data = data_dict[i][input_op][0]
             if data is None:
@@ -384,6 +393,8 @@ class MixPrecSearcher:
         if len(input_ops) > 0:
             value = model.module.invoke_at(op_name).copy()
             self.logger.print_dbg(f'invoke_at {op_name}')
+            if not is_int8_data and self.ref_cache is not None:
+                self.ref_cache.put('ref', i, op_name, value)
             fp32_v = None
             if is_int8_data:
                 fp32_v = model.module.get_fp32_tensor(op_name)
@@ -522,15 +533,47 @@ class MixPrecSearcher:
                 extra_input_data_dict[input] = self.get_input_int8_tensor(idx, input)
         return input_data_dict, extra_input_data_dict
 
-    def run(self):
-        t0 = time.time()
-        layer_cos_list, predictions_gt, fp_layer_list = [], [], []
-        os.system('rm -rf tensor_diff_fp32_vs_int8;mkdir -p tensor_diff_fp32_vs_int8/')
+    def open_ref_cache(self, float_model):
+        # float outputs and tensors of the samples, reused by the runs on the same model and
+        # inputs
+        cache_dir = getattr(self.args, 'ref_cache_dir', '')
+        if not cache_dir:
+            return
+        self.ref_cache = RefCache(os.path.expanduser(cache_dir),
+                                  int(getattr(self.args, 'ref_cache_size', 4096) * 2**20))
+        h = hash_file(self.fp32_mlir)
+        hash_file(self.parser.module_weight_file, h)
+        h.update('{} {} {}'.format(pymlir.module().version, self.chip, float_model.mode).encode())
+        for idx in range(self.num_sample):
+            for name in self.ref_activations[idx]:
+                h.update(name.encode())
+                hash_array(self.ref_activations[idx][name][0], h)
+        self.ref_cache.open(h.hexdigest())
 
-        # set all layer as float
-        self.disable_print()
-        self.logger.print_info("run float mode: {}".format(self.fp32_mlir))
-        float_model = MixQuantModel(self.fp32_mlir, self.chip)
+    def close_ref_cache(self):
+        if self.ref_cache is not None:
+            self.logger.print_info(self.ref_cache.summary())
+            self.ref_cache.close()
+            self.ref_cache = None
+
+    def float_infer(self, float_model, idx, global_compare_layers, layers=[]):
+        # the float outputs of sample idx and the float tensors of layers, from the cache
+        # when it has them all
+        names = float_model.module.output_names if global_compare_layers is None else global_compare_layers
+        names = list(names)
+        if self.ref_cache is not None:
+            cached = self.ref_cache.get_all('out', idx, names + [l for l in layers if l not in names])
+            if cached is not None:
+                return {name: cached[name] for name in names}, {name: cached[name] for name in layers}
+        data = [self.ref_activations[idx][name][0] for name in self.ref_activations[idx]]
+        outputs = float_model.infer(data, global_compare_layers)
+        tensors = {name: float_model.module.get_tensor(name) for name in layers}
+        if self.ref_cache is not None:
+            self.ref_cache.put_all('out', idx, outputs)
+            self.ref_cache.put_all('out', idx, {k: v for k, v in tensors.items() if k not in outputs})
+        return outputs, tensors
+
+    def parse_global_compare_layers(self):
         global_compare_layers = None
         layers_rate = None
         all_pre_layers = None
@@ -553,11 +596,21 @@ class MixPrecSearcher:
                     exit(1)
             else:
                 layers_rate = len(global_compare_layers)*[1]
+        return global_compare_layers, layers_rate, all_pre_layers
+
+    def run(self):
+        t0 = time.time()
+        layer_cos_list, predictions_gt, fp_layer_list = [], [], []
+        os.system('rm -rf tensor_diff_fp32_vs_int8;mkdir -p tensor_diff_fp32_vs_int8/')
+
+        # set all layer as float
+        self.disable_print()
+        self.logger.print_info("run float mode: {}".format(self.fp32_mlir))
+        float_model = MixQuantModel(self.fp32_mlir, self.chip)
+        self.open_ref_cache(float_model)
+        global_compare_layers, layers_rate, all_pre_layers = self.parse_global_compare_layers()
         for idx in range(self.num_sample):
-            data = []
-            for name in list(self.ref_activations[idx].keys()):
-                data.append(self.ref_activations[idx][name][0])
-            outputs = float_model.infer(data, global_compare_layers)
+            outputs, _ = self.float_infer(float_model, idx, global_compare_layers)
             predictions_gt.append(outputs)
 
         # set all layer as int8
@@ -576,6 +629,7 @@ class MixPrecSearcher:
             float_model.clean()
             int8_model.clean()
             self.enable_print()
+            self.close_ref_cache()
             self.logger.print_info(f'job success, current int8 cos:{outputs_cos} is higher than expected_cos:{self.args.expected_cos},no need for mix precsion')
             exit(0)
 
@@ -716,8 +770,137 @@ class MixPrecSearcher:
         int8_model.clean()
         float_model.clean()
         self.enable_print()
+        self.close_ref_cache()
 
         self.logger.print_info('>>>run result:')
+        self.write_tables(layer_cos_list, fp_layer_list)
+        self.logger.print_info(f'int8 outputs_cos:{all_int8_cos:.6f} old')
+        self.logger.print_info(f"mix model outputs_cos:{outputs_cos:.6f}")
+        self.logger.print_info("Output mix quantization table to {}".format(self.quantize_table))
+        self.print_lowering_info()
+        self.logger.print_info("total time:{}".format(time.time() - t0))
+
+    def expand_fp_layers(self, layers):
+        # as in run, a float layer takes its next top ops along, and the quant skip ops fed
+        # by float layers are float too
+        fp_layer_list = []
+        for layer in layers:
+            for name in [layer] + self.parser.get_next_op_by_op_name(layer):
+                if name not in fp_layer_list:
+                    fp_layer_list.append(name)
+        for op in self.parser.ops:
+            if op.type in SKIP_OPERATION and op.name not in fp_layer_list:
+                for pre_layer in self.parser.get_pre_op_by_op_name(op.name):
+                    if pre_layer in fp_layer_list:
+                        fp_layer_list.append(op.name)
+                        break
+        return fp_layer_list
+
+    def mix_outputs_cos(self, fp_layer_list, predictions_gt, global_compare_layers, layers_rate):
+        mix_table = self._gen_mix_table(fp_layer_list)
+        mix_model = MixQuantModel(self.fp32_mlir, self.chip, self.calib_table, mix_table, self.args.fp_type)
+        outputs_cos = 0
+        for idx in range(self.num_sample):
+            data = [self.ref_activations[idx][name][0] for name in self.ref_activations[idx]]
+            outputs = mix_model.infer(data, global_compare_layers)
+            outputs_cos += self._loss(outputs, predictions_gt[idx], layers_rate)
+        mix_model.clean()
+        return outputs_cos / self.num_sample
+
+    def run_sensitivity(self):
+        # The cos each layer loses in the all int8 model is measured in one float and one int8
+        # inference per sample. The layers are ranked by it, and the fewest top ranked layers
+        # set to float reaching expected_cos are binary searched, so the mix models lowered
+        # are log2 of the candidates instead of one per layer under min_layer_cos.
+        t0 = time.time()
+        predictions_gt = []
+        self.disable_print()
+        self.logger.print_info("run float and int8 mode: {}".format(self.fp32_mlir))
+        float_model = MixQuantModel(self.fp32_mlir, self.chip)
+        self.open_ref_cache(float_model)
+        int8_model = MixQuantModel(self.fp32_mlir, self.chip, self.calib_table)
+        global_compare_layers, layers_rate, all_pre_layers = self.parse_global_compare_layers()
+        int8_op_names = set(int8_model.parser.get_op_name_list())
+        fp_op_names = set(float_model.parser.get_op_name_list())
+        top_ops = {op.name: op for op in self.parser.ops}
+        compared = [
+            name for name in self.parser.get_op_name_list()
+            if name in int8_op_names and name in fp_op_names and top_ops[name].type != 'top.Input'
+        ]
+        layer_cos = {name: 0 for name in compared}
+        all_int8_cos = 0
+        for idx in range(self.num_sample):
+            # the float tensors stay in float_model while int8_model runs
+            outputs, fp32_outs = self.float_infer(float_model, idx, global_compare_layers, compared)
+            predictions_gt.append(outputs)
+            data = [self.ref_activations[idx][name][0] for name in self.ref_activations[idx]]
+            outputs = int8_model.infer(data, global_compare_layers)
+            all_int8_cos += self._loss(outputs, predictions_gt[idx], layers_rate)
+            for name in compared:
+                layer_cos[name] += cos_sim(int8_model.module.get_fp32_tensor(name), fp32_outs[name])
+        all_int8_cos = all_int8_cos / self.num_sample
+        int8_model.clean()
+        float_model.clean()
+        self.close_ref_cache()
+        if all_int8_cos > self.args.expected_cos:
+            self.enable_print()
+            self.logger.print_info(f'job success, current int8 cos:{all_int8_cos} is higher than expected_cos:{self.args.expected_cos},no need for mix precsion')
+            exit(0)
+
+        # the cos lost by the layer itself: the least cos of its inputs minus its own
+        drop = {}
+        for name in compared:
+            layer_cos[name] /= self.num_sample
+            pre_cos = [layer_cos.get(i, 1.0) for i in self.parser.get_pre_op_by_op_name(name)]
+            drop[name] = min(pre_cos, default=1.0) - layer_cos[name]
+        layer_cos_list = [(name, layer_cos[name]) for name in compared
+                          if top_ops[name].type not in SKIP_OPERATION]
+        candidates = [
+            name for name, cos in layer_cos_list if cos < self.args.min_layer_cos and
+            (all_pre_layers is None or name in all_pre_layers)
+        ]
+        max_fp32_layer_num = len(top_ops) // 4
+        ranked = sorted(candidates, key=lambda name: drop[name], reverse=True)[:max_fp32_layer_num]
+        for i, name in enumerate(ranked):
+            self.logger.print_dbg(f'rank {i}: {name} cos:{layer_cos[name]:.6f} drop:{drop[name]:.6f}')
+
+        # outputs cos of the mix models with the top n ranked layers as float
+        outputs_cos_of = {0: all_int8_cos}
+        best = len(ranked)
+        if best > 0:
+            outputs_cos_of[best] = self.mix_outputs_cos(self.expand_fp_layers(ranked), predictions_gt,
+                                                        global_compare_layers, layers_rate)
+        if outputs_cos_of[best] > self.args.expected_cos:
+            low = 1
+            while low < best:
+                mid = (low + best) // 2
+                outputs_cos_of[mid] = self.mix_outputs_cos(self.expand_fp_layers(ranked[:mid]),
+                                                           predictions_gt, global_compare_layers,
+                                                           layers_rate)
+                if outputs_cos_of[mid] > self.args.expected_cos:
+                    best = mid
+                else:
+                    low = mid + 1
+            self.logger.print_info(f'job success, {best} of {len(candidates)} layers under min_layer_cos set to {self.mix_mode}')
+        else:
+            self.logger.print_info(f'job fail, {self.mix_mode} on the top {best} ranked layers gives outputs_cos:{outputs_cos_of[best]:.6f}')
+        fp_layer_list = self.expand_fp_layers(ranked[:best])
+        self.enable_print()
+
+        self.logger.print_info('>>>run result:')
+        self.write_tables(layer_cos_list, fp_layer_list)
+        self.logger.print_info(f'int8 outputs_cos:{all_int8_cos:.6f} old')
+        self.logger.print_info(f"mix model outputs_cos:{outputs_cos_of[best]:.6f}")
+        self.logger.print_info("Output mix quantization table to {}".format(self.quantize_table))
+        self.print_lowering_info()
+        # run lowers float and int8 models 3 times, and a mix model plus num_sample
+        # infer_from for each layer under min_layer_cos until expected_cos is reached
+        self.logger.print_info(
+            "the sequential search would lower up to {} times and run up to {} inferences".format(
+                3 + len(candidates), (2 + len(candidates)) * self.num_sample))
+        self.logger.print_info("total time:{}".format(time.time() - t0))
+
+    def write_tables(self, layer_cos_list, fp_layer_list):
         layer_cos_list = sorted(layer_cos_list, key=lambda x: x[1], reverse=False)
         with open(self.loss_table, "w") as f:
             f.write("# genetated time: {}\n".format(datetime.datetime.now()))
@@ -737,10 +920,10 @@ class MixPrecSearcher:
             f.write("# op_name   quantize_mode\n")
             for layer in fp_layer_list:
                 f.write("{} {}\n".format(layer, self.mix_mode))
-        self.logger.print_info(f'int8 outputs_cos:{all_int8_cos:.6f} old')
-        self.logger.print_info(f"mix model outputs_cos:{outputs_cos:.6f}")
-        self.logger.print_info("Output mix quantization table to {}".format(self.quantize_table))
-        self.logger.print_info("total time:{}".format(time.time() - t0))
+
+    def print_lowering_info(self):
+        self.logger.print_info("lowered {} times in process".format(MixQuantModel.lowering_count))
+        self.logger.print_info("ran {} inferences".format(MixQuantModel.infer_count))
 
     def run_bias_correction(self):
         self.logger.print_info("run_bias_correction start")
@@ -754,28 +937,7 @@ class MixPrecSearcher:
         self.logger.print_info("run float mode: {}".format(self.fp32_mlir))
         self.disable_print()
         float_model = MixQuantModel(self.fp32_mlir, self.chip)
-        global_compare_layers = None
-        layers_rate = None
-        all_pre_layers = None
-        if self.args.global_compare_layers != '':
-            global_compare_layers = [i.strip() for i in self.args.global_compare_layers.split(',')]
-            layers_rate = [float(i.split(':')[-1].strip()) for i in global_compare_layers if ':' in i]
-            global_compare_layers = [i.split(':')[0].strip() for i in global_compare_layers]
-            all_pre_layers = []
-            for layer in global_compare_layers:
-                pre_layers = []
-                find_all_pre_layers(pre_layers, layer, self.parser)
-                all_pre_layers.extend(pre_layers)
-            all_pre_layers = set(all_pre_layers)
-            if len(layers_rate) > 0:
-                if len(global_compare_layers) != len(layers_rate):
-                    print('global_compare_layers format error')
-                    exit(1)
-                if 1 != sum(layers_rate):
-                    print('global_compare_layers rate error')
-                    exit(1)
-            else:
-                layers_rate = len(global_compare_layers)*[1]
+        global_compare_layers, layers_rate, all_pre_layers = self.parse_global_compare_layers()
         for idx in range(self.num_sample):
             data = []
             for name in list(self.ref_activations[idx].keys()):
@@ -929,5 +1091,6 @@ class MixPrecSearcher:
         for item in layer_cos_list:
             self.logger.print_info(f'  op:{item[0]}, old layer cos:{item[1]:.6f}, new layer cos:{item[2]:.6f}, new output cos:{item[3]:.6f}')
         self.logger.print_info(f'best mix model outputs_cos:{max_outputs_cos:.6f}')
+        self.print_lowering_info()
         self.logger.print_info("total time:{}".format(time.time() - t0))
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import numpy as np
+from calibration.quantile_sketch import LogHistogram
+
+
+class PartialStats:
+    # Statistics of the tensors over a part of the calibration samples, in two stages:
+    #   minmax: min, max and the |x| sketches (percentile/mse calibration) of each tensor
+    #   hist:   histograms built against the (min, max, abs max) statistics of all the samples
+    # Stats of the same stage are merged into the stats of all their samples, so the parts run
+    # in other processes or on other machines give the table of a serial run.
+
+    def __init__(self, num_samples=0):
+        self.num_samples = num_samples
+        self.min = {}
+        self.max = {}
+        self.sketch = {}
+        self.statistics = None
+        self.hist = {}
+
+    @property
+    def stage(self):
+        return 'minmax' if self.statistics is None else 'hist'
+
+    def update_min_max(self, name, data):
+        min_value, max_value = np.min(data), np.max(data)
+        if name in self.min:
+            min_value = min(min_value, self.min[name])
+            max_value = max(max_value, self.max[name])
+        self.min[name] = min_value
+        self.max[name] = max_value
+
+    def merge(self, other):
+        if self.stage != other.stage:
+            raise RuntimeError("can't merge {} stats with {} stats".format(
+                self.stage, other.stage))
+        self.num_samples += other.num_samples
+        for name, value in other.min.items():
+            self.min[name] = min(value, self.min[name]) if name in self.min else value
+        for name, value in other.max.items():
+            self.max[name] = max(value, self.max[name]) if name in self.max else value
+        for name, sketch in other.sketch.items():
+            if name in self.sketch:
+                self.sketch[name].merge(sketch)
+            else:
+                self.sketch[name] = sketch
+        if other.statistics is not None:
+            if self.statistics != other.statistics:
+                raise RuntimeError("histograms of different statistics can't be merged")
+            for name, hist in other.hist.items():
+                self.hist[name] = self.hist[name] + hist if name in self.hist else hist
+        return self
+
+    @staticmethod
+    def _pack(values):
+        # the values keep their numpy type, as the widths of the histograms depend on it
+        names = list(values.keys())
+        data = np.array([float(values[n]) for n in names], dtype=np.float64)
+        dtypes = np.array([np.asarray(values[n]).dtype.name for n in names])
+        return np.array(names), data, dtypes
+
+    @staticmethod
+    def _unpack(names, data, dtypes):
+        return {n: np.dtype(t).type(v) for n, v, t in zip(names.tolist(), data, dtypes.tolist())}
+
+    def save(self, path):
+        arrays = {'num_samples': np.array(self.num_samples)}
+        arrays['min_names'], arrays['min'], arrays['min_dtypes'] = self._pack(self.min)
+        arrays['max_names'], arrays['max'], arrays['max_dtypes'] = self._pack(self.max)
+        if self.sketch:
+            names = list(self.sketch.keys())
+            sketches = [self.sketch[n] for n in names]
+            bins = [np.nonzero(s.counts)[0] for s in sketches]
+            arrays['sketch_names'] = np.array(names)
+            arrays['sketch_bits'] = np.array([s.mantissa_bits for s in sketches])
+            arrays['sketch_max'] = np.array([s.max for s in sketches])
+            arrays['sketch_nan'] = np.array([s.nan_num for s in sketches])
+            arrays['sketch_offsets'] = np.cumsum([0] + [b.size for b in bins])
+            arrays['sketch_bins'] = np.concatenate(bins)
+            arrays['sketch_counts'] = np.concatenate([s.counts[b] for s, b in zip(sketches, bins)])
+        if self.statistics is not None:
+            names = list(self.statistics.keys())
+            for i, key in enumerate(['stat_min', 'stat_max', 'stat_abs']):
+                _, arrays[key], arrays[key + '_dtypes'] = self._pack(
+                    {n: self.statistics[n][i] for n in names})
+            arrays['stat_names'] = np.array(names)
+            names = list(self.hist.keys())
+            arrays['hist_names'] = np.array(names)
+            arrays['hist'] = np.stack([self.hist[n] for n in names]) if names else np.zeros((0, 0))
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        stats = cls(int(f['num_samples']))
+        stats.min = cls._unpack(f['min_names'], f['min'], f['min_dtypes'])
+        stats.max = cls._unpack(f['max_names'], f['max'], f['max_dtypes'])
+        if 'sketch_names' in f:
+            offsets = f['sketch_offsets']
+            bins, counts = f['sketch_bins'], f['sketch_counts']
+            for i, name in enumerate(f['sketch_names'].tolist()):
+                sketch = LogHistogram(int(f['sketch_bits'][i]))
+                sketch.counts[bins[offsets[i]:offsets[i + 1]]] = counts[offsets[i]:offsets[i + 1]]
+                sketch.max = float(f['sketch_max'][i])
+                sketch.nan_num = int(f['sketch_nan'][i])
+                stats.sketch[name] = sketch
+        if 'stat_names' in f:
+            columns = [
+                cls._unpack(f['stat_names'], f[key], f[key + '_dtypes'])
+                for key in ['stat_min', 'stat_max', 'stat_abs']
+            ]
+            stats.statistics = {n: tuple(c[n] for c in columns) for n in columns[0]}
+            stats.hist = dict(zip(f['hist_names'].tolist(), f['hist']))
+        return stats
+
+    @classmethod
+    def load_all(cls, paths):
+        stats = cls.load(paths[0])
+        for path in paths[1:]:
+            stats.merge(cls.load(path))
+        return stats
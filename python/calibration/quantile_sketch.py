@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import numpy as np
+
+
+class LogHistogram:
+    # Streaming histogram of |x| with a fixed memory. The bin of a value is the top bits of
+    # its float32 pattern: the exponent and the high mantissa_bits of the mantissa. So a bin
+    # spans at most 2^-mantissa_bits of its values, and quantiles are estimated within that
+    # relative error, whatever the number of samples. Histograms of the same mantissa_bits
+    # can be merged.
+
+    def __init__(self, mantissa_bits=7):
+        assert 0 <= mantissa_bits <= 16
+        self.mantissa_bits = mantissa_bits
+        self.shift = 23 - mantissa_bits
+        self.counts = np.zeros(1 << (8 + mantissa_bits), dtype=np.int64)
+        self.max = 0.0
+        self.nan_num = 0
+
+    @property
+    def relative_error(self):
+        return 2.0**-self.mantissa_bits
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def update(self, data, chunk=1 << 18):
+        data = np.asarray(data).ravel()
+        for i in range(0, data.size, chunk):
+            t = np.abs(data[i:i + chunk], dtype=np.float32)
+            nan = np.isnan(t)
+            if nan.any():
+                self.nan_num += int(nan.sum())
+                t = t[~nan]
+                if t.size == 0:
+                    continue
+            self.max = max(self.max, float(t.max()))
+            self.counts += np.bincount(t.view(np.uint32) >> self.shift,
+                                       minlength=self.counts.size)
+        return self
+
+    def merge(self, other):
+        assert self.mantissa_bits == other.mantissa_bits
+        self.counts += other.counts
+        self.max = max(self.max, other.max)
+        self.nan_num += other.nan_num
+        return self
+
+    def _edges(self, bins):
+        # [low, high) of the bins as float32 values
+        bins = np.asarray(bins, dtype=np.uint32)
+        low = (bins << self.shift).view(np.float32).astype(np.float64)
+        high = ((bins + 1) << self.shift).view(np.float32).astype(np.float64)
+        return low, np.minimum(high, self.max)
+
+    def quantile(self, q):
+        # np.percentile(..., q * 100) with linear interpolation between the order statistics,
+        # an order statistic is spread uniformly inside its bin
+        n = self.count
+        if n == 0:
+            return 0.0
+        rank = q * (n - 1)
+        k = np.array([np.floor(rank), min(np.floor(rank) + 1, n - 1)])
+        cum = np.cumsum(self.counts)
+        bins = np.searchsorted(cum, k, side='right')
+        before = cum[bins] - self.counts[bins]
+        low, high = self._edges(bins)
+        value = low + (high - low) * (k - before + 0.5) / self.counts[bins]
+        value = value[0] + (rank - k[0]) * (value[1] - value[0])
+        return float(min(value, self.max))
+
+    def percentile(self, p):
+        return self.quantile(p / 100.0)
+
+    def error_bound(self, value):
+        # absolute error bound of a quantile estimated as value
+        return abs(value) * self.relative_error
+
+    def mse_threshold(self, qmax=127):
+        # the symmetric threshold with the least expected quantization error: the values
+        # under it get a rounding error of (th / qmax)^2 / 12, the ones above are clipped.
+        bins = np.nonzero(self.counts)[0]
+        if bins.size == 0:
+            return 0.0
+        c = self.counts[bins].astype(np.float64)
+        low, high = self._edges(bins)
+        v = (low + high) / 2
+        s0, s1, s2 = np.cumsum(c), np.cumsum(c * v), np.cumsum(c * v * v)
+        th = high
+        clip = (s2[-1] - s2) - 2 * th * (s1[-1] - s1) + th * th * (s0[-1] - s0)
+        error = s0 * th * th / (12 * qmax * qmax) + clip
+        return float(th[int(np.argmin(error))])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import os
+import hashlib
+import numpy as np
+from utils.dir_cache import DirCache
+
+
+class RefCache(DirCache):
+    # Float tensors of a model on a set of inputs, kept on disk between runs. A key names
+    # everything the tensors depend on (the model, its weights, the float mode, the inputs)
+    # and owns a directory of .npy files read back memory-mapped.
+
+    def __init__(self, root, max_bytes):
+        super().__init__(root, max_bytes)
+        self.dir = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, key):
+        os.makedirs(self.root, exist_ok=True)
+        self.dir = os.path.join(self.root, key)
+        os.makedirs(self.dir, exist_ok=True)
+        self.nbytes = self.dir_size(self.dir)
+        self.touch(self.dir)
+        self.evict(keep=self.dir)
+
+    def _path(self, kind, i, name):
+        # tensor names may be long or hold '/'
+        digest = hashlib.md5(name.encode()).hexdigest()
+        return os.path.join(self.dir, '{}_{}_{}.npy'.format(kind, i, digest))
+
+    def get(self, kind, i, name):
+        path = self._path(kind, i, name)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(path, mmap_mode='r')
+
+    def get_all(self, kind, i, names):
+        # all the tensors or None
+        paths = [self._path(kind, i, name) for name in names]
+        if not all(os.path.exists(p) for p in paths):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {name: np.load(p, mmap_mode='r') for name, p in zip(names, paths)}
+
+    def put(self, kind, i, name, value):
+        value = np.asarray(value)
+        if self.nbytes + value.nbytes > self.max_bytes:
+            return
+        path = self._path(kind, i, name)
+        tmp = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp, value)
+        os.replace(tmp, path)
+        self.nbytes += os.path.getsize(path)
+
+    def put_all(self, kind, i, values):
+        for name, value in values.items():
+            self.put(kind, i, name, value)
+
+    def close(self):
+        if self.dir is not None:
+            self.touch(self.dir)
+            self.evict(keep=self.dir)
+            self.dir = None
+
+    def summary(self):
+        return 'float reference cache {}: {} hits, {} misses, {:.1f} MB'.format(
+            self.dir, self.hits, self.misses, self.nbytes / 2**20)
@@ -170,15 +170,8 @@ class BM1684X:
     def compute(self, command, engine_type):
         assert isinstance(command, np.ndarray)
         assert command.dtype == np.uint8
-        return self.lib.execute_command(
-            0,
-            np.packbits(
-                command.reshape(-1, 8),
-                axis=-1,
-                bitorder="little",
-            ).ctypes.data,
-            engine_type,
-        )
+        # command is the raw bytes of the instruction
+        return self.lib.execute_command(0, command.ctypes.data, engine_type)
 
     def tiu_compute(self, command):
         return self.compute(command, 0)
@@ -378,11 +371,7 @@ class BM1684:
     def compute(self, command, engine_type):
         assert isinstance(command, np.ndarray)
         assert command.dtype == np.uint8
-        cmd = np.packbits(
-            command.reshape(-1, 8),
-            axis=-1,
-            bitorder="little",
-        ).ctypes.data
+        cmd = command.ctypes.data
         return self.lib.get_atomic_function(cmd, engine_type)(0, cmd)
 
     def tiu_compute(self, command):
@@ -19,14 +19,9 @@ except:
     import bmodel_fbs
 
 
-def read_file_to_bits(cmd_file):
-    cmmand_buf = np.fromfile(cmd_file, dtype=np.uint8)
-    return np.unpackbits(cmmand_buf, bitorder="little")
-
-
-def buffer_to_bits(buffer):
-    cmmand_buf = np.frombuffer(buffer, dtype=np.uint8)
-    return np.unpackbits(cmmand_buf, bitorder="little")
+def read_file(cmd_file):
+    with open(cmd_file, "rb") as f:
+        return f.read()
 
 
 class Decoder:
@@ -35,27 +30,29 @@ class Decoder:
     def __init__(self, context):
         self.context = context
 
-    def _decode_base(self, cmd_buf_bits, opcode_bits, cmd_set, sys_end=None):
+    def _decode_base(self, cmd_buf, opcode_bits, cmd_set, sys_end=None):
+        # decode from the bytes directly, each command is a view of cmd_buf
         operation = None
         cur = 0
+        cmd_buf = memoryview(cmd_buf).cast("B")
         l, h = opcode_bits
-        while cmd_buf_bits.size > 0:
-            cmd_key = op_support.packbits(cmd_buf_bits[l:h])
+        while len(cmd_buf) > 0:
+            cmd_key = op_support.read_bits(cmd_buf, l, h)
             if cmd_key in cmd_set:
                 recognize = False
                 for op in cmd_set[cmd_key]:
-                    if op.is_comp(cmd_buf_bits):
+                    if op.is_comp(cmd_buf):
                         # check whether this command is recognized by the decoder
-                        operation = op.decode(cmd_buf_bits)
+                        operation = op.decode(cmd_buf)
                         yield operation
                         # consume this command_code
-                        cmd_buf_bits = cmd_buf_bits[op.length :]
+                        cmd_buf = cmd_buf[op.length // 8 :]
                         cur += op.length
                         recognize = True
                         break
                 is_sys = sys_end is None or isinstance(operation, sys_end)
-                is_less_1024 = cmd_buf_bits.size < 1025
-                if is_sys and is_less_1024 and not np.any(cmd_buf_bits):
+                is_less_1024 = len(cmd_buf) * 8 < 1025
+                if is_sys and is_less_1024 and not any(cmd_buf):
                     break  # all the code have been processed
                 if not recognize:
                     raise ValueError(
@@ -68,31 +65,23 @@ class Decoder:
                     "Can not decode cmd, with opcode: {}, at {}.".format(cmd_key, cur)
                 )
 
-    def decode_tiu_bug(self, cmd_buf):
-        if cmd_buf:
-            # input is a buffer
-            return self.decode_tiu_bits(buffer_to_bits(cmd_buf))
-        return cmd_buf
-
-    def decode_dma_buf(self, cmd_buf):
-        if cmd_buf:
-            # input is a buffer
-            return self.decode_dma_bits(buffer_to_bits(cmd_buf))
-        return cmd_buf
-
-    def decode_tiu_bits(self, cmd_buf_bits):
-        # input is a bits vector
+    def decode_tiu_buf(self, cmd_buf):
+        # input is a bytes-like buffer
+        if len(cmd_buf) == 0:
+            return []
         return self._decode_base(
-            cmd_buf_bits,
+            cmd_buf,
             self.context.opdef.tiu_base.opcode_bits,
             self.context.opdef.tiu_cls,
             self.context.opdef.tiu_sys,
         )
 
-    def decode_dma_bits(self, cmd_buf_bits):
-        # input is a bits vector
+    def decode_dma_buf(self, cmd_buf):
+        # input is a bytes-like buffer
+        if len(cmd_buf) == 0:
+            return []
         return self._decode_base(
-            cmd_buf_bits,
+            cmd_buf,
             self.context.opdef.dma_base.opcode_bits,
             self.context.opdef.dma_cls,
             self.context.opdef.dma_sys,
@@ -122,7 +111,7 @@ class Decoder:
 
     def decode_bmodel_cmd(self, bmodel_cmd, subnet_id):
         tiu = itertools.islice(
-            self.decode_tiu_bug(bmodel_cmd.tiu_cls), bmodel_cmd.tiu_num
+            self.decode_tiu_buf(bmodel_cmd.tiu_cmd), bmodel_cmd.tiu_num
         )
         dma = itertools.islice(
             self.decode_dma_buf(bmodel_cmd.dma_cmd), bmodel_cmd.dma_num
@@ -144,17 +133,17 @@ class BModelReader:
     )
 
     class cmd_group_cls:
-        def __init__(self, fbs: bmodel_fbs.CmdGroup, cmd_buf_bits):
+        def __init__(self, fbs: bmodel_fbs.CmdGroup, cmd_buf):
             self.tiu_num = fbs.BdcNum()
             self.dma_num = fbs.GdmaNum()
             if fbs.BinaryBdc():
                 binary_tiu = (fbs.BinaryBdc().Start(), fbs.BinaryBdc().Size())
-                self.tiu_cls = cmd_buf_bits[binary_tiu[0] : sum(binary_tiu)]
+                self.tiu_cmd = cmd_buf[binary_tiu[0] : sum(binary_tiu)]
             else:
-                self.tiu_cls = []
+                self.tiu_cmd = []
             if fbs.BinaryGdma():
                 binary_dma = (fbs.BinaryGdma().Start(), fbs.BinaryGdma().Size())
-                self.dma_cmd = cmd_buf_bits[binary_dma[0] : sum(binary_dma)]
+                self.dma_cmd = cmd_buf[binary_dma[0] : sum(binary_dma)]
             else:
                 self.dma_cmd = []
 
@@ -209,7 +198,8 @@ class BModelReader:
                 file_obj.read(self.header_t.itemsize), dtype=self.header_t
             )
             self.binary_desc = file_obj.read(self.head["flatbuffers_size"][0])
-            self.binary = file_obj.read(self.head["binary_size"][0])
+            # slices of a memoryview share the memory of the file content
+            self.binary = memoryview(file_obj.read(self.head["binary_size"][0]))
         bmodel = bmodel_fbs.Model.GetRootAsModel(self.binary_desc, 0)
 
         def fbs_adaptor(param, _fields):
@@ -8,53 +8,66 @@
 # ==============================================================================
 
 from enum import Enum, IntEnum
-import functools, ctypes
+import functools, ctypes, operator
 import numpy as np
 from collections import OrderedDict
+try:
+    from utils.dtype_convert import bf16_to_fp32
+except ImportError:
+    # the debugger used on its own, without utils
+
+    def bf16_to_fp32(d_bf16):
+        assert d_bf16.dtype == np.uint16
+        return (d_bf16.astype(np.uint32) << 16).view(np.float32)
 
 __all__ = ["InsBase", "TIUBase", "DMABase", "NamedDict", "MType", "DType", "Scalar"]
 
 # ------------------------------------------------------------
 # utility function
 
-# cache for convert binary to unsigned integer.
-_TABLE = 2 ** np.arange(64, dtype=np.uint64)
-
-
-def packbits1(arr):
-    if arr.size > 64:
-        return 0
-    return int(arr.dot(_TABLE[: arr.size]))
-
 
-def packbits2(arr):
-    if arr.size > 64:
-        return 0
-    return np.bitwise_or.reduce(np.left_shift(arr, np.arange(arr.size)))
+def read_bits(buffer, low, high):
+    # buffer is a little-endian bytes-like object, [low, high) in bits
+    value = int.from_bytes(buffer[low // 8 : (high + 7) // 8], "little")
+    return (value >> (low % 8)) & ((1 << (high - low)) - 1)
 
 
-packbits = packbits1
-
-
-# Please improve this function.
-# It is called many times and it should be super fast.
 def decode_reg(buffer, des_reg):
-    bits_sec = np.split(buffer, des_reg["high_bit"])  # slow
-    value = (packbits(x) for x in bits_sec)  # slow
-    return dict(zip(des_reg["fields"], value))
+    return des_reg.decode(buffer)
 
 
 def decoder_factory(fileds_def):
     key, high_bits = zip(*fileds_def)
-    # check register definition is 64bits aligned.
-    assert all(64 * x in high_bits for x in range(1, high_bits[-1] // 64 + 1))
     bits_width = np.diff(high_bits, prepend=0)
 
+    # ctypes bitfields can not cross the 64bits storage units, read the fields
+    # which are not 64bits aligned from a python integer instead.
+    if not all(64 * x in high_bits for x in range(1, high_bits[-1] // 64 + 1)):
+        fields = tuple(
+            (k, int(h - w), (1 << int(w)) - 1)
+            for k, h, w in zip(key, high_bits, bits_width)
+        )
+        length = (high_bits[-1] + 7) // 8
+
+        class REG:
+            @staticmethod
+            def decode(buffer):
+                value = int.from_bytes(buffer[:length], "little")
+                return {k: (value >> l) & m for k, l, m in fields}
+
+        return REG
+
+    get_fields = operator.attrgetter(*key)
+
     class REG(ctypes.Structure):
         _fields_ = [(k, ctypes.c_uint64, v) for k, v in zip(key, bits_width)]
 
         def asdict(self):
-            return {field[0]: getattr(self, field[0]) for field in self._fields_}
+            return dict(zip(key, get_fields(self)))
+
+        @classmethod
+        def decode(cls, buffer):
+            return cls.from_buffer_copy(buffer).asdict()
 
         def __repr__(self):
             return str(self.asdict())
@@ -94,7 +107,7 @@ class InsBase:
         "cmd_id_dep",
     )
 
-    def _is_comp(self, cmd_bits):
+    def _is_comp(self, cmd_buf):
         raise NotImplementedError(self.__class__)
 
     def _decode(self):
@@ -112,13 +125,14 @@ class InsBase:
         }
 
     @classmethod
-    def is_comp(cls, cmd_bits):
-        return cls._is_comp(cls, cmd_bits)
+    def is_comp(cls, cmd_buf):
+        return cls._is_comp(cls, cmd_buf)
 
     @classmethod
-    def decode(cls, cmd_bits):
+    def decode(cls, cmd_buf):
+        # cmd is a view of the command buffer, no copy
         cls = cls()
-        cls.cmd = cmd_bits[: cls.length]
+        cls.cmd = np.frombuffer(cmd_buf, np.uint8, cls.length // 8)
         cls._cache = {}
         cls._decode()
         return cls
@@ -153,7 +167,7 @@ class InsBase:
         return (self.cmd == other.cmd).all()
 
     def __hash__(self):
-        return hash(str(self.cmd))
+        return hash(self.cmd.tobytes())
 
     def __repr__(self):
         return self.description
@@ -255,16 +269,6 @@ def get_dtype(prec, sign=1):  # unsigned -> 0; sign -> 1
     return DType(prec + 8 + (sign == 1) * 8)
 
 
-def bf16_to_fp32(d_bf16):
-    assert d_bf16.dtype == np.uint16
-    s = d_bf16.shape
-    d_bf16 = d_bf16.ravel()
-    d_fp32 = np.empty_like(d_bf16, dtype=np.float32)
-    v_ui16 = d_fp32.view(np.uint16)
-    v_ui16[1::2] = d_bf16
-    return d_fp32.reshape(s)
-
-
 to_np_dtype = {
     DType.si8: np.int8,
     DType.ui8: np.uint8,
@@ -11,11 +11,25 @@
 try:
     from .regdef_1684 import tiu_reg_def, dma_reg_def
     from .opparam_1684 import opparam_converter
-    from .op_support import packbits, TIUBase, DMABase, NamedDict, decode_reg
+    from .op_support import (
+        read_bits,
+        decoder_factory,
+        TIUBase,
+        DMABase,
+        NamedDict,
+        decode_reg,
+    )
 except:
     from regdef_1684 import tiu_reg_def, dma_reg_def
     from opparam_1684x import opparam_converter
-    from op_support import packbits, TIUBase, DMABase, NamedDict, decode_reg
+    from op_support import (
+        read_bits,
+        decoder_factory,
+        TIUBase,
+        DMABase,
+        NamedDict,
+        decode_reg,
+    )
 
 # global data and type
 # ------------------------------------------------------------
@@ -28,9 +42,8 @@ dma_sys = None
 # registry function
 # ------------------------------------------------------------
 def base_registry(cmd_type, reg_def, cls):
-    fields, bits = zip(*reg_def)
     # high bit is the upper bit (open interval).
-    setattr(cls, "reg_def", {"fields": fields, "high_bit": bits})
+    setattr(cls, "reg_def", decoder_factory(reg_def))
     class_name = cls.__name__
     cmd_type.setdefault(cls.opcode, set()).add(cls)
     if class_name in opparam_converter:
@@ -62,12 +75,12 @@ class tiu_base(TIUBase):
         self.cmd_id_dep = self.reg.cmd_id_gdma
         self.op_name = self.eu_type[self.reg.tsk_eu_typ]
 
-    def _is_comp(self, cmd_bits):
-        if cmd_bits.size < self.length:
+    def _is_comp(self, cmd_buf):
+        if len(cmd_buf) * 8 < self.length:
             return False
-        if packbits(cmd_bits[self.opcode_bits[0] : self.opcode_bits[1]]) != self.opcode:
+        if read_bits(cmd_buf, *self.opcode_bits) != self.opcode:
             return False
-        if packbits(cmd_bits[self.eu_bits[0] : self.eu_bits[1]]) not in self.eu_type:
+        if read_bits(cmd_buf, *self.eu_bits) not in self.eu_type:
             return False
         return True
 
@@ -344,12 +357,12 @@ class dma_base(DMABase):
         if self.sp_fun:
             self.op_name = self.sp_fun[self.reg.special_func]
 
-    def _is_comp(self, cmd_bits):
-        if cmd_bits.size < self.length:
+    def _is_comp(self, cmd_buf):
+        if len(cmd_buf) * 8 < self.length:
             return False
-        if packbits(cmd_bits[self.opcode_bits[0] : self.opcode_bits[1]]) != self.opcode:
+        if read_bits(cmd_buf, *self.opcode_bits) != self.opcode:
             return False
-        sp_fun_id = packbits(cmd_bits[self.fun_bits[0] : self.fun_bits[1]])
+        sp_fun_id = read_bits(cmd_buf, *self.fun_bits)
         if self.sp_fun and (sp_fun_id not in self.sp_fun):
             return False
         return True
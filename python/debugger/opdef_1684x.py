@@ -11,11 +11,27 @@
 try:
     from . import regdef_1684x
     from .opparam_1684x import opparam_converter, NPU_NUM, EU_NUM
-    from .op_support import packbits, TIUBase, DMABase, NamedDict, decode_reg, ALIGN
+    from .op_support import (
+        read_bits,
+        decoder_factory,
+        TIUBase,
+        DMABase,
+        NamedDict,
+        decode_reg,
+        ALIGN,
+    )
 except:
     import regdef_1684x
     from opparam_1684x import opparam_converter, NPU_NUM, EU_NUM
-    from op_support import packbits, TIUBase, DMABase, NamedDict, decode_reg, ALIGN
+    from op_support import (
+        read_bits,
+        decoder_factory,
+        TIUBase,
+        DMABase,
+        NamedDict,
+        decode_reg,
+        ALIGN,
+    )
 
 # global data and type
 # ------------------------------------------------------------
@@ -27,9 +43,9 @@ dma_cls = dict()
 # ------------------------------------------------------------
 def base_registry(cmd_type, sheet_name, cls):
     attr = regdef_1684x.reg_def[sheet_name]
-    fields, bits = zip(*attr)
+    _, bits = zip(*attr)
     # high bit is the upper bit (open interval).
-    setattr(cls, "reg_def", {"fields": fields, "high_bit": bits})
+    setattr(cls, "reg_def", decoder_factory(attr))
     setattr(cls, "length", bits[-1])
     cmd_type.setdefault(cls.opcode, set()).add(cls)
     if sheet_name in opparam_converter:
@@ -67,14 +83,14 @@ class tiu_base(TIUBase):
         self.cmd_id_dep = self.reg.cmd_id_dep
         self.op_name = self.eu_type[self.reg.tsk_eu_typ]
 
-    def _is_comp(self, cmd_reg):
-        if cmd_reg.size < self.length:
+    def _is_comp(self, cmd_buf):
+        if len(cmd_buf) * 8 < self.length:
             return False
-        if self.short_cmd is not None and bool(cmd_reg[0]) != self.short_cmd:
+        if self.short_cmd is not None and bool(cmd_buf[0] & 1) != self.short_cmd:
             return False
-        if packbits(cmd_reg[self.opcode_bits[0] : self.opcode_bits[1]]) != self.opcode:
+        if read_bits(cmd_buf, *self.opcode_bits) != self.opcode:
             return False
-        if packbits(cmd_reg[self.eu_bits[0] : self.eu_bits[1]]) not in self.eu_type:
+        if read_bits(cmd_buf, *self.eu_bits) not in self.eu_type:
             return False
         return True
 
@@ -633,14 +649,14 @@ class dma_base(DMABase):
         if self.sp_fun:
             self.op_name = self.sp_fun[self.reg.cmd_special_function]
 
-    def _is_comp(self, cmd_reg):
-        if cmd_reg.size < self.length:
+    def _is_comp(self, cmd_buf):
+        if len(cmd_buf) * 8 < self.length:
             return False
-        if self.short_cmd is not None and bool(cmd_reg[3]) != self.short_cmd:
+        if self.short_cmd is not None and bool(cmd_buf[0] & 8) != self.short_cmd:
             return False
-        if packbits(cmd_reg[self.opcode_bits[0] : self.opcode_bits[1]]) != self.opcode:
+        if read_bits(cmd_buf, *self.opcode_bits) != self.opcode:
             return False
-        sp_fun_id = packbits(cmd_reg[self.fun_bits[0] : self.fun_bits[1]])
+        sp_fun_id = read_bits(cmd_buf, *self.fun_bits)
         if self.sp_fun and (sp_fun_id not in self.sp_fun):
             return False
         return True
@@ -18,7 +18,8 @@ import onnxsim.onnx_simplifier as onnxsim
 from utils.preprocess import get_preprocess_parser, preprocess
 from utils.mlir_parser import *
 from utils.misc import *
-from tools.model_runner import is_dynamic_model, get_chip_from_model, round_away_from_zero, fp32_to_bf16, bf16_to_fp32
+from tools.model_runner import is_dynamic_model, get_chip_from_model, round_away_from_zero
+from utils.dtype_convert import fp32_to_bf16, bf16_to_fp32
 
 
 
@@ -12,10 +12,7 @@ from .npz_statistic import npz_statistic
 from .npz_cali_test import npz_cali_test
 import numpy as np
 import sys
-import struct
-
-def bf16_to_fp32(bf16_value):
-    return struct.unpack('<f', struct.pack('<HH', 0, bf16_value))[0]
+from utils.dtype_convert import bf16_to_fp32
 
 def get_npz_shape(args):
     if (len(args) < 2):
@@ -102,16 +99,11 @@ def npz_bf16_to_fp32(args):
     npz_in = np.load(args[0])
     npz_out = {}
     for s in npz_in:
-        bf16_arr = npz_in[s]
-        fp32_arr = np.empty_like(bf16_arr, dtype=np.float32)
-
-        for x, y in np.nditer([bf16_arr, fp32_arr], op_flags=['readwrite']):
-          if npz_in[s].dtype == np.float32:
-            y[...] = x
-          else:
-            y[...] = bf16_to_fp32(x)
-
-        npz_out[s] = fp32_arr
+        arr = npz_in[s]
+        if arr.dtype == np.float32:
+            npz_out[s] = arr
+        else:
+            npz_out[s] = bf16_to_fp32(arr.astype(np.uint16))
 
     np.savez(args[1], **npz_out)
 
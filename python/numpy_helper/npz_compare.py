@@ -12,11 +12,13 @@ from __future__ import division
 import numpy as np
 import sys
 import argparse
-import struct
+from utils.dtype_convert import bf16_to_fp32
 from .tensor_compare import TensorCompare, TensorCompareStats
-import multiprocessing
+import os
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-import gc
 
 
 def parse_args(args_list):
@@ -41,32 +43,13 @@ def parse_args(args_list):
     parser.add_argument("--save", type=str, help="Save result as a csv file")
     parser.add_argument("--per_axis_compare", type=int, default=-1,
                         help="Compare along axis, usually along axis 1 as per-channel")
+    parser.add_argument("--all", action='store_true',
+                        help="Compare every tensor, by default at most 200 evenly picked ones")
     args = parser.parse_args(args_list)
     # yapf: enable
     return args
 
 
-def bf16_to_fp32(d_bf16):
-    s = d_bf16.shape
-    d_bf16 = d_bf16.flatten()
-    assert d_bf16.dtype == np.uint16
-    d_fp32 = np.empty_like(d_bf16, dtype=np.float32)
-    for i in range(len(d_bf16)):
-        d_fp32[i] = struct.unpack('<f', struct.pack('<HH', 0, d_bf16[i]))[0]
-    return d_fp32.reshape(s)
-
-
-def fp32_to_bf16(d_fp32):
-    s = d_fp32.shape
-    d_fp32 = d_fp32.flatten()
-    assert d_fp32.dtype == np.float32
-    d_bf16 = np.empty_like(d_fp32, dtype=np.uint16)
-    for i in range(len(d_bf16)):
-        bytes = struct.pack('f', d_fp32[i])
-        d_bf16[i] = struct.unpack('<H', struct.pack('BB', bytes[2], bytes[3]))[0]
-    return d_bf16.reshape(s)
-
-
 def crop_array(data, shape):
     slices = [slice(0, dim) for dim in shape]
     return data[tuple(slices)]
@@ -113,12 +96,55 @@ def dequantize(d1, threshold):
     return d1
 
 
-def compare_one_array(tc, npz1, npz2, name, verbose, lock, dic, int8_tensor_close,
-                      per_axis_compare):
-    lock.acquire()
+class NpzMmap:
+    # Read-only view of a npz file. Members stored without compression (np.savez)
+    # are memory-mapped in place, compressed ones are read when accessed.
+
+    def __init__(self, file):
+        self.file = file
+        self.npz = np.load(file)
+        self.files = self.npz.files
+        self.arrays = {}
+        self.lock = threading.Lock()
+        with zipfile.ZipFile(file) as zf, open(file, 'rb') as f:
+            for info in zf.infolist():
+                name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+                if info.compress_type != zipfile.ZIP_STORED or name not in self.files:
+                    continue
+                # data starts after the local header, whose extra field may differ
+                # from the one of the central directory
+                f.seek(info.header_offset + 26)
+                name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+                f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if dtype.hasobject:
+                    continue
+                if np.prod(shape) == 0:
+                    self.arrays[name] = np.zeros(shape, dtype)
+                    continue
+                self.arrays[name] = np.memmap(file, dtype=dtype, mode='r', offset=f.tell(),
+                                              shape=shape, order='F' if fortran_order else 'C')
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __getitem__(self, name):
+        if name in self.arrays:
+            return self.arrays[name]
+        with self.lock:
+            return self.npz[name]
+
+    def get(self, name, default=None):
+        return self[name] if name in self.files else default
+
+
+def compare_one_array(tc, npz1, npz2, name, verbose, int8_tensor_close, per_axis_compare):
     d1 = npz1.get(name)
     d2 = npz2.get(name)
-    lock.release()
     try:
         # dirty hack for NonMaxSuppression
         # onnx and bmodel can get correct shape, but top/tpu always get largest shape
@@ -131,12 +157,8 @@ def compare_one_array(tc, npz1, npz2, name, verbose, lock, dic, int8_tensor_clos
     except:
         print("Error: {} in two npz file is not same shape. {} v.s. {}".format(
             name, d1.shape, d2.shape))
-        result = (False, tc.NOT_MATCH, {}, None)
-        dic[name] = result
-        return result
-    result = tc.compare(d1, d2, verbose, int8_tensor_close, per_axis_compare)
-    dic[name] = result
-    return result
+        return (False, tc.NOT_MATCH, {}, None)
+    return tc.compare(d1, d2, verbose, int8_tensor_close, per_axis_compare)
 
 
 def print_result_one_array(tc, npz1, name, dic, verbose, per_axis_compare):
@@ -145,8 +167,7 @@ def print_result_one_array(tc, npz1, name, dic, verbose, per_axis_compare):
 
 
 def npz_compare(args_list):
-    lock = multiprocessing.Lock()
-    dic = multiprocessing.Manager().dict()
+    dic = {}
     args = parse_args(args_list)
     f1 = args.target_file
     f2 = args.ref_file
@@ -166,8 +187,8 @@ def npz_compare(args_list):
     quant_types = {}
 
     int8_tensor_close = args.int8_tensor_close
-    npz1 = np.load(f1)
-    npz2 = np.load(f2)
+    npz1 = NpzMmap(f1)
+    npz2 = NpzMmap(f2)
     tc = TensorCompare(close_order_tol=3,
                        cosine_similarity_tol=tolerance[0],
                        euclidean_similarity_tol=tolerance[1],
@@ -189,36 +210,34 @@ def npz_compare(args_list):
     stats = TensorCompareStats()
 
     names_list = list(names)  # deep copy
-    if len(names_list) > 200:
+    if len(names_list) > 200 and not args.all:
         step = len(names_list) // 200
         if step > 1:
             names_list = names_list[::step]
         if names[-1] not in names_list:
             # last compare is very important
             names_list.append(names[-1])
-    process_number = min(multiprocessing.cpu_count(), 8)
+        print("compare {} of {} tensors, use --all to compare all of them".format(
+            len(names_list), len(names)))
+    # numpy releases the GIL in the heavy parts, and threads read the mapped files
+    # directly instead of copying tensors to child processes
+    worker_number = min(os.cpu_count() or 1, 8)
     if args.per_axis_compare >= 0:
-        process_number = 1
-
-    pbar = tqdm(names, total=len(names_list), position=0, leave=True)
-    while (len(names_list) > 0):
-        compare_process_name_list = names_list[:process_number]
-        names_list = names_list[process_number:]  # remove done name
-        # take process number names
-        # take name which will do compare
-        processes = []
-        for name in compare_process_name_list:
+        worker_number = 1
+
+    pbar = tqdm(names_list, total=len(names_list), position=0, leave=True)
+    with ThreadPoolExecutor(max_workers=worker_number) as executor:
+        futures = {
+            executor.submit(compare_one_array, tc, npz1, npz2, name, args.verbose,
+                            int8_tensor_close, args.per_axis_compare): name
+            for name in names_list
+        }
+        for future in as_completed(futures):
+            name = futures[future]
             pbar.set_description("compare {}".format(name))
             pbar.update(1)
-            p = multiprocessing.Process(target=compare_one_array,
-                                        args=(tc, npz1, npz2, name, args.verbose, lock, dic,
-                                              int8_tensor_close, args.per_axis_compare))
-            processes.append(p)
-            p.start()
-
-        for j in processes:
-            j.join()
-        gc.collect()
+            dic[name] = future.result()
+    pbar.close()
 
     for name in names:
         if dic.get(name) == None:
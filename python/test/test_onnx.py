@@ -257,6 +257,7 @@ class ONNX_IR_TESTER(object):
             #f32 mode works finely
             #"If2":               (self.test_If_v2,    N, Y, N, N)
             #"Loop" :            (self.test_Loop,    Y, N, N)
+            "IfSameConst":      (self.test_IfSameConst,    N, Y, N, N),
         }
         # yapf: enable
 
@@ -5251,6 +5252,46 @@ class ONNX_IR_TESTER(object):
         graph_def = make_graph([rsum, cond, if_node], "if", [X, Y, K], [Z], [zero, axes])
         self.onnx_and_test(graph_def)
 
+    def test_IfSameConst(self, case_name):
+        # the same constant in both branches and the main graph, a weight op must not be
+        # shared out of its region; only the f32 top mlir is checked
+        from onnx.helper import (make_node, make_graph, make_tensor_value_info)
+        shape = [5, 5]
+        const_data = np.random.rand(*shape).astype(np.float32)
+
+        def const_node(output):
+            return make_node('Constant', [], [output],
+                             value=helper.make_tensor(name=output,
+                                                      data_type=TensorProto.FLOAT,
+                                                      dims=const_data.shape,
+                                                      vals=const_data.flatten()))
+
+        X = make_tensor_value_info('X', TensorProto.FLOAT, shape)
+        Z = make_tensor_value_info('Z', TensorProto.FLOAT, shape)
+        axes = helper.make_tensor('axes', TensorProto.INT64, [2], [0, 1])
+        zero = helper.make_tensor('zero', TensorProto.FLOAT, [1], [0])
+        rsum = make_node('ReduceSum', ['X', 'axes'], ['rsum'], keepdims=0)
+        cond = make_node('Greater', ['rsum', 'zero'], ['cond'])
+        then_out = make_tensor_value_info('then_out', TensorProto.FLOAT, shape)
+        then_body = make_graph(
+            [const_node('then_c'),
+             make_node('Add', ['X', 'then_c'], ['then_out'])], 'then_body', [], [then_out])
+        else_out = make_tensor_value_info('else_out', TensorProto.FLOAT, shape)
+        else_body = make_graph(
+            [const_node('else_c'),
+             make_node('Sub', ['X', 'else_c'], ['else_out'])], 'else_body', [], [else_out])
+        if_node = make_node("If", ["cond"], ["if_out"],
+                            then_branch=then_body,
+                            else_branch=else_body)
+        mul_node = make_node('Mul', ['if_out', 'main_c'], ['Z'])
+        graph_def = make_graph([rsum, cond, if_node, const_node('main_c'), mul_node],
+                               case_name, [X], [Z], [axes, zero])
+        for sign in [1, -1]:
+            input_data = {'X': sign * np.random.rand(*shape).astype(np.float32)}
+            onnx_outs, top_mlir_outs, _, _ = self.onnx_convert(input_data, graph_def, case_name)
+            self.compare(onnx_outs['Z'].ravel(), list(top_mlir_outs.values())[-1].ravel())
+        print("Success: ONNX outs and Mlir outs are equal\n")
+
     def test_Loop(self, case_name):
         from onnx import numpy_helper
         from onnx.helper import (make_node, make_graph, make_model, make_tensor_value_info)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import numpy as np
+from numpy_helper.tensor_compare import TensorCompare
+
+# (shape, per_axis_compare), the trailing axis ones give an inner dim of ()
+cases = [
+    ((1, ), 0),
+    ((1, 1), 1),
+    ((4, ), 0),
+    ((2, 3, 5), 2),
+    ((2, 3, 5), 1),
+    ((2, 3, 5), -1),
+]
+
+
+def check(shape, axis, noise):
+    # the fused float32 path gives the same verdict as the per channel loop, run on float64
+    tc = TensorCompare()
+    d1 = np.random.rand(*shape).astype(np.float32)
+    d2 = (d1 + noise * np.random.randn(*shape)).astype(np.float32)
+    fused = tc.compare(d1.copy(), d2.copy(), False, True, axis)
+    loop = tc.compare(d1.astype(np.float64), d2.astype(np.float64), False, True, axis)
+    assert fused[:3] == loop[:3], (shape, axis, noise, fused[:3], loop[:3])
+
+
+def test_tensor_compare():
+    np.random.seed(0)
+    for shape, axis in cases:
+        for noise in [0, 1e-6, 1e-2, 1.0]:
+            check(shape, axis, noise)
+
+
+if __name__ == "__main__":
+    test_tensor_compare()
+    print("Success: TensorCompare cases passed")
@@ -9,18 +9,19 @@
 # ==============================================================================
 from debugger.context import Context
 import debugger.disassembler as dis
+import numpy as np
 
 
 def decode_tiu_file(tiu_file, device):
-    tiu = dis.read_file_to_bits(tiu_file)
+    tiu = dis.read_file(tiu_file)
     context = Context(device.upper())
-    return context.decoder.decode_tiu_bits(tiu)
+    return context.decoder.decode_tiu_buf(tiu)
 
 
 def decode_dma_file(dma_file, device):
-    dma = dis.read_file_to_bits(dma_file)
+    dma = dis.read_file(dma_file)
     context = Context(device.upper())
-    return context.decoder.decode_dma_bits(dma)
+    return context.decoder.decode_dma_buf(dma)
 
 
 def BModel2MLIR(bmodel_file):
@@ -69,7 +70,9 @@ def unified_diff(a, b, fromfile="", tofile="", n=3, format="mlir"):
     fmt_op = {
         "raw": lambda op: str(op.attr),
         "mlir": lambda op: str(op),
-        "bits": lambda op: "".join((str(x) for x in op.cmd)),
+        "bits": lambda op: "".join(
+            (str(x) for x in np.unpackbits(op.cmd, bitorder="little"))
+        ),
     }
     fmt = fmt_op[format]
 
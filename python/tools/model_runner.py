@@ -12,9 +12,11 @@ import importlib
 import numpy as np
 import argparse
 import os
-import struct
+import glob
 import shutil
+from collections import OrderedDict
 from utils.misc import str2bool
+from utils.dtype_convert import bf16_to_fp32, fp32_to_bf16
 
 
 def round_away_from_zero(x):
@@ -22,27 +24,6 @@ def round_away_from_zero(x):
     return np.sign(x) * a
 
 
-def bf16_to_fp32(d_bf16):
-    s = d_bf16.shape
-    d_bf16 = d_bf16.flatten()
-    assert d_bf16.dtype == np.uint16
-    d_fp32 = np.empty_like(d_bf16, dtype=np.float32)
-    for i in range(len(d_bf16)):
-        d_fp32[i] = struct.unpack('<f', struct.pack('<HH', 0, d_bf16[i]))[0]
-    return d_fp32.reshape(s)
-
-
-def fp32_to_bf16(d_fp32):
-    s = d_fp32.shape
-    d_fp32 = d_fp32.flatten()
-    assert d_fp32.dtype == np.float32
-    d_bf16 = np.empty_like(d_fp32, dtype=np.uint16)
-    for i in range(len(d_bf16)):
-        bytes = struct.pack('f', d_fp32[i])
-        d_bf16[i] = struct.unpack('<H', struct.pack('BB', bytes[2], bytes[3]))[0]
-    return d_bf16.reshape(s)
-
-
 def show_fake_cmd(in_npz: str, model: str, out_npz: str):
     print("[CMD]: model_runner.py --input {} --model {} --output {}".format(in_npz, model, out_npz))
 
@@ -54,6 +35,70 @@ def get_chip_from_model(model_file: str) -> str:
     return chip
 
 
+class SessionCache:
+    # Loaded models kept warm across calls. A session is keyed by the model path and
+    # its mtime, so rebuilding the model reloads it. When the estimated footprint is
+    # over max_bytes, the least recently used sessions are dropped.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()  # key -> [session, nbytes]
+
+    @staticmethod
+    def key(kind: str, model_file: str, *extra):
+        path = os.path.abspath(model_file)
+        return (kind, path, os.path.getmtime(path)) + extra
+
+    def get(self, key):
+        if key not in self.sessions:
+            return None
+        self.sessions.move_to_end(key)
+        return self.sessions[key][0]
+
+    def put(self, key, session, nbytes: int):
+        # an older build of the same model is never used again
+        for k in [k for k in self.sessions if k[:2] == key[:2]]:
+            del self.sessions[k]
+        self.sessions[key] = [session, nbytes]
+        self.shrink()
+
+    def update_size(self, key, nbytes: int):
+        if key in self.sessions:
+            self.sessions[key][1] = nbytes
+            self.sessions.move_to_end(key)
+            self.shrink()
+
+    def shrink(self):
+        # the most recent session always stays
+        while len(self.sessions) > 1 and self.total_bytes() > self.max_bytes:
+            self.sessions.popitem(last=False)
+
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes in self.sessions.values())
+
+    def clear(self, kind: str = None):
+        for k in [k for k in self.sessions if kind is None or k[0] == kind]:
+            del self.sessions[k]
+
+
+session_cache = SessionCache(4 << 30)
+
+
+def link_cmodel(chip: str):
+    # trick for runtime link chip cmodel
+    lib_so = 'libcmodel_1684x.so'
+    if chip == 'BM1686' or chip == 'CV186X':
+        lib_so = 'libcmodel_1686.so'
+    elif chip == 'BM1684':
+        lib_so = 'libcmodel_1684.so'
+    lib_dir = os.path.join(os.environ.get("TPUC_ROOT", ""), "lib")
+    link = os.path.join(lib_dir, "libcmodel.so")
+    if os.path.islink(link) and os.readlink(link) == os.path.join(lib_dir, lib_so):
+        return
+    cmd = 'ln -sf $TPUC_ROOT/lib/{} $TPUC_ROOT/lib/libcmodel.so'.format(lib_so)
+    os.system(cmd)
+
+
 def pack_bmodel_context_generator(model_file, net):
     out_dir = model_file.rsplit(".", maxsplit=1)[0]
     os.makedirs(out_dir, exist_ok=True)
@@ -73,29 +118,30 @@ def model_inference(inputs: dict, model_file: str, dump_all = True) -> dict:
     is_cv18xx = False
     if model_file.endswith(".bmodel"):
         pyruntime = pyruntime + "bm"
-        chip = get_chip_from_model(model_file)
-        # trick for runtime link chip cmodel
-        lib_so = 'libcmodel_1684x.so'
-        if chip == 'BM1686' or chip == 'CV186X':
-            lib_so = 'libcmodel_1686.so'
-        elif chip == 'BM1684':
-            lib_so = 'libcmodel_1684.so'
-        cmd = 'ln -sf $TPUC_ROOT/lib/{} $TPUC_ROOT/lib/libcmodel.so'.format(lib_so)
-        os.system(cmd)
+        key = SessionCache.key("bmodel", model_file)
     elif model_file.endswith(".cvimodel"):
         pyruntime = pyruntime + "cvi"
         is_cv18xx = True
+        key = SessionCache.key("cvimodel", model_file, dump_all)
     else:
         raise RuntimeError("not support modle file:{}".format(model_file))
-    pyruntime = importlib.import_module(pyruntime)
 
     outputs = dict()
-    if not is_cv18xx:
-        model = pyruntime.Model(model_file)
-        net = model.Net(model.networks[0])
-    else:
-        model = pyruntime.Model(model_file, output_all_tensors = dump_all)
-        net = model
+    session = session_cache.get(key)
+    if session is None:
+        if not is_cv18xx:
+            chip = get_chip_from_model(model_file)
+            link_cmodel(chip)
+            pyruntime = importlib.import_module(pyruntime)
+            model = pyruntime.Model(model_file)
+            net = model.Net(model.networks[0])
+        else:
+            pyruntime = importlib.import_module(pyruntime)
+            model = pyruntime.Model(model_file, output_all_tensors = dump_all)
+            net = model
+        session = (model, net)
+        session_cache.put(key, session, os.path.getsize(model_file))
+    model, net = session
     input_shapes = []
     only_one = len(inputs) == 1
     if only_one and len(net.inputs) != 1:
@@ -197,15 +243,33 @@ def model_inference(inputs: dict, model_file: str, dump_all = True) -> dict:
 g_mlir_module = None
 
 
+class MlirSession:
+    # a loaded mlir module, its graph is only parsed when needed
+
+    def __init__(self, mlir_file: str):
+        import pymlir
+        self.mlir_file = mlir_file
+        self.module = pymlir.module()
+        self.module.load(mlir_file)
+        self._parser = None
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            from utils.mlir_parser import MlirParser
+            self._parser = MlirParser(self.mlir_file)
+        return self._parser
+
+
 def mlir_inference(inputs: dict, mlir_file: str, dump_all: bool = True, debug=None) -> dict:
-    import pymlir
-    from utils.mlir_parser import MlirParser
     global g_mlir_module
-    if g_mlir_module != None:
-        g_mlir_module = None
-    g_mlir_module = pymlir.module()
-    g_mlir_module.load(mlir_file)
-    parser = MlirParser(mlir_file)
+    key = SessionCache.key("mlir", mlir_file)
+    session = session_cache.get(key)
+    is_new = session is None
+    if is_new:
+        session = MlirSession(mlir_file)
+        session_cache.put(key, session, os.path.getsize(mlir_file))
+    g_mlir_module = session.module
     only_one = len(inputs) == 1
     if only_one:
         assert (len(g_mlir_module.input_names) == 1)
@@ -220,19 +284,24 @@ def mlir_inference(inputs: dict, mlir_file: str, dump_all: bool = True, debug=No
         else:
             g_mlir_module.set_tensor(name, input.astype(np.float32))
     g_mlir_module.invoke()
+    # tensors share memory with the module, the ones returned are copied as it is kept for
+    # later calls
     tensors = g_mlir_module.get_all_tensor()
+    if is_new:
+        session_cache.update_size(key,
+                                  os.path.getsize(mlir_file) + sum(v.nbytes for v in tensors.values()))
     if dump_all:
-        return tensors
+        return {k: np.array(v) for k, v in tensors.items()}
     outputs = dict()
     temp_file_name = g_mlir_module.get_tempfile()
     for name in g_mlir_module.output_names:
-        outputs[name] = tensors[name]
+        outputs[name] = np.array(tensors[name])
         # assume output of op has the same name
-        op_type = parser.get_op_type_by_op_name(name)
+        op_type = session.parser.get_op_type_by_op_name(name)
         if op_type == "tpu.Cast":
-            pre_op = parser.get_pre_op_by_op_name(name)[0]
+            pre_op = session.parser.get_pre_op_by_op_name(name)[0]
             if pre_op in tensors:
-                outputs[pre_op] = tensors[pre_op]
+                outputs[pre_op] = np.array(tensors[pre_op])
             else:
                 #if file exists,read tensor for compare
                 if temp_file_name!="Default" and os.path.isfile(temp_file_name):
@@ -246,6 +315,7 @@ def mlir_inference(inputs: dict, mlir_file: str, dump_all: bool = True, debug=No
 def free_mlir_module():
     global g_mlir_module
     g_mlir_module = None
+    session_cache.clear("mlir")
 
 
 def onnx_inference(inputs: dict, onnx_file: str, dump_all: bool = True) -> dict:
@@ -441,38 +511,68 @@ def torch_inference(inputs: dict, model: str, dump_all: bool = True) -> dict:
     return outputs
 
 
+def get_input_files(input: str) -> list:
+    # a npz file, a comma separated list of them, or a directory holding them
+    files = []
+    for item in input.split(','):
+        item = item.strip()
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, "*.npz"))))
+        elif item:
+            files.append(item)
+    if not files:
+        raise RuntimeError("no input npz found in:{}".format(input))
+    return files
+
+
+def get_output_file(output: str, input_file: str, input_num: int) -> str:
+    if input_num == 1:
+        return output
+    # one output per input, named after it
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return "{}_{}.npz".format(os.path.splitext(output)[0], stem)
+
+
 if __name__ == '__main__':
     # yapf: disable
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", required=True, help="input npz file")
+    parser.add_argument("--input", required=True,
+                        help="input npz file, a comma separated list or a directory of npz files")
     parser.add_argument("--model", type=str, required=True,
                         help="mlir/pytorch/onnx/tflie/bmodel/prototxt file.")
     parser.add_argument("--weight", type=str, default="", help="caffemodel for caffe")
-    parser.add_argument("--output", default='_output.npz', help="output npz file")
+    parser.add_argument("--output", default='_output.npz',
+                        help="output npz file, with several inputs each result is saved to <output>_<input>.npz")
     parser.add_argument("--dump_all_tensors", action='store_true',
                         help="dump all tensors to output file")
+    parser.add_argument("--cache_size", type=int, default=4096,
+                        help="memory (MB) of the models kept loaded between inputs")
     parser.add_argument("--debug", type=str, nargs="?", const="",
                         help="configure the debugging information.")
 
     # yapf: enable
     args = parser.parse_args()
-    data = np.load(args.input)
-    output = dict()
-    if args.model.endswith(".mlir"):
-        output = mlir_inference(data, args.model, args.dump_all_tensors, args.debug)
-    elif args.model.endswith('.onnx'):
-        output = onnx_inference(data, args.model, args.dump_all_tensors)
-    elif args.model.endswith(".tflite"):
-        output = tflite_inference(data, args.model, args.dump_all_tensors)
-    elif args.model.endswith(".prototxt") and args.weight.endswith(".caffemodel"):
-        output = caffe_inference(data, args.model, args.weight, args.dump_all_tensors)
-    elif args.model.endswith(".pt") or args.model.endswith(".pth"):
-        output = torch_inference(data, args.model, args.dump_all_tensors)
-    elif args.model.endswith(".bmodel") or args.model.endswith(".cvimodel"):
-        output = model_inference(data, args.model)
-    else:
-        raise RuntimeError("not support modle file:{}".format(args.model))
-    print("\nSaving ...")
-    if output:
-        np.savez(args.output, **output)
-        print("\nResult saved to:{}".format(args.output))
+    session_cache.max_bytes = args.cache_size << 20
+    input_files = get_input_files(args.input)
+    for input_file in input_files:
+        data = np.load(input_file)
+        output = dict()
+        if args.model.endswith(".mlir"):
+            output = mlir_inference(data, args.model, args.dump_all_tensors, args.debug)
+        elif args.model.endswith('.onnx'):
+            output = onnx_inference(data, args.model, args.dump_all_tensors)
+        elif args.model.endswith(".tflite"):
+            output = tflite_inference(data, args.model, args.dump_all_tensors)
+        elif args.model.endswith(".prototxt") and args.weight.endswith(".caffemodel"):
+            output = caffe_inference(data, args.model, args.weight, args.dump_all_tensors)
+        elif args.model.endswith(".pt") or args.model.endswith(".pth"):
+            output = torch_inference(data, args.model, args.dump_all_tensors)
+        elif args.model.endswith(".bmodel") or args.model.endswith(".cvimodel"):
+            output = model_inference(data, args.model)
+        else:
+            raise RuntimeError("not support modle file:{}".format(args.model))
+        print("\nSaving ...")
+        if output:
+            output_file = get_output_file(args.output, input_file, len(input_files))
+            np.savez(output_file, **output)
+            print("\nResult saved to:{}".format(output_file))
@@ -8,7 +8,12 @@
 #
 # ==============================================================================
 
+import os
+import sys
 import abc
+import glob
+import json
+import hashlib
 import numpy as np
 import argparse
 
@@ -18,6 +23,8 @@ from utils.mlir_parser import *
 from utils.misc import *
 from utils.auto_remove import file_mark, file_clean
 from utils.preprocess import get_preprocess_parser, preprocess
+from utils.compile_cache import CompileCache
+from utils.file_hash import hash_file
 import pymlir
 
 
@@ -227,6 +234,47 @@ def get_model_transform(args):
     return tool
 
 
+def onnx_external_files(model_def):
+    import mmap
+    import onnx
+    # the model is parsed only if it may name external files, its inline weights would be loaded
+    with open(model_def, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m.find(b'location') < 0:
+            return []
+    model = onnx.load(model_def, load_external_data=False)
+    files = set()
+    for tensor in model.graph.initializer:
+        if tensor.data_location == onnx.TensorProto.EXTERNAL:
+            info = dict((x.key, x.value) for x in tensor.external_data)
+            files.add(os.path.join(os.path.dirname(model_def), info['location']))
+    return sorted(files)
+
+
+def transform_cache_key(args):
+    # the model files, the test inputs, the options and the tool: its version and the sources of
+    # the converters and of the validation a hit skips
+    h = hashlib.sha1(pymlir.module().version.encode())
+    options = dict((k, v) for k, v in vars(args).items()
+                   if k not in ['debug', 'no_cache', 'cache_dir', 'cache_size'])
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    files = [args.model_def]
+    if args.model_data:
+        files.append(args.model_data)
+    if args.model_def.endswith('.onnx'):
+        files.extend(onnx_external_files(args.model_def))
+    files.extend(args.test_input)
+    tools_dir = os.path.dirname(os.path.abspath(__file__))
+    for package in ['transform', 'utils', 'numpy_helper']:
+        files.extend(sorted(glob.glob(os.path.join(tools_dir, '..', package, '*.py'))))
+    for tool in ['model_transform.py', 'model_runner.py', 'npz_tool.py']:
+        files.append(os.path.join(tools_dir, tool))
+    for file in files:
+        h.update(file.encode())
+        if os.path.isfile(file):
+            hash_file(file, h)
+    return h.hexdigest()
+
+
 if __name__ == '__main__':
     print("SOPHGO Toolchain {}".format(pymlir.module().version))
     parser = argparse.ArgumentParser()
@@ -252,11 +300,26 @@ if __name__ == '__main__':
                         choices=['','yolov3','yolov5','ssd'], help="add postprocess for model")
     parser.add_argument("--debug", action='store_true', help='to keep all intermediate files for debug')
     parser.add_argument("--mlir", type=str, required=True, help="output mlir model file")
+    parser.add_argument("--no_cache", "--no-cache", action='store_true',
+                        help="don't restore the outputs of a run with the same model and options")
+    parser.add_argument("--cache_dir", default="~/.cache/tpu_mlir/transform", type=str,
+                        help="directory of the transform cache, empty to disable it")
+    parser.add_argument("--cache_size", default=10240, type=int,
+                        help="max size of the transform cache in MB")
     # yapf: enable
     parser = get_preprocess_parser(existed_parser=parser)
     args, unknown_args = parser.parse_known_args()
     if unknown_args:
         args.unknown_params += unknown_args
+    # the intermediate files of --debug are not cached
+    cache, key = None, None
+    if not args.no_cache and not args.debug and args.cache_dir:
+        cache = CompileCache(args.cache_dir, args.cache_size * 2**20)
+        key = transform_cache_key(args)
+        files = cache.restore(key)
+        if files is not None:
+            print("Restored from transform cache {}: {}".format(cache.root, ", ".join(files)))
+            sys.exit(0)
     tool = get_model_transform(args)
     tool.model_transform(args.mlir, args.add_postprocess)
     if args.test_input:
@@ -264,3 +327,11 @@ if __name__ == '__main__':
         tool.model_validate(args.test_input, args.tolerance, args.excepts, args.test_result)
     if not args.debug:
         tool.cleanup()
+    if cache is not None:
+        files = [args.mlir, tool.module_parsered.module_weight_file]
+        if args.test_input:
+            files += [args.model_name + '_in_f32.npz', args.test_result]
+        try:
+            cache.save(key, [f for f in files if os.path.exists(f)])
+        except OSError as e:
+            print("WARNING: transform cache not saved: {}".format(e))
@@ -29,6 +29,21 @@ if __name__ == '__main__':
                         help='Specify histogram bin numer for kld calculate')
     parser.add_argument('-o', '--calibration_table', type=str, help='output threshold table')
     parser.add_argument('--debug_cmd', type=str, default='', help='debug cmd')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='num of processes the calibration samples are split across')
+    parser.add_argument('--shard', type=str, default='0/1',
+                        help='calibrate the k-th of n parts of the samples, as k/n')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='save the state of calibration and tuning every ckpt_interval '
+                        'seconds of debug_cmd (60 by default) for --resume')
+    parser.add_argument('--resume', action='store_true',
+                        help='go on from the checkpoint of an interrupted calibration or tuning, '
+                        'implies --checkpoint')
+    parser.add_argument('--stats_in', type=str, nargs='+', default=[],
+                        help='partial stats files to merge, from --stats_out of other runs')
+    parser.add_argument('--stats_out', type=str, default='',
+                        help='save the partial stats of the next stage instead of the table: '
+                        'min/max without --stats_in, histograms with min/max stats in')
     # yapf: enable
     args = parser.parse_args()
 
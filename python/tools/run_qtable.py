@@ -43,6 +43,14 @@ if __name__ == '__main__':
                         help=argparse.SUPPRESS)
     parser.add_argument('-o', '--quantize_table', required=True,
                         help='output searched bf16 layer table')
+    parser.add_argument('--search', default='sequential', type=str,
+                        choices=['sequential', 'sensitivity'],
+                        help='sequential: set float the layers under min_layer_cos in order; '
+                        'sensitivity: rank the layers by their cos loss and binary search the fewest')
+    parser.add_argument('--ref_cache_dir', default='~/.cache/tpu_mlir/qtable', type=str,
+                        help='directory of the float references kept between runs, \'\' to disable')
+    parser.add_argument('--ref_cache_size', default=4096, type=float,
+                        help='max size of the float reference cache in MB')
     parser.add_argument('--debug_cmd', type=str, default='', help='debug cmd')
 
     # yapf: enable
@@ -50,5 +58,7 @@ if __name__ == '__main__':
     searcher = MixPrecSearcher(args)
     if 'run_bias_correction' in args.debug_cmd:
         searcher.run_bias_correction()
+    elif args.search == 'sensitivity':
+        searcher.run_sensitivity()
     else:
         searcher.run()
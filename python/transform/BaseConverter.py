@@ -5,14 +5,72 @@
 #
 # ==============================================================================
 
+import zipfile
+import hashlib
 import numpy as np
 
 
+class LazyWeight(object):
+    # a f32 weight not read yet, loader gives its data
+    def __init__(self, shape, loader):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.float32)
+        self.loader = loader
+
+    def load(self):
+        data = self.loader()
+        if data.dtype != np.float32 or not data.flags.writeable:
+            data = data.astype(np.float32)
+        return data.reshape(self.shape)
+
+
+class WeightStore(object):
+    # Weights by name. A lazy weight is loaded on its first read and kept from then on, the ones
+    # only written to the weight file are loaded one at a time and never kept.
+
+    def __init__(self):
+        self.data = dict()
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        data = self.data[name]
+        if isinstance(data, LazyWeight):
+            data = data.load()
+            self.data[name] = data
+        return data
+
+    def __setitem__(self, name, data):
+        self.data[name] = data
+
+    def add_lazy(self, name, shape, loader):
+        self.data[name] = LazyWeight(shape, loader)
+
+    def dtype(self, name):
+        return self.data[name].dtype
+
+    def read(self, name):
+        data = self.data[name]
+        return data.load() if isinstance(data, LazyWeight) else data
+
+
 class BaseConverter(object):
 
     def __init__(self):
         self.operands = dict()
-        self.tensors = dict()
+        self.tensors = WeightStore()
+        # weights sharing the weight op of the same data: {alias: name}
+        self.weight_alias = dict()
+        # (shape, type): first weight op, {data hash: weight op}
+        self.weight_first = dict()
+        self.weight_hashes = dict()
         self.shapes = dict()
         self.input_names = list()
         self.output_names = list()
@@ -74,6 +132,14 @@ class BaseConverter(object):
         self.tensors[name] = data
         self.addShape(name, data.shape)
 
+    def addLazyWeight(self, name, shape, loader):
+        # loader gives the data when the weight is first read
+        if name in self.tensors:
+            return self.addWeight(name, loader())
+        shape = list(shape) if len(shape) > 0 else [1]
+        self.tensors.add_lazy(name, shape, loader)
+        self.addShape(name, shape)
+
     def isWeight(self, name):
         if name in self.tensors:
             return True
@@ -109,7 +175,7 @@ class BaseConverter(object):
         if shape and old_shape != shape:
             assert (np.prod(old_shape) == np.prod(shape))
             old_shape = shape
-        ori_type = str(self.tensors[name].dtype)
+        ori_type = str(self.tensors.dtype(name))
         type_dict = {
             'int8': "INT8",
             'uint8': "UINT8",
@@ -120,13 +186,60 @@ class BaseConverter(object):
         }
         if ori_type not in type_dict:
             raise KeyError("type {} not implemented".format(ori_type))
-        op = self.mlir.create_weight_op(name, old_shape, type_dict[ori_type])
+        if name not in self.operands and not self.mlir.insert_point_save_flag:
+            # only weights of the entry block, a weight op in an If/Loop region does not
+            # dominate the uses out of it
+            same = self.getSameWeight(name, (tuple(int(x) for x in old_shape), ori_type))
+            if same is not None:
+                # one weight op for the same data
+                self.weight_alias[name] = same
+                self.mlir.load_weight[name] = self.mlir.load_weight[same]
+        op = self.mlir.create_weight_op(self.weight_alias.get(name, name), old_shape,
+                                        type_dict[ori_type])
         self.addOperand(name, op)
         return op
 
+    def getSameWeight(self, name, key):
+        # the weight op of the same shape, type and data; the data are hashed only when a
+        # shape and type is shared
+        first = self.weight_first.setdefault(key, name)
+        if first == name:
+            return None
+        hashes = self.weight_hashes.setdefault(key, dict())
+        if not hashes:
+            hashes[self.weightHash(first)] = first
+        digest = self.weightHash(name)
+        if digest in hashes:
+            return hashes[digest]
+        hashes[digest] = name
+        return None
+
+    def weightHash(self, name):
+        data = np.ascontiguousarray(self.tensors.read(name))
+        return hashlib.sha1(data.data).hexdigest()
+
+    def checkWeightAlias(self):
+        # an alias is chosen by the data at getWeightOp, weights must not change after it
+        for name, same in self.weight_alias.items():
+            if not np.array_equal(self.tensors.read(name), self.tensors.read(same)):
+                raise RuntimeError("weight {} changed after sharing the weight op of {}".format(
+                    name, same))
+
     def WeightToNpz(self, weight_file):
-        tensor_npz = {}
-        for name in self.tensors:
-            if name in self.operands:
-                tensor_npz[name] = self.tensors[name]
-        np.savez(weight_file, **tensor_npz)
+        # the npz of np.savez, written a tensor at a time
+        self.checkWeightAlias()
+        if not weight_file.endswith('.npz'):
+            weight_file += '.npz'
+        with zipfile.ZipFile(weight_file, mode="w", compression=zipfile.ZIP_STORED,
+                             allowZip64=True) as npz:
+            for name in self.tensors:
+                if name not in self.operands or name in self.weight_alias:
+                    continue
+                with npz.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(self.tensors.read(name)))
+        if self.weight_alias:
+            saved = sum(
+                int(np.prod(self.getShape(name))) * self.tensors.dtype(name).itemsize
+                for name in self.weight_alias)
+            print("{} weights share the data of others, {:.2f} MB saved".format(
+                len(self.weight_alias), saved / 2**20))
@@ -48,6 +48,31 @@ def onnx_dtype(dtype):
     return mapping.TENSOR_TYPE_TO_NP_TYPE[onnx_dtype]
 
 
+# the types stored as their numpy type in external data
+mmap_types = [
+    onnx.TensorProto.FLOAT, onnx.TensorProto.FLOAT16, onnx.TensorProto.DOUBLE,
+    onnx.TensorProto.INT8, onnx.TensorProto.UINT8, onnx.TensorProto.INT16,
+    onnx.TensorProto.UINT16, onnx.TensorProto.INT32, onnx.TensorProto.UINT32,
+    onnx.TensorProto.INT64, onnx.TensorProto.UINT64
+]
+
+
+def weight_loader(tensor, base_dir=""):
+    # the data of the tensors still in external files are memory-mapped
+    def load():
+        info = dict((x.key, x.value) for x in tensor.external_data)
+        if tensor.data_location == onnx.TensorProto.EXTERNAL and "location" in info \
+                and tensor.data_type in mmap_types:
+            return np.memmap(os.path.join(base_dir, info["location"]),
+                             dtype=onnx_dtype(tensor.data_type),
+                             mode="c",
+                             offset=int(info.get("offset", 0)),
+                             shape=tuple(tensor.dims))
+        return numpy_helper.to_array(tensor, base_dir)
+
+    return load
+
+
 def convert_onnx_attribute_proto(attr_proto):
     if attr_proto.HasField('f'):
         return attr_proto.f
@@ -429,11 +454,10 @@ class OnnxConverter(BaseConverter):
         if (is_ok_ and not is_ok):
             print("WARNING: Onnx-sim failed caused by assign input_shape.")
         print("--------------------------------")
-        # add all weight
+        # add all weight, read from the model when used
+        base_dir = os.path.dirname(onnx_file) if isinstance(onnx_file, str) else ""
         for tensor in self.model.graph.initializer:
-            name = tensor.name
-            data = numpy_helper.to_array(tensor).astype(np.float32)
-            self.addWeight(name, data)
+            self.addLazyWeight(tensor.name, tensor.dims, weight_loader(tensor, base_dir))
             # TODO: for quantized onnx, keep the same type
         self.add_shape_info(self.model.graph)
         self.onnx_file = "{}_opt.onnx".format(self.model_name)
@@ -3119,9 +3143,7 @@ class OnnxConverter(BaseConverter):
                 self.addOperand(input.name, input_op)
         # add all weight
         for tensor in graph_node.initializer:
-            name = tensor.name
-            data = numpy_helper.to_array(tensor).astype(np.float32)
-            self.addWeight(name, data)
+            self.addLazyWeight(tensor.name, tensor.dims, weight_loader(tensor))
         self.add_shape_info(graph_node, False)
 
         def NoneAndRaise(node):
@@ -2,6 +2,8 @@ from collections import Counter, defaultdict, OrderedDict
 import onnx
 import onnx.numpy_helper
 import copy
+import time
+import functools
 import numpy as np
 import onnxruntime as rt
 from transform.OnnxOpOptionalAttrs import OnnxOpOptionalAttrGetter
@@ -58,6 +60,151 @@ def get_node_attrs(node) -> dict:
     return attrs
 
 
+def _attr(attrs, name, default=None):
+    return attrs[name] if name in attrs else default
+
+
+def _ints(value):
+    return [int(v) for v in np.asarray(value).flatten()]
+
+
+def _np_dtype(elem_type):
+    dtype = onnx.helper.tensor_dtype_to_np_dtype(elem_type)
+    if dtype == np.object_:
+        raise NotImplementedError("string tensors")
+    return dtype
+
+
+def _div(a, b):
+    if np.issubdtype(a.dtype, np.integer):
+        # truncated to zero as onnxruntime does
+        q = np.abs(a) // np.abs(b)
+        return np.where((a < 0) != (b < 0), -q, q).astype(a.dtype)
+    return a / b
+
+
+def _reshape(inputs, attrs):
+    x, shape = inputs[0], _ints(inputs[1])
+    if not _attr(attrs, "allowzero", 0):
+        shape = [x.shape[i] if s == 0 else s for i, s in enumerate(shape)]
+    return [x.reshape(shape)]
+
+
+def _slice(inputs, attrs):
+    x = inputs[0]
+    if len(inputs) == 1:
+        starts, ends = attrs["starts"], attrs["ends"]
+        axes, steps = _attr(attrs, "axes"), None
+    else:
+        starts, ends = _ints(inputs[1]), _ints(inputs[2])
+        axes = _ints(inputs[3]) if len(inputs) > 3 and inputs[3] is not None else None
+        steps = _ints(inputs[4]) if len(inputs) > 4 and inputs[4] is not None else None
+    axes = list(range(len(starts))) if axes is None else axes
+    steps = [1] * len(starts) if steps is None else steps
+    index = [slice(None)] * x.ndim
+    for start, end, axis, step in zip(starts, ends, axes, steps):
+        index[axis] = slice(int(start), int(end), int(step))
+    return [x[tuple(index)]]
+
+
+def _axes(inputs, attrs):
+    if len(inputs) > 1 and inputs[1] is not None:
+        return tuple(_ints(inputs[1]))
+    axes = _attr(attrs, "axes")
+    return None if axes is None else tuple(axes)
+
+
+def _squeeze(inputs, attrs):
+    axes = _axes(inputs, attrs)
+    return [np.squeeze(inputs[0]) if axes is None else np.squeeze(inputs[0], axes)]
+
+
+def _constant(inputs, attrs):
+    if "value" in attrs:
+        return [onnx.numpy_helper.to_array(attrs["value"])]
+    if "value_float" in attrs:
+        return [np.array(attrs["value_float"], dtype=np.float32)]
+    if "value_floats" in attrs:
+        return [np.array(attrs["value_floats"], dtype=np.float32)]
+    if "value_int" in attrs:
+        return [np.array(attrs["value_int"], dtype=np.int64)]
+    if "value_ints" in attrs:
+        return [np.array(attrs["value_ints"], dtype=np.int64)]
+    raise NotImplementedError("Constant {}".format(list(attrs)))
+
+
+def _constant_of_shape(inputs, attrs):
+    value = onnx.numpy_helper.to_array(attrs["value"]) if "value" in attrs \
+        else np.zeros(1, dtype=np.float32)
+    return [np.full(_ints(inputs[0]), value.flatten()[0], dtype=value.dtype)]
+
+
+def _expand(inputs, attrs):
+    x, shape = inputs[0], _ints(inputs[1])
+    return [np.broadcast_to(x, np.broadcast_shapes(x.shape, tuple(shape))).copy()]
+
+
+def _range(inputs, attrs):
+    start, limit, delta = inputs
+    return [np.arange(start, limit, delta).astype(start.dtype)]
+
+
+def _binary(fn):
+    return lambda inputs, attrs: [fn(inputs[0], inputs[1])]
+
+
+def _unary(fn):
+    return lambda inputs, attrs: [fn(inputs[0])]
+
+
+def _variadic(fn):
+    return lambda inputs, attrs: [functools.reduce(fn, inputs)]
+
+
+# NumPy evaluation of the ops met in the shape computations, (inputs, attrs) -> outputs; the
+# other constant ops are run by onnxruntime
+numpy_evaluators = {
+    "Constant": _constant,
+    "ConstantOfShape": _constant_of_shape,
+    "Identity": _unary(lambda x: x),
+    "Cast": lambda inputs, attrs: [inputs[0].astype(_np_dtype(attrs["to"]))],
+    "Reshape": _reshape,
+    "Flatten": lambda inputs, attrs: [inputs[0].reshape(
+        int(np.prod(inputs[0].shape[:_attr(attrs, "axis", 1)])), -1)],
+    "Squeeze": _squeeze,
+    "Unsqueeze": lambda inputs, attrs: [np.expand_dims(inputs[0], _axes(inputs, attrs))],
+    "Concat": lambda inputs, attrs: [np.concatenate(inputs, axis=attrs["axis"])],
+    "Gather": lambda inputs, attrs: [np.take(inputs[0], inputs[1], axis=_attr(attrs, "axis", 0))],
+    "Slice": _slice,
+    "Transpose": lambda inputs, attrs: [np.transpose(inputs[0], _attr(attrs, "perm"))],
+    "Expand": _expand,
+    "Tile": lambda inputs, attrs: [np.tile(inputs[0], _ints(inputs[1]))],
+    "Range": _range,
+    "Size": lambda inputs, attrs: [np.array(inputs[0].size, dtype=np.int64)],
+    "Where": lambda inputs, attrs: [np.where(*inputs)],
+    "Add": _binary(np.add),
+    "Sub": _binary(np.subtract),
+    "Mul": _binary(np.multiply),
+    "Div": _binary(_div),
+    "Mod": lambda inputs, attrs: [(np.fmod if _attr(attrs, "fmod", 0) else np.mod)(*inputs)],
+    "Equal": _binary(np.equal),
+    "Less": _binary(np.less),
+    "LessOrEqual": _binary(np.less_equal),
+    "Greater": _binary(np.greater),
+    "GreaterOrEqual": _binary(np.greater_equal),
+    "And": _binary(np.logical_and),
+    "Or": _binary(np.logical_or),
+    "Not": _unary(np.logical_not),
+    "Neg": _unary(np.negative),
+    "Abs": _unary(np.abs),
+    "Floor": _unary(np.floor),
+    "Ceil": _unary(np.ceil),
+    "Sqrt": _unary(np.sqrt),
+    "Max": _variadic(np.maximum),
+    "Min": _variadic(np.minimum),
+}
+
+
 class ConstantFolding(object):
     def __init__(self, model):
         self.model = copy.deepcopy(model)
@@ -111,13 +258,6 @@ class ConstantFolding(object):
                 return v
         return None
 
-    @staticmethod
-    def insert_elem(nodes, idx, element):
-        nodes.extend([nodes[-1]])
-        for i in reversed(range(idx + 1, len(nodes) - 1)):
-            nodes[i].CopyFrom(nodes[i - 1])
-        nodes[idx].CopyFrom(element)
-
     @staticmethod
     def get_shape_from_value_info_proto(vinfo):
         return [dim.dim_value for dim in vinfo.type.tensor_type.shape.dim]
@@ -169,76 +309,105 @@ class ConstantFolding(object):
     def is_non_determinstic_node(self, node):
         return node.op_type in ["RandomNormal", "RandomNormalLike", "RandomUniformLike"]
 
-    def get_constant_nodes(self):
-        const_nodes = []
-        dynamic_tensors = []
-        self.const_tensors = [x.name for x in self.model.graph.initializer]
-        self.const_tensors.extend([node.output[0] for node in self.model.graph.node if node.op_type == "Constant"])
-        for node in self.model.graph.node:
+    def get_constant_node_ids(self):
+        const_ids = []
+        dynamic_tensors = set()
+        self.const_tensors = set(x.name for x in self.model.graph.initializer)
+        self.const_tensors.update(
+            [node.output[0] for node in self.model.graph.node if node.op_type == "Constant"])
+        for i, node in enumerate(self.model.graph.node):
             if any(x in dynamic_tensors for x in node.input):
-                dynamic_tensors.extend(node.output)
+                dynamic_tensors.update(node.output)
             elif node.op_type == "Shape":
-                const_nodes.append(node)
-                self.const_tensors.extend(node.output)
+                const_ids.append(i)
+                self.const_tensors.update(node.output)
             elif self.is_dynamic(node):
-                dynamic_tensors.extend(node.output)
+                dynamic_tensors.update(node.output)
             elif self.is_quantizeLinear(node):
                 pass
             elif self.has_subgraph_in_node(node):
                 pass
             elif len(node.input) > 0 and all([x in self.const_tensors for x in node.input]) \
                     and not self.is_non_determinstic_node(node):
-                const_nodes.append(node)
-                self.const_tensors.extend(node.output)
-        return copy.deepcopy(const_nodes)
+                const_ids.append(i)
+                self.const_tensors.update(node.output)
+        return const_ids
 
-    def forward(self, model):
-        input_shapes = {}
+    @staticmethod
+    def session_run(model, inputs):
         sess_options = rt.SessionOptions()
         sess_options.graph_optimization_level = rt.GraphOptimizationLevel(0)
         sess_options.log_severity_level = 3
 
         sess = rt.InferenceSession(model.SerializeToString(), sess_options=sess_options,
                                    providers=["CPUExecutionProvider"])
-        input_names = self.get_input_names()
-        inputs = {}
-        for name in input_names:
-            shape = self.get_shape(name)
-            input_shapes.update({name: shape})
-        inputs.update(self.generate_specific_rand_input(input_shapes))
         outputs = [x.name for x in sess.get_outputs()]
         run_options = rt.RunOptions()
         run_options.log_severity_level = 3
         return OrderedDict(zip(outputs, sess.run(outputs, inputs, run_options=run_options)))
 
+    def forward(self, model):
+        input_shapes = {}
+        input_names = self.get_input_names()
+        for name in input_names:
+            shape = self.get_shape(name)
+            input_shapes.update({name: shape})
+        return self.session_run(model, self.generate_specific_rand_input(input_shapes))
+
     def forward_for_node_outputs(self, const_nodes):
-        model = copy.deepcopy(self.model)
+        # outputs added for the run only, a copy of the model would copy all the weights
+        num_output = len(self.model.graph.output)
         for node in const_nodes:
             for output in node.output:
-                model.graph.output.extend([onnx.ValueInfoProto(name=output)])
-        return self.forward(model)
+                self.model.graph.output.extend([onnx.ValueInfoProto(name=output)])
+        try:
+            return self.forward(self.model)
+        finally:
+            del self.model.graph.output[num_output:]
+
+    def forward_nodes(self, nodes, values):
+        # the nodes alone, their inputs of other nodes given as initializers
+        outputs = set(x for node in nodes for x in node.output)
+        inputs = set(x for node in nodes for x in node.input if x and x not in outputs)
+        graph = onnx.helper.make_graph(
+            nodes, "constant_nodes", [],
+            [onnx.ValueInfoProto(name=x) for node in nodes for x in node.output if x],
+            [onnx.numpy_helper.from_array(values[x], name=x) for x in inputs])
+        model = onnx.helper.make_model(graph, opset_imports=self.model.opset_import)
+        model.ir_version = self.model.ir_version
+        model.functions.extend(self.model.functions)
+        return self.session_run(model, {})
 
-    def eliminate_const_nodes(self, const_node, res):
-        do_eliminate = False
-        for i, node in enumerate(self.model.graph.node):
-            if node in const_node:
-                for output in node.output:
-                    new_node = copy.deepcopy(node)
-                    new_node.name = "node_" + output
-                    new_node.op_type = "Constant"
-                    new_attr = onnx.helper.make_attribute(
-                        "value",
-                        onnx.numpy_helper.from_array(res[output], name=output)
-                    )
-                    del new_node.input[:]
-                    del new_node.attribute[:]
-                    del new_node.output[:]
-                    new_node.output.extend([output])
-                    new_node.attribute.extend([new_attr])
-                    self.insert_elem(self.model.graph.node, i + 1, new_node)
-                del self.model.graph.node[i]
-                do_eliminate = True
-        return do_eliminate
+    @staticmethod
+    def static_shape(vinfo):
+        if vinfo is None or not vinfo.type.tensor_type.HasField("shape"):
+            return None
+        shape = ConstantFolding.get_shape_from_value_info_proto(vinfo)
+        # unknown dims are read as 0
+        return shape if all(x > 0 for x in shape) else None
+
+    def eval_node(self, node, values, value_infos):
+        # NumPy outputs of the node, None if it has to run in onnxruntime
+        attrs = dict((attr.name, onnx.helper.get_attribute_value(attr)) for attr in node.attribute)
+        if node.op_type == "Shape":
+            name = node.input[0]
+            if name in values:
+                shape = list(values[name].shape)
+            elif name in self.const_tensors:
+                return None
+            else:
+                shape = self.static_shape(value_infos.get(name))
+            start, end = attrs.get("start", 0), attrs.get("end")
+            return {node.output[0]: np.array(shape[start:end], dtype=np.int64)}
+        if node.op_type not in numpy_evaluators or \
+                any(x not in values for x in node.input if x):
+            return None
+        inputs = [values[x] if x else None for x in node.input]
+        try:
+            outputs = numpy_evaluators[node.op_type](inputs, attrs)
+        except Exception:
+            return None
+        return dict((name, np.asarray(x)) for name, x in zip(node.output, outputs))
 
     def remove_unused_nodes(self):
         node_inputs = []
@@ -248,11 +417,11 @@ class ConstantFolding(object):
         node_inputs.extend([out.name for out in self.model.graph.output])
         node_inputs = set(node_inputs)
 
-        for n in self.model.graph.node:
+        for i, n in enumerate(self.model.graph.node):
             if len(set(n.output).intersection(node_inputs)) == 0:
-                unused_node.append(n)
-        for n in unused_node:
-            self.model.graph.node.remove(n)
+                unused_node.append(i)
+        for i in reversed(unused_node):
+            del self.model.graph.node[i]
 
     def infer_shapes(self):
         try:
@@ -261,25 +430,77 @@ class ConstantFolding(object):
             pass
         # self.model = onnx.shape_inference.infer_shapes(self.model, strict_mode =True, data_prop=True)
 
-
-    def folding(self, infer_shapes=True):
-        const_nodes = self.get_constant_nodes()
-        res = self.forward_for_node_outputs(const_nodes)
-        const_node = [node for node in const_nodes if node.output[0] in res]
-        do_eliminate = self.eliminate_const_nodes(const_node, res)
-        if infer_shapes:
-            self.infer_shapes()
-        return do_eliminate
+    def fold_constants(self):
+        # One pass over the constant nodes in order: NumPy runs the ops it knows, onnxruntime the
+        # others in batches of the nodes ready, and the folded nodes are replaced by Constants
+        nodes = self.model.graph.node
+        const_ids = self.get_constant_node_ids()
+        graph = self.model.graph
+        value_infos = dict((v.name, v) for v in graph.input)
+        value_infos.update((v.name, v) for v in graph.output)
+        value_infos.update((v.name, v) for v in graph.value_info)
+        # only the weights read by the constant nodes are loaded
+        reads = set(x for i in const_ids for x in nodes[i].input)
+        values = dict((x.name, onnx.numpy_helper.to_array(x)) for x in graph.initializer
+                      if x.name in reads)
+        for node in nodes:
+            if node.op_type == "Constant" and node.output[0] in reads:
+                try:
+                    values[node.output[0]] = numpy_evaluators["Constant"]([], dict(
+                        (attr.name, onnx.helper.get_attribute_value(attr))
+                        for attr in node.attribute))[0]
+                except NotImplementedError:
+                    pass
+        # the shapes unknown to the shape inference are taken from a run of the model
+        unknown = [i for i in const_ids if nodes[i].op_type == "Shape" \
+                   and nodes[i].input[0] not in self.const_tensors \
+                   and self.static_shape(value_infos.get(nodes[i].input[0])) is None]
+        num_run = 0
+        if unknown:
+            values.update(self.forward_for_node_outputs([nodes[i] for i in unknown]))
+            num_run += 1
+        unknown = set(unknown)
+        pending = [i for i in const_ids if i not in unknown]
+        while pending:
+            batch, batch_outputs, deferred = [], set(), []
+            for i in pending:
+                res = self.eval_node(nodes[i], values, value_infos)
+                if res is not None:
+                    values.update(res)
+                elif all(x in values or x in batch_outputs for x in nodes[i].input if x):
+                    batch.append(i)
+                    batch_outputs.update(nodes[i].output)
+                else:
+                    deferred.append(i)
+            if not batch:
+                break
+            try:
+                values.update(self.forward_nodes([nodes[i] for i in batch], values))
+            except Exception as e:
+                print("WARNING: {} constant nodes not folded: {}".format(len(batch), e))
+            num_run += 1
+            pending = deferred
+        folded = set(i for i in const_ids if all(x in values for x in nodes[i].output if x))
+        new_nodes = []
+        for i, node in enumerate(nodes):
+            if i not in folded:
+                new_nodes.append(node)
+                continue
+            for output in node.output:
+                if output:
+                    new_nodes.append(onnx.helper.make_node(
+                        "Constant", [], [output], name="node_" + output,
+                        value=onnx.numpy_helper.from_array(values[output], name=output)))
+        del nodes[:]
+        nodes.extend(new_nodes)
+        print("constant folding: {} nodes folded, {} onnxruntime runs".format(
+            len(folded), num_run))
+        return len(folded) > 0
 
     def run(self):
-        def fixed_point(fun):
-            flag = fun()
-            while True:
-                if flag:
-                    flag = fun()
-                    continue
-                break
-        fixed_point(self.folding)
+        self.infer_shapes()
+        if self.fold_constants():
+            self.infer_shapes()
         self.remove_unused_nodes()
         # dump_model(self.model, "constant_opt.onnx")
         return self.model
@@ -383,10 +604,12 @@ class PatternNode(object):
 
 class ReformInfo(object):
 
-    def __init__(self, name: str, src_nodes, dst_nodes):
+    def __init__(self, name: str, src_nodes, dst_nodes, src_ids=[]):
         self.name = name
         self.src_nodes = src_nodes
         self.dst_nodes = dst_nodes
+        # positions of the matched src_nodes in the graph
+        self.src_ids = src_ids
 
 
 class ReForm(object):
@@ -404,36 +627,35 @@ class ReForm(object):
             info.name: [i.dim_value for i in info.type.tensor_type.shape.dim if i.dim_value > 0]
             for info in self.shape_info
         }
-        self.weight_tensor = [x.name for x in self.weight]
-        self.node_tensor = [node.output[0] for node in self.nodes if node.op_type == "Constant"]
+        self.build_index()
         # stores output node name mapping from src to dst of replace subgraphs
         self.node_name_mapping = {}
+        # pattern name: [matched num, seconds]
+        self.pattern_time = OrderedDict()
+
+    def build_index(self):
+        # tensor name to weight / Constant node / node, rebuilt when the node list changes
+        self.weight_tensor = dict((x.name, x) for x in self.weight)
+        self.node_tensor = dict(
+            (node.output[0], node) for node in self.nodes if node.op_type == "Constant")
+        self.node_output = set(node.output[0] for node in self.nodes if node.output)
 
     def get_tensor_value(self, name):
-        for n in self.nodes:
-            if name == n.output[0] and n.op_type == 'Constant':
-                return onnx.numpy_helper.to_array(n.attribute[0].t)
-        for w in self.weight:
-            if name == w.name:
-                return onnx.numpy_helper.to_array(w).astype(np.float32)
+        if name in self.node_tensor:
+            return onnx.numpy_helper.to_array(self.node_tensor[name].attribute[0].t)
+        if name in self.weight_tensor:
+            return onnx.numpy_helper.to_array(self.weight_tensor[name]).astype(np.float32)
 
     def find_tensor(self, name):
         if name in self.node_tensor or name in self.weight_tensor:
             return True
         return False
 
-    def get_node(self, name):
-        for idx, n in enumerate(self.nodes):
-            if name in n.output:
-                return idx, n
-
     def get_input_shape(self, name):
-        for n in self.nodes:
-            if name == n.output[0]:
-                return self.shape_info[name]
-        for w in self.weight:
-            if name == w.name:
-                return list(w.dims)
+        if name in self.node_output:
+            return self.shape_info[name]
+        if name in self.weight_tensor:
+            return list(self.weight_tensor[name].dims)
 
     def constraint(self, node, mode):
         if mode == 'broadcast' and len(node.input) == 2:
@@ -570,9 +792,10 @@ class ReForm(object):
         pnodeIdx = 0
         matched_patterns = []
         unused_nodes = []
+        unused_ids = []
         pattern = reform_info.src_nodes
         patternLens = len(pattern)
-        for node in self.nodes:
+        for idx, node in enumerate(self.nodes):
             matched = False
             if node.op_type == 'Constant':
                 continue
@@ -581,21 +804,25 @@ class ReForm(object):
             if matched:
                 pnodeIdx += 1
                 unused_nodes.append(node)
+                unused_ids.append(idx)
                 if pnodeIdx == patternLens:
                     newNodes = copy.deepcopy(reform_info.dst_nodes)
-                    matched_patterns.append(ReformInfo(name, unused_nodes, newNodes))
+                    matched_patterns.append(ReformInfo(name, unused_nodes, newNodes, unused_ids))
                     pnodeIdx = 0
                     unused_nodes = []
+                    unused_ids = []
                     self.reset_outer_node(pattern)
             else:
                 pnodeIdx = 0
                 unused_nodes = []
+                unused_ids = []
                 self.reset_outer_node(pattern)
                 if node.op_type == pattern[0].op_type:
                     matched = self.match_node(node, pattern[0])
                 if matched:
                     pnodeIdx += 1
                     unused_nodes.append(node)
+                    unused_ids.append(idx)
                 else:
                     self.reset_outer_node(pattern)
         return matched_patterns
@@ -610,11 +837,17 @@ class ReForm(object):
     def replace_pattern(self, matched_pattern):
         # Recently we assume that subgraph to be replace has only one output
         # TODO: implement for multi-output cases
+        # All the matches at once: the new nodes of a match take the place of its last node and
+        # the matched nodes are dropped, in one rebuild of the node list
+        if not matched_pattern:
+            return
+        new_nodes = {}
+        removed = set()
         for reform_info in matched_pattern:
             src_nodes = reform_info.src_nodes
             dst_nodes = reform_info.dst_nodes
             last_node = src_nodes[-1]
-            insert_idx, _ = self.get_node(last_node.output[0])
+            inserted = new_nodes.setdefault(reform_info.src_ids[-1], [])
             out = last_node.output
             for i, new_node in enumerate(dst_nodes):
                 if i == len(dst_nodes) - 1:
@@ -638,8 +871,7 @@ class ReForm(object):
                                                               value=onnx.helper.make_tensor(
                                                                   "value", onnx.TensorProto.FLOAT,
                                                                   tensor_value.shape, tensor_value))
-                        self.nodes.insert(insert_idx, new_onnx_node)
-                        insert_idx += 1
+                        inserted.append(new_onnx_node)
                         inode.output.extend(new_onnx_node.output)
                     _input.append(inode.output[0])
                 # insert new pattern node
@@ -648,42 +880,41 @@ class ReForm(object):
                                                  inputs=_input,
                                                  outputs=_output,
                                                  **new_node.get_attr())
-                self.nodes.insert(insert_idx, new_node)
-                insert_idx += 1
+                inserted.append(new_node)
             node_name = _output[0]
             src_oname = "{}_{}".format(node_name, src_nodes[-1].op_type)
             dst_oname = "{}_{}".format(node_name, dst_nodes[-1].op_type)
             assert (src_oname not in self.node_name_mapping)
             self.node_name_mapping[src_oname] = dst_oname
-            # clear up
-            for node in src_nodes:
-                self.nodes.remove(node)
-            self.remove_unused_tensor()
+            removed.update(reform_info.src_ids)
             # print("[ONNX OPT] RULE <<{}>> applied \n".format(reform_info.name))
+        self.rebuild_nodes(removed, new_nodes)
+
+    def rebuild_nodes(self, removed, new_nodes={}):
+        # node list without the nodes at the removed positions, new_nodes inserted before the
+        # nodes at their positions
+        nodes = []
+        for idx, node in enumerate(self.nodes):
+            nodes.extend(new_nodes.get(idx, []))
+            if idx not in removed:
+                nodes.append(node)
+        del self.nodes[:]
+        self.nodes.extend(nodes)
+        self.build_index()
 
     def remove_unused_tensor(self):
         # purging redundancy tensor
-        all_input = []
-        all_node = [n for n in self.nodes]
-        for n in all_node:
-            all_input.extend(n.input)
-        unused_weight = []
-        unused_node = []
-        for w in self.weight:
-            if w.name in all_input:
-                continue
-            unused_weight.append(w)
+        all_input = set()
         for n in self.nodes:
-            if n.op_type != "Constant" or n.output[0] in all_input:
-                continue
-            unused_node.append(n)
-        for w in unused_weight:
-            self.weight.remove(w)
-        for n in unused_node:
-            self.nodes.remove(n)
-        # update
-        self.weight_tensor = [x.name for x in self.weight]
-        self.node_tensor = [node.output[0] for node in self.nodes if node.op_type == "Constant"]
+            all_input.update(n.input)
+        unused_weight = [i for i, w in enumerate(self.weight) if w.name not in all_input]
+        unused_node = [
+            i for i, n in enumerate(self.nodes)
+            if n.op_type == "Constant" and n.output[0] not in all_input
+        ]
+        for i in reversed(unused_weight):
+            del self.weight[i]
+        self.rebuild_nodes(set(unused_node))
 
     def remove_duplicate(self):
         # same op_type and inputs different output_name
@@ -706,7 +937,7 @@ class ReForm(object):
         nodes_info.clear()
         # find duplicate node's str(input) output_name
         duplicate_op_type = duplicate_op.keys()
-        for node in self.nodes:
+        for idx, node in enumerate(self.nodes):
             if node.op_type not in duplicate_op_type:
                 continue
             if node.input in duplicate_op[node.op_type]:
@@ -719,10 +950,9 @@ class ReForm(object):
                     assert (len(okept) == len(oremove))
                     for i in range(len(okept)):
                         oname_map[oremove[i]] = okept[i]
-                    rm_node.append(node)
+                    rm_node.append(idx)
         # remove duplicat node
-        for n in rm_node:
-            self.nodes.remove(n)
+        self.rebuild_nodes(set(rm_node))
         # verify inputs for each node
         removed_input = oname_map.keys()
         for node in self.nodes:
@@ -749,9 +979,9 @@ class ReForm(object):
             else:
                 return find_cast(cast_dict[node], cast_dict)
 
-        for node in self.nodes:
+        for idx, node in enumerate(self.nodes):
             if node.op_type == "Cast":
-                cast_ops.append(node)
+                cast_ops.append(idx)
                 cast_in_dict[node.output[0]] = node.input[0]
                 if node.output[0] in net_out_names: reverse_search = True
                 continue
@@ -774,24 +1004,34 @@ class ReForm(object):
                         if out_name in net_out_names:
                             node.output[i] = out_name
 
-        for op in cast_ops:
-            self.nodes.remove(op)
+        self.rebuild_nodes(set(cast_ops))
 
     def graph_opt(self):
-        replaced = False
-        for reform_info in self.reform_info_list:
-            matched_pattern = self.match_pattern(reform_info)
-            if len(matched_pattern) > 0:
-                replaced = True
-            self.replace_pattern(matched_pattern)
-        if replaced:
-            self.graph_opt()
+        replaced = True
+        changed = False
+        while replaced:
+            replaced = False
+            for reform_info in self.reform_info_list:
+                start = time.time()
+                matched_pattern = self.match_pattern(reform_info)
+                if len(matched_pattern) > 0:
+                    replaced = True
+                self.replace_pattern(matched_pattern)
+                stat = self.pattern_time.setdefault(reform_info.name, [0, 0.0])
+                stat[0] += len(matched_pattern)
+                stat[1] += time.time() - start
+            changed |= replaced
+        if changed:
+            # the tensors left unused by all the replacements
+            self.remove_unused_tensor()
 
     def __call__(self, reform_info_list):
         self.reform_info_list = reform_info_list
         self.remove_cast()
         self.remove_duplicate()
         self.graph_opt()
+        for name, (num, seconds) in self.pattern_time.items():
+            print("[ONNX OPT] {}: {} matched, {:.3f}s".format(name, num, seconds))
         return self.node_name_mapping, self.nodes, self.weight
 
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import os
+import json
+import shutil
+from utils.dir_cache import DirCache
+
+
+class CompileCache(DirCache):
+    # Output files of a compile step, kept between runs in a directory per key. The key names
+    # everything the files depend on (model files, options, tool version); a hit copies them
+    # back.
+
+    def __init__(self, root, max_bytes):
+        super().__init__(os.path.expanduser(root), max_bytes)
+
+    def restore(self, key):
+        # the files restored, None on a miss
+        path = os.path.join(self.root, key)
+        manifest = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest):
+            return None
+        with open(manifest) as f:
+            files = json.load(f)
+        if not all(os.path.exists(os.path.join(path, str(i))) for i in range(len(files))):
+            return None
+        for i, file in enumerate(files):
+            dirname = os.path.dirname(file)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            shutil.copyfile(os.path.join(path, str(i)), file)
+        self.touch(path)
+        return files
+
+    def save(self, key, files):
+        path = os.path.join(self.root, key)
+        if os.path.exists(path) or sum(os.path.getsize(f) for f in files) > self.max_bytes:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        # made aside and renamed, a run killed while saving leaves no entry
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            for i, file in enumerate(files):
+                shutil.copyfile(file, os.path.join(tmp, str(i)))
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump(files, f)
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=path)
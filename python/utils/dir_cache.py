@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import os
+import time
+import shutil
+
+
+class DirCache:
+    # A cache root of one directory per key. The directories used the least recently are
+    # removed to keep the root under max_bytes; the ones being made ('.tmp' in the name) are
+    # left alone.
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def touch(path):
+        now = time.time()
+        os.utime(path, (now, now))
+
+    @staticmethod
+    def dir_size(path):
+        return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+    def evict(self, keep=None):
+        entries = []
+        for e in os.scandir(self.root):
+            if e.is_dir() and '.tmp' not in e.name:
+                entries.append((e.stat().st_mtime, e.path, self.dir_size(e.path)))
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
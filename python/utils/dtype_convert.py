@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+# Conversions between float32 and the 16/8 bits float formats, done on whole
+# arrays through numpy views. Low precision data is kept as its raw bits
+# (uint16 for bf16/fp16, uint8 for fp8), the same as runtime buffers and npz files.
+
+import sys
+import time
+import numpy as np
+
+__all__ = [
+    "bf16_to_fp32", "fp32_to_bf16", "fp16_to_fp32", "fp32_to_fp16", "fp8_to_fp32", "fp32_to_fp8"
+]
+
+
+def bf16_to_fp32(d_bf16):
+    assert d_bf16.dtype == np.uint16
+    return (d_bf16.astype(np.uint32) << 16).view(np.float32)
+
+
+def fp32_to_bf16(d_fp32, round_to_even=True):
+    # round half to even as the compiler does, or truncate the low 16 bits
+    assert d_fp32.dtype == np.float32
+    u32 = np.ascontiguousarray(d_fp32).view(np.uint32)
+    if not round_to_even:
+        return (u32 >> 16).astype(np.uint16)
+    tmp = u32 >> 16
+    tmp &= 1
+    tmp += 0x7FFF
+    tmp += u32
+    tmp >>= 16
+    d_bf16 = tmp.astype(np.uint16)
+    # rounding must not turn a NaN into Inf, keep it a quiet NaN
+    nan = np.isnan(d_fp32)
+    if nan.any():
+        d_bf16[nan] = ((u32[nan] >> 16) | 0x40).astype(np.uint16)
+    return d_bf16
+
+
+def fp16_to_fp32(d_fp16):
+    assert d_fp16.dtype == np.uint16
+    return d_fp16.view(np.float16).astype(np.float32)
+
+
+def fp32_to_fp16(d_fp32):
+    # numpy casts with round half to even
+    assert d_fp32.dtype == np.float32
+    return d_fp32.astype(np.float16).view(np.uint16)
+
+
+def _fp8_table(fmt):
+    # value of every fp8 code, e4m3 is the finite-only variant (no inf, nan is S.1111.111)
+    assert fmt in ("e4m3", "e5m2")
+    exp_bits, man_bits, bias = (4, 3, 7) if fmt == "e4m3" else (5, 2, 15)
+    codes = np.arange(256, dtype=np.uint32)
+    sign = np.where(codes & 0x80, -1.0, 1.0)
+    exp = (codes >> man_bits) & ((1 << exp_bits) - 1)
+    man = codes & ((1 << man_bits) - 1)
+    normal = (1.0 + man / (1 << man_bits)) * np.exp2(exp.astype(np.float64) - bias)
+    subnormal = (man / (1 << man_bits)) * np.exp2(1.0 - bias)
+    table = sign * np.where(exp == 0, subnormal, normal)
+    if fmt == "e4m3":
+        table[(codes & 0x7F) == 0x7F] = np.nan
+    else:
+        max_exp = (1 << exp_bits) - 1
+        table[(exp == max_exp) & (man == 0)] = sign[(exp == max_exp) & (man == 0)] * np.inf
+        table[(exp == max_exp) & (man != 0)] = np.nan
+    return table.astype(np.float32)
+
+
+_FP8_TABLE = {fmt: _fp8_table(fmt) for fmt in ("e4m3", "e5m2")}
+
+
+def fp8_to_fp32(d_fp8, fmt="e4m3"):
+    assert d_fp8.dtype == np.uint8
+    return _FP8_TABLE[fmt][d_fp8]
+
+
+def _fp32_to_fp8_exact(d_fp32, fmt):
+    table = _FP8_TABLE[fmt]
+    finite = np.isfinite(table[:0x80])
+    values = table[:0x80][finite]  # positive finite values, ascending with the code
+    codes = np.arange(0x80, dtype=np.uint8)[finite]
+    x = np.abs(d_fp32)
+    hi = np.minimum(np.searchsorted(values, x), values.size - 1)
+    lo = np.maximum(hi - 1, 0)
+    with np.errstate(invalid='ignore'):
+        d_lo = x - values[lo]
+        d_hi = values[hi] - x
+    pick_hi = (d_hi < d_lo) | ((d_hi == d_lo) & (codes[hi] % 2 == 0))
+    d_fp8 = np.where(pick_hi, codes[hi], codes[lo])
+    d_fp8 = np.where(np.signbit(d_fp32), d_fp8 | 0x80, d_fp8).astype(np.uint8)
+    d_fp8[np.isnan(d_fp32)] = 0x7F
+    return d_fp8
+
+
+_FP8_ENCODE = {}
+
+
+def _fp8_encode_table(fmt):
+    # fp8 keeps at most 3 mantissa bits, so the rounding of a fp32 is decided by its high
+    # 16 bits and whether any of the low 16 bits is set; encode each such class once
+    if fmt not in _FP8_ENCODE:
+        high = np.arange(1 << 16, dtype=np.uint32) << 16
+        keys = np.stack([high, high | 1], axis=1).reshape(-1)
+        _FP8_ENCODE[fmt] = _fp32_to_fp8_exact(keys.view(np.float32), fmt)
+    return _FP8_ENCODE[fmt]
+
+
+def fp32_to_fp8(d_fp32, fmt="e4m3"):
+    # round half to even, values beyond the largest finite one saturate to it
+    assert d_fp32.dtype == np.float32
+    u32 = np.ascontiguousarray(d_fp32).view(np.uint32)
+    key = u32 >> 16
+    key <<= 1
+    key |= (u32 & 0xFFFF) != 0
+    return _fp8_encode_table(fmt)[key]
+
+
+def benchmark(num=100000000):
+    data = np.random.randn(num).astype(np.float32)
+    for name, to_low, to_fp32 in [("bf16", fp32_to_bf16, bf16_to_fp32),
+                                  ("fp16", fp32_to_fp16, fp16_to_fp32),
+                                  ("fp8", fp32_to_fp8, fp8_to_fp32)]:
+        t0 = time.time()
+        low = to_low(data)
+        t1 = time.time()
+        to_fp32(low)
+        t2 = time.time()
+        print("{}: {} elements, fp32->{} {:.3f}s, {}->fp32 {:.3f}s".format(
+            name, num, name, t1 - t0, name, t2 - t1))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000000)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# ==============================================================================
+#
+# Copyright (C) 2022 Sophgo Technologies Inc.  All rights reserved.
+#
+# TPU-MLIR is licensed under the 2-Clause BSD License except for the
+# third-party components.
+#
+# ==============================================================================
+
+import hashlib
+import numpy as np
+
+
+def hash_file(path, h=None, chunk=1 << 20):
+    h = hashlib.sha1() if h is None else h
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h
+
+
+def hash_array(value, h):
+    value = np.ascontiguousarray(value)
+    h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+    h.update(value.data)
+    return h
@@ -6,11 +6,12 @@ import argparse
 import numpy as np
 import math
 from tqdm import tqdm
-import gc
 import copy
 from scipy.special import expit
 
-from datetime import datetime
+import json
+import mmap
+from collections import OrderedDict
 from multiprocessing.pool import ThreadPool
 from multiprocessing import Lock
 
@@ -19,6 +20,7 @@ import pymlir
 from utils.mlir_parser import MlirParser
 from utils.preprocess import preprocess
 from calibration.data_selector import DataSelector
+from utils.file_hash import hash_file, hash_array
 
 
 SKIP_OPERATION = [
@@ -233,93 +235,76 @@ class learning_inputs:
         return self.num_sample
 
 class ref_tensors:
-    def __init__(self, loopnum, seg, buf_num=8):
+    # Reference tensors of all the samples in one memory-mapped file: each op has a contiguous
+    # page aligned region of [loopnum, *shape] float32, so the tensor of a sample is a slice.
+    # The resident pages are bounded by budget bytes, the segments of seg samples of an op read
+    # the least recently are dropped from memory (LRU). A manifest names the model and the
+    # inputs the file was gathered from, a rerun on the same ones reuses it.
+    def __init__(self, loopnum, seg, budget=4 << 30):
         self.loopnum = loopnum
-        self.ops = {}
-        self.dir = './buf/'
-        self.len = 0
         self.seg = seg
-        self.cnt = {}
-        self.tensors = {}
-        self.batch_tensors = []
-        self.buffer = {}
-        self.atime = {}
-        self.buf_num = buf_num
+        self.budget = budget
+        self.dir = './buf/'
+        self.data_file = self.dir + 'ref_tensors.bin'
+        self.manifest_file = self.dir + 'manifest.json'
+        self.ops = {}
+        self.layout = {}
+        self.mm = None
+        self.views = {}
+        self.lru = OrderedDict()
+        self.resident = 0
         self.lock = Lock()
-
-        if os.path.exists(self.dir):
-            if not os.path.isfile(self.dir+'0-0.npy'):
-                return
-            total = np.ceil(loopnum/seg)
-            cnt = 0
-            for i in np.arange(total):
-                if not os.path.isfile(self.dir+'0-'+str(int(i))+'.npy'):
-                    return
-                test = np.load(self.dir+'0-'+str(int(i))+'.npy')
-                cnt = cnt + test.shape[0]
-                del test
-            if cnt < loopnum:
-                print(
-                    f"samples in buf not enough, {cnt} vs {loopnum}, re run!")
-                import shutil
-                try:
-                    shutil.rmtree(self.dir)
-                    os.mkdir(self.dir)
-                except OSError as e:
-                    print("Error: %s - %s." % (e.filename, e.strerror))
-            self.len = cnt
-        else:
-            os.mkdir(self.dir)
-
-    def load(self, op, idx):
-        if op in self.ops:
-            fname = self.ops[op]
-        else:
-            self.ops[op] = str(len(self.ops))
-            fname = self.ops[op]
-        index = op+'+'+str(idx)
-        self.lock.acquire()
-        if index not in self.buffer:
-            self.buffer[index] = np.load(self.dir+fname+'-'+str(int(idx))+'.npy')
-        self.lock.release()
-        self.atime[index] = datetime.now()
-        if len(self.buffer) > self.buf_num:
-            self.lock.acquire()
-            t=datetime.now()
-            e=''
-            for i in self.buffer:
-                if self.atime[i] < t:
-                    t = self.atime[i]
-                    e = i
-            if e != index and (datetime.now()-self.atime[e]).total_seconds()>2:
-                del self.buffer[e]
-                del self.atime[e]
-            self.lock.release()
-        return self.buffer[index]
-
-
-    def save(self, cnt):
-        for op in self.ops:
-            fname = self.ops[op]
-            shape = list(np.expand_dims(self.batch_tensors[0][op], axis=0).shape)
-            if (cnt+1) % self.seg == 0:
-                shape[0] = self.seg
-            else:
-                shape[0] = (cnt+1) % self.seg
-            buf = np.zeros(tuple(shape), dtype=np.float32)
-            for i in np.arange(shape[0]):
-                buf[i] = np.expand_dims(self.batch_tensors[i][op], axis=0)
-            np.save(self.dir+fname+'-'+str(cnt//self.seg)+'.npy', buf)
-        self.batch_tensors = []
-        del buf
-        gc.collect()
+        os.makedirs(self.dir, exist_ok=True)
 
     def add_name(self, ops):
         for op in ops:
-            if op in self.ops:
-                continue
-            else:
-                self.ops[op] = str(len(self.ops))
+            if op not in self.ops:
+                self.ops[op] = len(self.ops)
+
+    def key(self, learner, inputs):
+        h = hash_file(learner.mlir_file)
+        hash_file(learner.parser.module_weight_file, h)
+        h.update(json.dumps([self.loopnum, list(self.ops)]).encode())
+        for loop in range(self.loopnum):
+            for name, value in inputs.ref_activations[loop].items():
+                h.update(name.encode())
+                hash_array(value[0], h)
+        return h.hexdigest()
+
+    def reuse(self, key):
+        if not os.path.isfile(self.manifest_file) or not os.path.isfile(self.data_file):
+            return False
+        with open(self.manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['key'] != key or os.path.getsize(self.data_file) != manifest['size']:
+            print('reference tensors in buf are of other model or inputs, re run!')
+            return False
+        self.layout = {op: (offset, tuple(shape)) for op, (offset, shape) in manifest['ops'].items()}
+        self.open()
+        return True
+
+    def create(self, shapes):
+        # one region per op, aligned to pages to drop them from memory
+        offset = 0
+        self.layout = {}
+        for op, shape in shapes.items():
+            self.layout[op] = (offset, tuple(shape))
+            size = self.loopnum * int(np.prod(shape)) * 4
+            offset += (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        if os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+        with open(self.data_file, 'wb') as f:
+            f.truncate(max(offset, 1))
+        return np.memmap(self.data_file, dtype=np.uint8, mode='r+', shape=(max(offset, 1),))
+
+    def open(self):
+        with open(self.data_file, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = {}
+        for op, (offset, shape) in self.layout.items():
+            count = self.loopnum * int(np.prod(shape))
+            self.views[op] = np.frombuffer(self.mm, dtype=np.float32, count=count,
+                                           offset=offset).reshape((self.loopnum, ) + shape)
 
     def infer(self, module, data: dict, input_names: list):
         for name in input_names:
@@ -330,37 +315,69 @@ class ref_tensors:
             outputs[name] = module.get_tensor(name)
         return outputs
 
-    def gather_orig_tensors(self, learner, inputs, idx):
-        import sys
-        net_input = list(inputs.ref_activations[idx].keys())
-        outputs = self.infer(learner.module, inputs.ref_activations[idx], net_input)
-        tensors = {}
-        for name in self.ops:
-            tensors[name] = copy.deepcopy(learner.module.get_tensor(name))
-        self.batch_tensors.append(tensors)
-
     def gather(self, learner, inputs):
         self.add_name(learner.module.all_tensor_names)
         self.add_name(learner.parser.get_op_name_list())
-        if self.len < learner.num_sample:
-            pbar = tqdm(np.arange(learner.num_sample))
-            pbar.set_description("Gather ref ")
-            for loop in pbar:
-                self.gather_orig_tensors(learner, inputs, loop)
-                if (loop+1) % self.seg == 0 or ((loop) == (learner.num_sample - 1)):
-                    self.save(loop)
-                    gc.collect()
+        key = self.key(learner, inputs)
+        if self.reuse(key):
+            print(f'reuse reference tensors of {self.loopnum} samples in {self.dir}')
+            return
+        buf = None
+        pbar = tqdm(np.arange(learner.num_sample))
+        pbar.set_description("Gather ref ")
+        for loop in pbar:
+            net_input = list(inputs.ref_activations[loop].keys())
+            self.infer(learner.module, inputs.ref_activations[loop], net_input)
+            if buf is None:
+                buf = self.create({op: learner.module.get_tensor(op).shape for op in self.ops})
+            for op, (offset, shape) in self.layout.items():
+                size = int(np.prod(shape)) * 4
+                dst = buf[offset + loop * size:offset + (loop + 1) * size].view(np.float32)
+                dst[:] = learner.module.get_tensor(op).reshape(-1)
+        if buf is None:
+            # no sample, the shapes are not known and no tensor is read
+            buf = self.create({})
+        buf.flush()
+        del buf
+        manifest = {
+            'key': key,
+            'size': os.path.getsize(self.data_file),
+            'ops': {op: [offset, list(shape)] for op, (offset, shape) in self.layout.items()}
+        }
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        self.open()
+
+    def _drop(self, unit):
+        # the pages are read again from the file when needed
+        op, idx = unit
+        offset, shape = self.layout[op]
+        size = int(np.prod(shape)) * 4
+        begin = offset + idx * self.seg * size
+        end = offset + min((idx + 1) * self.seg, self.loopnum) * size
+        begin = (begin + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        end = end // mmap.PAGESIZE * mmap.PAGESIZE
+        if end > begin and hasattr(mmap, 'MADV_DONTNEED'):
+            self.mm.madvise(mmap.MADV_DONTNEED, begin, end - begin)
 
     def get(self, op, loop):
-        if op in self.ops:
-            fname = self.ops[op]
-        else:
+        if op not in self.views:
             print(f'op not exist {op}')
-            print(self.ops)
+            print(list(self.ops))
             sys.exit(1)
-        idx = loop//self.seg
-        data_all = self.load(op, idx)
-        return data_all[loop % self.seg]
+        unit = (op, loop // self.seg)
+        with self.lock:
+            if unit in self.lru:
+                self.lru.move_to_end(unit)
+            else:
+                self.lru[unit] = self.views[op][0].nbytes * self.seg
+                self.resident += self.lru[unit]
+                while self.resident > self.budget and len(self.lru) > 1:
+                    old, size = self.lru.popitem(last=False)
+                    self._drop(old)
+                    self.resident -= size
+        return self.views[op][loop]
 
 class LrScheduler:
     def __init__(self, lr, max_iter, mode):
@@ -1256,7 +1273,9 @@ if __name__ == '__main__':
     parser.add_argument('--input_num', type=int, default=1000,
                         help='num of input samples for quantization searching')
     parser.add_argument('--data_seg', type=int, default=1000,
-                        help='num of samples to buffer data on disk, they will be re-aranged after gather all samples')
+                        help='num of samples in a segment of the buffered reference tensors, the unit kept in memory')
+    parser.add_argument('--buf_size', type=float, default=4096,
+                        help='MB of buffered reference tensors kept in memory')
     parser.add_argument('--epoch', type=int, default=1,
                         help='num of repeat times of input_num samples for weight learning')
     parser.add_argument('--mini_batch', type=int, default=4,
@@ -1312,7 +1331,7 @@ if __name__ == '__main__':
             scale_searcher.opt = scale_searcher.SgdScaleOpt(scheduler, args.momentum, args.nesterov, args.weight_decay)
         else:
             scale_searcher.opt = scale_searcher.AdamScaleOpt(scheduler, 0.9, 0.999, args.weight_decay)
-    ref_all_tensor = ref_tensors(scale_searcher.num_sample, args.data_seg, args.threads*4*(num_sample//args.data_seg))
+    ref_all_tensor = ref_tensors(scale_searcher.num_sample, args.data_seg, int(args.buf_size * 2**20))
     ref_all_tensor.gather(scale_searcher, all_inputs)
     del all_inputs
     if learn_scale:
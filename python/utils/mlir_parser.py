@@ -150,9 +150,12 @@ class Operation:
 
 class MlirParser:
 
-    def __init__(self, mlir_file):
-        with open(mlir_file, 'r') as f:
-            context = f.read()
+    def __init__(self, mlir_file=None, mlir_str=None):
+        if mlir_str is None:
+            with open(mlir_file, 'r') as f:
+                context = f.read()
+        else:
+            context = mlir_str
         self.ctx = mlir.ir.Context()
         self.ctx.allow_unregistered_dialects = True
         self.module = mlir.ir.Module.parse(context, self.ctx)
@@ -165,9 +168,10 @@ class MlirParser:
         self.ops = []
         self.return_op = None
 
+        # indexing body.operations walks the op list from its head, iterate it only once
+        self.body_ops = list(self.body.operations)
         cache_map = {}
-        for i in range(len(self.body.operations)):
-            prev_op = self.body.operations[i]
+        for i, prev_op in enumerate(self.body_ops):
             if Operation.type(prev_op) not in [
                     "tpu.None",
                     "top.None",
@@ -177,8 +181,7 @@ class MlirParser:
                 cache_map.setdefault(prev_op.results[0],[]).append([i, Operation.name(prev_op)])
         Operation.cache_map = cache_map
 
-        for i in range(len(self.body.operations)):
-            op = self.body.operations[i]
+        for i, op in enumerate(self.body_ops):
             type = Operation.type(op)
             if type in ['top.None', 'top.Weight', 'func.return']:
                 if type == 'func.return':
@@ -189,9 +192,61 @@ class MlirParser:
         for op in self.ops:
             if op.type == 'top.Input':
                 self.inputs.append(op)
+        self._build_index()
+
+    def _build_index(self):
+        # all lookups by op name are served from these maps, built once
+        self.op_names = [op.name for op in self.ops]
+        self.op_map = {}
+        self.op_idx_map = {}
+        self.pre_ops_map = {}
+        self.next_ops_map = {}
+        self.user_count_map = {}
+        self.use_count_map = {}
+        name_set = set(self.op_names)
+        for i, op in enumerate(self.ops):
+            if op.name not in self.op_map:
+                self.op_map[op.name] = op
+                self.op_idx_map[op.name] = i
+            self.pre_ops_map.setdefault(op.name, []).extend(
+                [opd for opd in op.opds if opd in name_set])
+            for opd in op.opds:
+                self.use_count_map[opd] = self.use_count_map.get(opd, 0) + 1
+            for opd in dict.fromkeys(op.opds):
+                self.user_count_map[opd] = self.user_count_map.get(opd, 0) + 1
+                self.next_ops_map.setdefault(opd, []).append(op.name)
 
     def get_op_name_list(self):
-        return [op.name for op in self.ops]
+        return list(self.op_names)
+
+    def get_op_idx_by_op_name(self, op_name):
+        return self.op_idx_map.get(op_name)
+
+    def get_topological_order(self):
+        # ops of a func body follow SSA dominance, so the body order is a valid topological order
+        return list(self.op_names)
+
+    def get_ancestors_by_op_name(self, op_name):
+        ancestors = set()
+        stack = list(self.pre_ops_map.get(op_name, []))
+        while stack:
+            name = stack.pop()
+            if name in ancestors:
+                continue
+            ancestors.add(name)
+            stack.extend(self.pre_ops_map.get(name, []))
+        return [name for name in self.op_names if name in ancestors]
+
+    def get_descendants_by_op_name(self, op_name):
+        descendants = set()
+        stack = list(self.next_ops_map.get(op_name, []))
+        while stack:
+            name = stack.pop()
+            if name in descendants:
+                continue
+            descendants.add(name)
+            stack.extend(self.next_ops_map.get(name, []))
+        return [name for name in self.op_names if name in descendants]
 
     def get_input_num(self):
         return len(self.inputs)
@@ -203,65 +258,38 @@ class MlirParser:
         return Operation.shape(self.inputs[0].op)[0]
 
     def get_pre_op_by_op_name(self, op_name):
-        op_input_tensor = []
-        for op in self.ops:
-            if op.name == op_name:
-                for opd in op.opds:
-                    if opd in self.get_op_name_list():
-                        op_input_tensor.append(opd)
-        return op_input_tensor
+        return list(self.pre_ops_map.get(op_name, []))
 
     def get_next_op_by_op_name(self, op_name):
-        op_output_tensor = []
-        for op in self.ops:
-            if op_name in op.opds:
-                if op.name in self.get_op_name_list():
-                    op_output_tensor.append(op.name)
-        return op_output_tensor
+        return list(self.next_ops_map.get(op_name, []))
 
     def get_user_count_by_op_name(self, op_name):
-        count = 0
-        for op in self.ops:
-            if op_name in op.opds:
-                count += 1
-        return count
+        return self.user_count_map.get(op_name, 0)
 
     def get_use_count_by_op_name(self, op_name):
-        count = 0
-        for op in self.ops:
-            count += op.opds.count(op_name)
-        return count
+        return self.use_count_map.get(op_name, 0)
 
     def get_outputs_by_op_name(self, op_name):
-        for op in self.ops:
-            if op.name == op_name:
-                return op.outputs
-        return None
+        op = self.op_map.get(op_name)
+        return op.outputs if op is not None else None
 
     def get_op_by_op_name(self, op_name):
-        for op in self.ops:
-            if op.name == op_name:
-                return op
-        return None
+        return self.op_map.get(op_name)
 
     def get_opds_by_op_name(self, op_name):
-        for op in self.ops:
-            if op.name == op_name:
-                return op.opds
-        return None
+        op = self.op_map.get(op_name)
+        return op.opds if op is not None else None
 
     def get_op_type_by_op_name(self, op_name):
-        for op in self.ops:
-            if op.name == op_name:
-                return op.type
-        return None
+        op = self.op_map.get(op_name)
+        return op.type if op is not None else None
 
     # the func is to get a dict with output names and corresponding shapes
     def get_output_op_names_n_shapes(self):
         if not self.return_op:
             return []
         outputs = {}
-        for op in self.body.operations:
+        for op in self.body_ops:
             if op == self.return_op:
                 continue
             for opd in self.return_op.operands:
@@ -274,8 +302,7 @@ class MlirParser:
 
     def get_middle_op_names_n_shape_type(self):
         middles = {}
-        for i in range(len(self.body.operations)):
-            op = self.body.operations[i]
+        for op in self.body_ops:
             type = Operation.type(op)
             if type in ['top.None', 'top.Input', 'func.return']:
                 continue
@@ -287,8 +314,7 @@ class MlirParser:
     def get_initializer_op_names_n_shape_type(self):
 
         initializer = {}
-        for i in range(len(self.body.operations)):
-            op = self.body.operations[i]
+        for op in self.body_ops:
             type = Operation.type(op)
             if type != 'top.Weight':
                 continue
@@ -99,6 +99,35 @@ def mlir_lowering(top_mlir: str,
     _os_system(cmd)
 
 
+def mlir_lowering_in_process(module,
+                             top_mlir: str,
+                             tpu_mlir: str,
+                             mode: str,
+                             chip: str,
+                             cali_table: str = None,
+                             asymmetric: bool = False,
+                             quantize_table: str = None):
+    # same passes as mlir_lowering, but run by pymlir on an in-memory copy of top_mlir,
+    # the lowered module is loaded into `module` without writing tpu_mlir
+    passes = ["init", "chip-assign{{chip={}}}".format(chip.lower())]
+    mode = mode.upper()
+    asymmetric = False  # TODO: always using symmetric, as asymmetric not good
+    if cali_table != None:
+        passes.append("import-calibration-table{{file={} asymmetric={}}}".format(
+            cali_table, asymmetric))
+    passes.append("chip-top-optimize")
+    qtable = ""
+    if quantize_table:
+        assert (tpu_mlir.endswith(".mlir"))
+        weight_name = tpu_mlir[:-len(".mlir")] + "_qtable_weights.npz"
+        qtable = "qtable={} weightFileName={}".format(quantize_table, weight_name)
+    passes.append("convert-top-to-tpu{{mode={} {} asymmetric={}}}".format(mode, qtable, asymmetric))
+    passes.extend(["canonicalize", "deinit"])
+    pipeline = ",".join(passes)
+    print("[Lowering in process]: {} {}".format(top_mlir, pipeline))
+    module.lowering(top_mlir, pipeline)
+
+
 def mlir_to_model(tpu_mlir: str,
                   model: str,
                   final_mlir: str,
@@ -5,6 +5,8 @@ import cv2
 import ast
 import argparse
 from enum import Enum
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from utils.log_setting import setup_logger
 from utils.mlir_parser import *
 from utils.misc import *
@@ -42,6 +44,29 @@ customization_format_attributes = {
     'RGBA_PLANAR':   ('rgba', 'nchw')
 }
 
+_thread_pools = {}
+
+
+def _thread_pool(name):
+    # shared pools, "image" decodes single images and "batch" assembles whole batches,
+    # kept apart so a batch waiting on its images never holds an image worker
+    if name not in _thread_pools:
+        _thread_pools[name] = ThreadPoolExecutor(thread_name_prefix="preprocess_" + name)
+    return _thread_pools[name]
+
+
+def batch_image_inputs(data_list, input_num, batch_size):
+    # group image samples ("a.jpg,b.jpg" per line, one path per input) into batched
+    # run() inputs for each input, a trailing incomplete batch is dropped
+    batches = [[] for _ in range(input_num)]
+    for start in range(0, len(data_list) - batch_size + 1, batch_size):
+        samples = [[s.strip() for s in data.split(',')] for data in data_list[start:start + batch_size]]
+        for inputs in samples:
+            assert (input_num == len(inputs))
+        for i in range(input_num):
+            batches[i].append(','.join(inputs[i] for inputs in samples))
+    return batches
+
 # fix bool bug of argparse
 
 
@@ -431,29 +456,27 @@ class preprocess(object):
 
         total_size = self.align_up(v_offset + int(h/2) * uv_w_aligned, self.VPSS_CHANNEL_ALIGN)
         yuv420 = np.zeros(int(total_size), np.uint8)
-        for h_idx in range(h):
-            for w_idx in range(w):
-                r, g, b = input[h_idx][w_idx]
-                y = int(0.2569 * r + 0.5044 * g + 0.0979 * b + 16)
-                u = int(-0.1483 * r - 0.2911 * g + 0.4394 * b + 128)
-                v = int(0.4394 * r - 0.3679 * g - 0.0715 * b + 128)
-                y = max(min(y, 255), 0)
-                u = max(min(u, 255), 0)
-                v = max(min(v, 255), 0)
-                yuv420[y_offset + h_idx * y_w_aligned + w_idx] = y
-                if (h_idx % 2 == 0 and w_idx % 2 == 0):
-                  if pixel_type == YuvType.YUV420_PLANAR:
-                    u_idx = int(u_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2))
-                    v_idx = int(v_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2))
-                  elif pixel_type == YuvType.YUV_NV12:
-                    u_idx = int(u_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2) * 2)
-                    v_idx = int(v_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2) * 2 + 1)
-                  else :
-                    u_idx = int(u_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2) * 2 + 1)
-                    v_idx = int(v_offset + int(h_idx/2) * uv_w_aligned + int(w_idx / 2) * 2)
-
-                  yuv420[u_idx] = u
-                  yuv420[v_idx] = v
+        # in float64 as the per pixel python arithmetic on NumPy 1, truncate toward zero then clamp
+        input = input.astype(np.float64)
+        r, g, b = input[:, :, 0], input[:, :, 1], input[:, :, 2]
+        y = np.clip(np.trunc(0.2569 * r + 0.5044 * g + 0.0979 * b + 16), 0, 255).astype(np.uint8)
+        # u,v only sampled at even rows and cols
+        r, g, b = r[::2, ::2], g[::2, ::2], b[::2, ::2]
+        u = np.clip(np.trunc(-0.1483 * r - 0.2911 * g + 0.4394 * b + 128), 0, 255).astype(np.uint8)
+        v = np.clip(np.trunc(0.4394 * r - 0.3679 * g - 0.0715 * b + 128), 0, 255).astype(np.uint8)
+        yuv420[y_offset:y_offset + h * y_w_aligned].reshape(h, y_w_aligned)[:, :w] = y
+        uv_h, uv_w = u.shape
+        u_plane = yuv420[u_offset:u_offset + uv_h * uv_w_aligned].reshape(uv_h, uv_w_aligned)
+        v_plane = yuv420[v_offset:v_offset + uv_h * uv_w_aligned].reshape(uv_h, uv_w_aligned)
+        if pixel_type == YuvType.YUV420_PLANAR:
+            u_plane[:, :uv_w] = u
+            v_plane[:, :uv_w] = v
+        elif pixel_type == YuvType.YUV_NV12:
+            u_plane[:, 0:2 * uv_w:2] = u
+            v_plane[:, 1:2 * uv_w:2] = v
+        else:
+            u_plane[:, 1:2 * uv_w:2] = u
+            v_plane[:, 0:2 * uv_w:2] = v
         return yuv420.reshape(int(total_size), 1, 1)
 
     def align_packed_frame(self, x, aligned):
@@ -488,15 +511,39 @@ class preprocess(object):
         return x_tmp2
 
     def run(self, input):
+        x, self.ratio_list = self.__process(input)
+        return x
+
+    def prefetch(self, inputs, depth=4):
+        # run() every item of inputs ahead of the consumer, at most depth batches in flight.
+        # Batches come back in order, get_config('ratio') follows the batch last yielded.
+        inputs = iter(inputs)
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < depth:
+                    input = next(inputs, None)
+                    if input is None:
+                        break
+                    pending.append(_thread_pool("batch").submit(self.__process, input))
+                if not pending:
+                    return
+                x, self.ratio_list = pending.popleft().result()
+                yield x
+        finally:
+            for f in pending:
+                f.cancel()
+
+    def __process(self, input):
         # load and resize image, the output image is chw format.
-        x_list = []
-        self.ratio_list = []
-        for path in input.split(','):
-            x, ratio = self.__load_image_and_resize(path)
-            x = np.expand_dims(x, axis=0)
-            x_list.append(x)
-            self.ratio_list.append(ratio)
-        x = np.concatenate(x_list, axis=0)
+        # images are decoded in parallel, cv2 and PIL release the GIL while decoding
+        paths = input.split(',')
+        if len(paths) > 1:
+            loaded = list(_thread_pool("image").map(self.__load_image_and_resize, paths))
+        else:
+            loaded = [self.__load_image_and_resize(paths[0])]
+        ratio_list = [ratio for _, ratio in loaded]
+        x = np.stack([image for image, _ in loaded], axis=0)
         # take center crop if needed
         if self.resize_dims != self.net_input_dims:
             if self.crop_method == "right":
@@ -505,26 +552,28 @@ class preprocess(object):
                 x = self.__center_crop(x, self.net_input_dims)
 
         x = x.astype(np.float32)
+        if self.fuse_pre and self.customization_format.find("YUV") >= 0:
+            pixel_type = YuvType.YUV420_PLANAR
+            if self.customization_format == 'YUV420_PLANAR':
+                pixel_type = YuvType.YUV420_PLANAR
+            elif self.customization_format == 'YUV_NV12':
+                pixel_type = YuvType.YUV_NV12
+            else:
+                pixel_type = YuvType.YUV_NV21
+            # swap to 'rgb', nchw -> nhwc
+            x = np.transpose(x[:, [2, 1, 0], :, :], (0, 2, 3, 1))
+            # frames are laid one after another, as the [n, 1, 1, size] input
+            x = np.concatenate([self.rgb2yuv420(frame, pixel_type) for frame in x], axis=0)
+            x = x.astype(np.uint8)
+            if len(paths) == 1:
+                x = np.tile(x, (self.batch_size, 1, 1))
+            return x, ratio_list
         if self.fuse_pre:
             x = np.squeeze(x, 0)
             if self.customization_format == "GRAYSCALE":
                 x = self.align_gray_frame(x, self.aligned)
                 x = np.expand_dims(x, axis=0)
                 x = x.astype(np.uint8)
-            elif self.customization_format.find("YUV") >= 0:
-                # swap to 'rgb'
-                pixel_type = YuvType.YUV420_PLANAR
-                if self.customization_format == 'YUV420_PLANAR':
-                    pixel_type = YuvType.YUV420_PLANAR
-                elif self.customization_format == 'YUV_NV12':
-                    pixel_type = YuvType.YUV_NV12
-                else:
-                    pixel_type = YuvType.YUV_NV21
-                x = x[[2, 1, 0], :, :]
-                x = np.transpose(x, (1, 2, 0))
-                x = self.rgb2yuv420(x, pixel_type)
-                x = x.astype(np.uint8)
-                assert(self.batch_size == 1)
             elif self.customization_format.find("_PLANAR") >= 0:
                 if self.pixel_format == 'rgb':
                     x = x[[2, 1, 0], :, :]
@@ -542,16 +591,17 @@ class preprocess(object):
                 logger.info("unsupported pixel format");
                 assert(0)
         else:
+            mean, scale = self.mean, self.scale
             if self.pixel_format == 'gray':
-                self.mean = self.mean[:, :1, :, :]
-                self.scale = self.scale[:, :1, :, :]
+                mean = mean[:, :1, :, :]
+                scale = scale[:, :1, :, :]
             elif self.pixel_format == 'rgb':
                 x = x[:, [2, 1, 0], :, :]
-            x = (x - self.mean) * self.scale
+            x = (x - mean) * scale
 
             if self.channel_format == 'nhwc':
                 x = np.transpose(x, (0, 2, 3, 1))
 
-        if len(input.split(',')) == 1:
+        if len(paths) == 1:
             x = np.repeat(x, self.batch_size, axis=0)
-        return x
+        return x, ratio_list